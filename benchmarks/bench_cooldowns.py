@@ -0,0 +1,71 @@
+"""Compare memory use of the XP cooldown tracker with a plain dict.
+
+Run from the repository root:
+
+    python benchmarks/bench_cooldowns.py [messages] [messages_per_second]
+
+A synthetic stream of messages from distinct users (every message comes
+from a user that has not talked before) is fed through CooldownTracker and
+through the plain `{user_id: timestamp}` dict process_xp used before. The
+clock is simulated, so the run takes as long as the CPU work and not the
+simulated time.
+"""
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def run_tracker(messages, rate, report_every):
+    tracker = main.CooldownTracker(main.XP_COOLDOWN)
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(messages):
+        now = i / rate
+        tracker.try_acquire("1", str(i), now)
+        if (i + 1) % report_every == 0:
+            current, _ = tracemalloc.get_traced_memory()
+            print(f"  {i + 1:>10,} messages  {len(tracker):>8,} entries  {current / 1024 / 1024:8.2f} MiB")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run_dict(messages, rate, report_every):
+    cooldowns = {}
+    tracemalloc.start()
+    start = time.perf_counter()
+    for i in range(messages):
+        now = i / rate
+        user_id = str(i)
+        if user_id in cooldowns and now - cooldowns[user_id] < main.XP_COOLDOWN:
+            continue
+        cooldowns[user_id] = now
+        if (i + 1) % report_every == 0:
+            current, _ = tracemalloc.get_traced_memory()
+            print(f"  {i + 1:>10,} messages  {len(cooldowns):>8,} entries  {current / 1024 / 1024:8.2f} MiB")
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run():
+    messages = int(sys.argv[1]) if len(sys.argv) > 1 else 2_000_000
+    rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    report_every = max(1, messages // 8)
+    print(f"{messages:,} distinct users at {rate:,.0f} messages/s, XP_COOLDOWN={main.XP_COOLDOWN}s")
+
+    for name, func in (("CooldownTracker", run_tracker), ("plain dict", run_dict)):
+        print(name)
+        elapsed, peak = func(messages, rate, report_every)
+        print(f"  peak {peak / 1024 / 1024:.2f} MiB, {elapsed / messages * 1e9:.0f} ns/message")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,250 @@
+"""Time the XP and starboard hot paths against servers of growing size.
+
+Run from the repository root:
+
+    python benchmarks/bench_hot_paths.py [sizes] [--backend json|sqlite] [--budget seconds]
+
+`sizes` is a comma separated list of user counts (default
+1000,10000,100000,1000000). For every size a server with that many users
+(random XP) and a starboard with a tenth as many entries is loaded into a
+fresh storage directory, then each case runs for up to `--budget` seconds
+(default 1). Cases that do not depend on the number of users run once.
+
+Everything goes through the real functions in main.py with the stand-ins
+from benchmarks/fakes.py, so no network is used. For each case the script
+prints ops/s, p50 and p99 latency, and the peak memory allocated while
+running it (measured in a separate, shorter pass under tracemalloc so the
+timings are not slowed down).
+"""
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from fakes import FakeChannel, FakeGuild, FakeInteraction, FakeMessage
+
+GUILD_ID = 1
+STARBOARD_CHANNEL_ID = 2
+TEXT_CHANNEL_ID = 3
+MAX_OPS = 100_000
+MEMORY_OPS = 1000
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+async def measure(op, budget, max_ops=MAX_OPS):
+    """Run `op(i)` until `budget` seconds or `max_ops` calls; return latencies in ns"""
+    latencies = []
+    deadline = time.perf_counter() + budget
+    i = 0
+    while i < max_ops and (i < 5 or time.perf_counter() < deadline):
+        start = time.perf_counter_ns()
+        result = op(i)
+        if asyncio.iscoroutine(result):
+            await result
+        latencies.append(time.perf_counter_ns() - start)
+        i += 1
+    return latencies
+
+
+async def peak_memory(op, ops):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline, _ = tracemalloc.get_traced_memory()
+    for i in range(ops):
+        result = op(i)
+        if asyncio.iscoroutine(result):
+            await result
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - baseline
+
+
+async def run_case(name, users, op, budget, reset=None, quiet=False):
+    """Time `op` and print a row of results; `quiet` hides what `op` prints"""
+    with open(os.devnull, "w") if quiet else contextlib.nullcontext(sys.stdout) as output:
+        with contextlib.redirect_stdout(output):
+            latencies = await measure(op, budget)
+            if reset is not None:
+                reset()
+            peak = await peak_memory(op, min(len(latencies), MEMORY_OPS))
+            if reset is not None:
+                reset()
+
+    total = sum(latencies)
+    latencies.sort()
+    print(
+        f"{name:<32} {users:>10} {len(latencies) / (total / 1e9):>12,.0f} "
+        f"{percentile(latencies, 0.5) / 1000:>10.1f} {percentile(latencies, 0.99) / 1000:>10.1f} "
+        f"{peak / 1024:>10.1f}"
+    )
+
+
+def populate(users):
+    """Give GUILD_ID `users` users with random XP and a starboard of a tenth as many posts"""
+    rng = random.Random(users)
+    entries = {}
+    for user_id in range(1, users + 1):
+        xp = rng.randint(0, 500_000)
+        entries[str(user_id)] = {"xp": xp, "level": main.calculate_level(xp), "username": f"user{user_id}"}
+
+    guild = main.xp_store.partition(str(GUILD_ID))
+    if guild.lazy:
+        main.storage_backend.save_guild(str(GUILD_ID), entries)
+    else:
+        for user_id, entry in entries.items():
+            guild.insert(user_id, entry)
+        main.xp_store.flush()
+
+    main.storage_backend.save_starboard_many({
+        str(message_id): {"starboard_msg_id": str(message_id), "stars": 3, "author": "1", "channel": str(TEXT_CHANNEL_ID)}
+        for message_id in range(1, users // 10 + 1)
+    })
+
+
+async def bench_fixed(budget):
+    """Cases that do not depend on the number of users"""
+    guild = FakeGuild(GUILD_ID)
+    channel = guild.add_channel(TEXT_CHANNEL_ID)
+    author = guild.add_member(1)
+    messages = [FakeMessage("x" * length, author, channel, guild) for length in range(0, 2000, 7)]
+    await run_case("calculate_message_xp", "-", lambda i: main.calculate_message_xp(messages[i % len(messages)]), budget)
+
+    top = int(main.xp_for_level(main.MAX_LEVEL + 1) * 1.1)
+    samples = [random.randint(0, top) for _ in range(10_000)]
+    await run_case("calculate_level", "-", lambda i: main.calculate_level(samples[i % len(samples)]), budget)
+
+    config = main.edit_guild_config(GUILD_ID)
+    config.level_roles = {level: 1000 + level for level in range(5, 101, 5)}
+    config.rebuild()
+    for role_id in config.level_roles.values():
+        guild.add_role(role_id)
+    member = guild.add_member(2)
+    # quiet keeps the "Set level role" log lines out of the results
+    await run_case(
+        "update_level_roles (no change)", "-",
+        lambda i: main.update_level_roles(guild, member, 50), budget, quiet=True
+    )
+    await run_case(
+        "update_level_roles (new role)", "-",
+        lambda i: main.update_level_roles(guild, member, 5 + (i % 2) * 50), budget, quiet=True
+    )
+
+
+async def bench_size(users, budget):
+    guild = FakeGuild(GUILD_ID)
+    channel = guild.add_channel(TEXT_CHANNEL_ID)
+    starboard_channel = FakeChannel(STARBOARD_CHANNEL_ID, guild)
+    main.bot.get_channel = lambda channel_id: starboard_channel if channel_id == STARBOARD_CHANNEL_ID else channel
+    main.edit_guild_config(GUILD_ID).starboard.update(enabled=True, channel_id=STARBOARD_CHANNEL_ID, threshold=3)
+
+    start = time.perf_counter()
+    tracemalloc.start()
+    populate(users)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'(load ' + format(users, ',') + ' users)':<32} {users:>10} {'':>12} {'':>10} {'':>10} {peak / 1024:>10.1f}"
+          f"  {time.perf_counter() - start:.1f}s")
+
+    rng = random.Random(0)
+    members = [guild.add_member(rng.randint(1, users)) for _ in range(10_000)]
+    messages = [FakeMessage("hello " * rng.randint(1, 50), member, channel, guild) for member in members]
+
+    def drain():
+        while not main.xp_queue.empty():
+            main.apply_xp_batch(main.take_xp_batch(main.XP_BATCH_SIZE))
+
+    def process(i):
+        main.process_xp(messages[i % len(messages)])
+        if main.xp_queue.qsize() >= main.XP_QUEUE_SIZE - 1:
+            drain()
+
+    main.user_cooldowns = main.CooldownTracker(0)
+    await run_case("process_xp", users, process, budget, reset=drain)
+
+    def apply_batch(i):
+        batch = [
+            (guild, member, channel, 100, 0.0)
+            for member in rng.sample(members, main.XP_BATCH_SIZE)
+        ]
+        main.apply_xp_batch(batch)
+
+    await run_case(f"apply_xp_batch ({main.XP_BATCH_SIZE} messages)", users, apply_batch, budget)
+
+    admin = guild.add_member(users + 1, administrator=True)
+
+    async def leaderboard_cold(i):
+        main.leaderboard_cache.clear()
+        await main.leaderboard.callback(FakeInteraction(admin, guild, channel), 1 + i % main.LEADERBOARD_MAX_PAGES)
+
+    async def leaderboard_cached(i):
+        await main.leaderboard.callback(FakeInteraction(admin, guild, channel), 1 + i % main.LEADERBOARD_MAX_PAGES)
+
+    async def rank(i):
+        await main.rank.callback(FakeInteraction(admin, guild, channel), members[i % len(members)])
+
+    await run_case("leaderboard (cold)", users, leaderboard_cold, budget)
+    await run_case("leaderboard (cached)", users, leaderboard_cached, budget)
+    await run_case("rank", users, rank, budget)
+
+    # Existing posts: the new count is only recorded and edited in after the debounce
+    main.STARBOARD_EDIT_DEBOUNCE = 3600
+    starboard_messages = users // 10
+
+    def reset_edits():
+        for task in list(main.starboard_edit_tasks):
+            task.cancel()
+        main.pending_starboard_edits.clear()
+
+    await run_case(
+        "add_to_starboard (update)", users,
+        lambda i: main.add_to_starboard(FakeMessage(guild=guild, message_id=1 + i % starboard_messages), 4 + i),
+        budget, reset=reset_edits
+    )
+    reset_edits()
+
+    await run_case(
+        "add_to_starboard (new post)", users,
+        lambda i: main.add_to_starboard(FakeMessage("starred", admin, channel, guild), 3),
+        budget
+    )
+
+
+async def run(sizes, budget):
+    print(f"{'case':<32} {'users':>10} {'ops/s':>12} {'p50 us':>10} {'p99 us':>10} {'peak KiB':>10}")
+    await bench_fixed(budget)
+    original_directory = os.getcwd()
+    for users in sizes:
+        with tempfile.TemporaryDirectory(prefix="kitan-bench-") as directory:
+            os.chdir(directory)
+            main.leaderboard_cache.clear()
+            main.open_storage()
+            try:
+                await bench_size(users, budget)
+            finally:
+                main.storage_backend.close()
+                os.chdir(original_directory)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the XP and starboard hot paths")
+    parser.add_argument("sizes", nargs="?", default="1000,10000,100000,1000000")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--budget", type=float, default=1.0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    main.STORAGE_BACKEND = args.backend
+    asyncio.run(run([int(size) for size in args.sizes.split(",")], args.budget))
@@ -0,0 +1,50 @@
+"""Time the level threshold table used by calculate_level.
+
+Run from the repository root:
+
+    python benchmarks/bench_levels.py
+
+The script reports the per-call cost of calculate_level and of the original
+binary search over advanced_xp_for_level. tests/test_levels.py checks that
+both return the same levels.
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+
+
+def reference_calculate_level(xp):
+    """calculate_level as it was before the threshold table, also used by tests/test_levels.py"""
+    if xp <= 0:
+        return 1
+
+    low, high = 1, main.MAX_LEVEL
+    while low <= high:
+        mid = (low + high) // 2
+        if main.advanced_xp_for_level(mid) <= xp < main.advanced_xp_for_level(mid + 1):
+            return mid
+        elif main.advanced_xp_for_level(mid) > xp:
+            high = mid - 1
+        else:
+            low = mid + 1
+
+    return min(low, main.MAX_LEVEL)
+
+
+def run():
+    top = main.advanced_xp_for_level(main.MAX_LEVEL + 1)
+    samples = [random.randint(0, int(top * 1.1)) for _ in range(10000)]
+    runs = 20
+
+    for name, func in (("reference", reference_calculate_level), ("table", main.calculate_level)):
+        seconds = min(timeit.repeat(lambda: [func(xp) for xp in samples], number=1, repeat=runs))
+        print(f"{name:>10}: {seconds / len(samples) * 1e9:8.1f} ns/call")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,176 @@
+"""Compare startup time and memory with the default member cache and LOW_MEMORY_MEMBERS.
+
+Run from the repository root:
+
+    python benchmarks/bench_member_cache.py [sizes] [--messages n]
+
+`sizes` is a comma separated list of member counts of one server (default
+10000,100000,500000). For every size discord.py's connection state is fed
+the server's GUILD_CREATE event, then in the default mode every member the
+way startup chunking delivers them (GUILD_MEMBERS_CHUNK events of 1000
+members, decoded from JSON like gateway messages). In low-memory mode no
+members are requested, and the fetched-member cache is filled to
+MEMBER_CACHE_SIZE as role updates would. Then `--messages` messages
+(default 20000) from a twentieth of the members are parsed.
+
+The script prints how long the bot spends processing events until the
+server is ready (Discord streaming the chunks comes on top of that), the
+memory held once ready and after the messages, and the peak, measured with
+tracemalloc in a separate pass.
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import discord
+from discord.state import ChunkRequest
+
+import main
+from fake_discord import FakeDiscord, member_payload, message_payload, now_iso, user_payload
+
+GUILD_ID = "200000000000000001"
+CHANNEL_ID = "200000000000000002"
+ROLE_IDS = ("200000000000000003", "200000000000000004")
+CHUNK_SIZE = 1000
+NONCE = "bench"
+
+
+def user_id(index):
+    return str(300000000000000000 + index)
+
+
+def build_events(members, messages):
+    """Return the GUILD_CREATE payload, the member chunks and the messages as gateway JSON"""
+    guild_create = {
+        "id": GUILD_ID, "name": "Bench", "icon": None, "owner_id": "1", "member_count": members,
+        "large": True, "unavailable": False, "joined_at": now_iso(), "features": [], "emojis": [],
+        "stickers": [], "threads": [], "presences": [], "voice_states": [], "stage_instances": [],
+        "guild_scheduled_events": [], "soundboard_sounds": [],
+        "roles": [
+            {"id": role_id, "name": role_id, "permissions": "0", "position": 0, "color": 0,
+             "hoist": False, "managed": False, "mentionable": False, "flags": 0}
+            for role_id in (GUILD_ID,) + ROLE_IDS
+        ],
+        "channels": [{"id": CHANNEL_ID, "type": 0, "name": "general", "position": 0, "permission_overwrites": []}],
+        # Large servers only come with the bot's own member
+        "members": [member_payload(FakeDiscord.BOT_USER_ID, name="Kitan")]
+    }
+
+    chunk_count = -(-members // CHUNK_SIZE)
+    chunks = [
+        json.dumps({
+            "guild_id": GUILD_ID, "chunk_index": index, "chunk_count": chunk_count, "nonce": NONCE,
+            "members": [
+                member_payload(user_id(i), roles=ROLE_IDS[:i % 3])
+                for i in range(index * CHUNK_SIZE, min(members, (index + 1) * CHUNK_SIZE))
+            ]
+        })
+        for index in range(chunk_count)
+    ]
+
+    rng = random.Random(members)
+    active = max(1, members // 20)
+    message_events = []
+    for i in range(messages):
+        author = user_id(rng.randrange(active))
+        data = message_payload(400000000000000000 + i, CHANNEL_ID, user_payload(author), "hello", guild_id=GUILD_ID)
+        data["member"] = member_payload(author, roles=ROLE_IDS[:1])
+        del data["member"]["user"]
+        message_events.append(json.dumps(data))
+    return guild_create, chunks, message_events
+
+
+def start(low_memory, guild_create, chunks):
+    """Bring the server up the way the bot would in each mode and return the connection state"""
+    options = {"chunk_guilds_at_startup": False}
+    if low_memory:
+        options["member_cache_flags"] = discord.MemberCacheFlags.none()
+    client = discord.Client(intents=main.intents, **options)
+    state = client._connection
+    state.user = discord.ClientUser(state=state, data=user_payload(FakeDiscord.BOT_USER_ID, "Kitan", bot=True))
+    state.parse_guild_create(guild_create)
+    guild = state._get_guild(int(GUILD_ID))
+
+    if low_memory:
+        for i in range(min(main.MEMBER_CACHE_SIZE, guild_create["member_count"])):
+            main.cache_fetched_member(discord.Member(data=member_payload(user_id(i)), guild=guild, state=state))
+        return state
+
+    # What guild.chunk() sets up before the chunks arrive
+    request = ChunkRequest(guild.id, 0, None, state._get_guild, cache=True)
+    request.nonce = NONCE
+    state._chunk_requests[NONCE] = request
+    for chunk in chunks:
+        state.parse_guild_members_chunk(json.loads(chunk))
+    return state
+
+
+def receive(state, message_events):
+    for raw in message_events:
+        state.parse_message_create(json.loads(raw))
+
+
+def bench_mode(low_memory, events):
+    guild_create, chunks, message_events = events
+
+    main.fetched_members.clear()
+    gc.collect()
+    started = time.perf_counter()
+    state = start(low_memory, guild_create, chunks)
+    ready_time = time.perf_counter() - started
+    started = time.perf_counter()
+    receive(state, message_events)
+    message_time = (time.perf_counter() - started) / len(message_events)
+    members = len(state._get_guild(int(GUILD_ID)).members)
+    del state
+
+    main.fetched_members.clear()
+    gc.collect()
+    tracemalloc.start()
+    state = start(low_memory, guild_create, chunks)
+    gc.collect()
+    ready_held, _ = tracemalloc.get_traced_memory()
+    receive(state, message_events)
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del state
+    main.fetched_members.clear()
+
+    print(
+        f"{'low-memory' if low_memory else 'default':<11} {guild_create['member_count']:>9} {members:>9} "
+        f"{len(chunks) if not low_memory else 0:>7} {ready_time:>9.2f} {ready_held / 2 ** 20:>10.1f} "
+        f"{held / 2 ** 20:>10.1f} {peak / 2 ** 20:>10.1f} {message_time * 1e6:>7.1f}"
+    )
+
+
+def run(sizes, messages):
+    print(
+        f"{'mode':<11} {'members':>9} {'cached':>9} {'chunks':>7} {'ready s':>9} {'ready MiB':>10} "
+        f"{'held MiB':>10} {'peak MiB':>10} {'msg µs':>7}"
+    )
+    for members in sizes:
+        events = build_events(members, messages)
+        for low_memory in (False, True):
+            bench_mode(low_memory, events)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare member caching modes")
+    parser.add_argument("sizes", nargs="?", default="10000,100000,500000")
+    parser.add_argument("--messages", type=int, default=20_000)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run([int(size) for size in args.sizes.split(",")], args.messages)
@@ -0,0 +1,82 @@
+"""Compare the memory of a guild's XP held as dicts and as GuildXP columns.
+
+Run from the repository root:
+
+    python benchmarks/bench_memory.py [sizes]
+
+`sizes` is a comma separated list of user counts (default
+10000,100000,1000000). For every size the same users are loaded the way the
+JSON backend returns them, then kept either as the dict layout the store used
+before (a dict of {"xp", "level", "username"} dicts plus a SortedList of
+(-xp, user_id) tuples) or as a GuildXP. The script prints the memory each
+layout holds once loaded, per user, and the peak while loading, measured with
+tracemalloc.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sortedcontainers import SortedList
+
+from storage import GuildXP
+
+
+def load_users(users):
+    """Return `users` entries shaped like a loaded guild file"""
+    rng = random.Random(users)
+    return {
+        str(10 ** 17 + user_id): {"xp": xp, "level": 1 + xp // 1000, "username": f"user{user_id}"}
+        for user_id, xp in ((user_id, rng.randint(0, 500_000)) for user_id in range(users))
+    }
+
+
+def dict_layout(users):
+    data = load_users(users)
+    ranking = SortedList((-entry["xp"], user_id) for user_id, entry in data.items())
+    return data, ranking
+
+
+def column_layout(users):
+    return GuildXP("1", load_users(users), lazy=False)
+
+
+def measure(build, users):
+    """Return (held bytes, peak bytes, seconds) of building a layout"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    layout = build(users)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    held, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del layout
+    return held, peak, elapsed
+
+
+def run(sizes):
+    print(f"{'layout':<10} {'users':>10} {'held MiB':>10} {'B/user':>8} {'peak MiB':>10} {'load s':>8}")
+    for users in sizes:
+        for name, build in (("dict", dict_layout), ("columns", column_layout)):
+            held, peak, elapsed = measure(build, users)
+            print(
+                f"{name:<10} {users:>10} {held / 2 ** 20:>10.1f} {held / users:>8.0f} "
+                f"{peak / 2 ** 20:>10.1f} {elapsed:>8.2f}"
+            )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare XP memory layouts")
+    parser.add_argument("sizes", nargs="?", default="10000,100000,1000000")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run([int(size) for size in args.sizes.split(",")])
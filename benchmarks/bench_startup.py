@@ -0,0 +1,108 @@
+"""Time loading a large server's XP from JSON and binary snapshots.
+
+Run from the repository root:
+
+    python benchmarks/bench_startup.py [sizes] [--repeat n]
+
+`sizes` is a comma separated list of user counts (default
+10000,100000,1000000). For every size one server is written in both
+snapshot formats, then loaded the way the bot does on the server's first
+activity (the backend reads the file and XPStore builds the partition,
+including its ranking). The script prints the file size, the best load time
+of `--repeat` runs (default 3), the time of a /rank lookup straight after,
+the peak memory while loading (measured in a separate pass under
+tracemalloc), and how long a single user lookup in the mapped binary file
+takes without loading the partition.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JSONBackend, XPSnapshot, XPStore
+
+GUILD_ID = "1"
+
+
+def make_entries(users):
+    rng = random.Random(users)
+    entries = {}
+    for user_id in range(users):
+        xp = rng.randint(0, 500_000)
+        entries[str(10 ** 17 + user_id)] = {"xp": xp, "level": 1 + xp // 1000, "username": f"user{user_id}"}
+    return entries
+
+
+def load(backend):
+    store = XPStore(backend)
+    store.partition(GUILD_ID)
+    return store
+
+
+def bench_format(directory, snapshot_format, entries, repeat):
+    backend = JSONBackend(directory, os.path.join(directory, "starboard.json"), snapshot_format=snapshot_format)
+    backend.save_guild(GUILD_ID, entries, seq=1)
+    size = os.path.getsize(backend.guild_path(GUILD_ID))
+
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        store = load(backend)
+        times.append(time.perf_counter() - start)
+
+    user_id = random.Random(0).choice(list(entries))
+    start = time.perf_counter()
+    store.guilds[GUILD_ID].position(user_id)
+    rank_time = time.perf_counter() - start
+    del store
+
+    gc.collect()
+    tracemalloc.start()
+    store = load(backend)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del store
+    print(
+        f"{snapshot_format:<8} {len(entries):>10} {size / 2 ** 20:>10.1f} {min(times):>10.3f} "
+        f"{rank_time * 1000:>10.2f} {peak / 2 ** 20:>10.1f}"
+    )
+    return backend.guild_path(GUILD_ID), user_id
+
+
+def bench_lookup(path, user_id):
+    start = time.perf_counter()
+    snapshot = XPSnapshot(path)
+    entry = snapshot.get(user_id)
+    elapsed = time.perf_counter() - start
+    snapshot.close()
+    assert entry is not None
+    print(f"{'':<8} {'':>10} binary open and look up one user without loading: {elapsed * 1000:.2f} ms")
+
+
+def run(sizes, repeat):
+    print(f"{'format':<8} {'users':>10} {'file MiB':>10} {'load s':>10} {'rank ms':>10} {'peak MiB':>10}")
+    for users in sizes:
+        entries = make_entries(users)
+        with tempfile.TemporaryDirectory(prefix="kitan-bench-") as directory:
+            bench_format(directory, "json", entries, repeat)
+            path, user_id = bench_format(directory, "binary", entries, repeat)
+            bench_lookup(path, user_id)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Compare XP snapshot load times")
+    parser.add_argument("sizes", nargs="?", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    run([int(size) for size in args.sizes.split(",")], args.repeat)
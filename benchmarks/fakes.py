@@ -0,0 +1,168 @@
+"""Offline stand-ins for the discord.py objects the bot handles.
+
+They carry just the attributes and coroutines main.py uses, and never touch
+the network, so handlers can be driven from benchmarks and tools.
+"""
+import datetime
+import itertools
+
+_ids = itertools.count(10 ** 17)
+
+
+def next_id():
+    return next(_ids)
+
+
+class FakeAsset:
+    url = "https://cdn.discordapp.com/embed/avatars/0.png"
+
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+
+
+class FakeRole:
+    def __init__(self, role_id, name=None):
+        self.id = role_id
+        self.name = name or f"role-{role_id}"
+        self.mention = f"<@&{role_id}>"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMember:
+    def __init__(self, member_id, guild, name=None, bot=False, administrator=False):
+        self.id = member_id
+        self.guild = guild
+        self.name = name or f"user{member_id}"
+        self.display_name = self.name
+        self.mention = f"<@{member_id}>"
+        self.bot = bot
+        self.display_avatar = FakeAsset()
+        self.guild_permissions = FakePermissions(administrator)
+        self.roles = [guild.default_role] if guild is not None else []
+        self.edits = 0
+
+    async def edit(self, roles=None, **kwargs):
+        self.edits += 1
+        if roles is not None:
+            self.roles = [self.guild.default_role] + list(roles)
+        return self
+
+
+class FakeMessage:
+    def __init__(self, content="", author=None, channel=None, guild=None, embeds=None, message_id=None):
+        self.id = message_id or next_id()
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = guild
+        self.embeds = embeds or []
+        self.attachments = []
+        self.reactions = []
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        guild_id = guild.id if guild is not None else "@me"
+        channel_id = channel.id if channel is not None else 0
+        self.jump_url = f"https://discord.com/channels/{guild_id}/{channel_id}/{self.id}"
+
+    async def edit(self, embed=None, **kwargs):
+        if embed is not None:
+            self.embeds = [embed]
+        return self
+
+
+class FakeChannel:
+    def __init__(self, channel_id, guild=None, name=None):
+        self.id = channel_id
+        self.guild = guild
+        self.name = name or f"channel-{channel_id}"
+        self.mention = f"<#{channel_id}>"
+        self.messages = {}
+        self.sent = 0
+
+    async def send(self, content=None, embed=None, **kwargs):
+        self.sent += 1
+        message = FakeMessage(content or "", channel=self, guild=self.guild, embeds=[embed] if embed else [])
+        self.messages[message.id] = message
+        return message
+
+    async def fetch_message(self, message_id):
+        return self.messages[message_id]
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name=None):
+        self.id = guild_id
+        self.name = name or f"guild-{guild_id}"
+        self.default_role = FakeRole(guild_id, "@everyone")
+        self.roles = {}
+        self.members = {}
+        self.channels = {}
+
+    def add_role(self, role_id, name=None):
+        role = self.roles[role_id] = FakeRole(role_id, name)
+        return role
+
+    def add_member(self, member_id, **kwargs):
+        member = self.members[member_id] = FakeMember(member_id, self, **kwargs)
+        return member
+
+    def add_channel(self, channel_id, name=None):
+        channel = self.channels[channel_id] = FakeChannel(channel_id, self, name)
+        return channel
+
+    def get_role(self, role_id):
+        return self.roles.get(role_id)
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+    async def fetch_member(self, member_id):
+        return self.members[member_id]
+
+
+class FakeResponse:
+    def __init__(self):
+        self.messages = []
+        self.done = False
+
+    async def send_message(self, content=None, **kwargs):
+        self.messages.append(kwargs)
+        self.done = True
+
+    async def defer(self, **kwargs):
+        self.done = True
+
+    async def edit_message(self, **kwargs):
+        self.messages.append(kwargs)
+        self.done = True
+
+    def is_done(self):
+        return self.done
+
+
+class FakeFollowup:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append(kwargs)
+
+
+class FakeInteraction:
+    def __init__(self, user, guild, channel=None):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id if guild is not None else None
+        self.channel = channel
+        self.channel_id = channel.id if channel is not None else None
+        self.response = FakeResponse()
+        self.followup = FakeFollowup()
@@ -0,0 +1,284 @@
+"""Run the bot as several worker processes, each connected with a range of its shards.
+
+Run from the repository root instead of main.py:
+
+    python cluster.py [--workers n] [--shards n] [--sync-commands]
+
+The shard count is SHARD_COUNT from main.py, or the number Discord
+recommends. Shards are split into contiguous ranges, one per worker (default
+CLUSTER_WORKERS), and each worker is a normal main.py process running an
+AutoShardedBot with its range. Every server belongs to exactly one shard, so
+workers keep to their own servers' XP, and share the config, starboard and
+resync files under a file lock.
+
+Before starting the workers, XP journals left by earlier runs are applied,
+so the servers can move to other workers safely. Workers are started a few
+seconds apart so their shards do not all identify at once, restarted with
+a growing delay when they exit, and restarted when their health report in
+CLUSTER_DIR goes stale. A summary of every worker's shards is printed every
+CLUSTER_HEALTH_INTERVAL seconds. Ctrl+C stops the workers, letting them
+save first.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import discord
+from dotenv import load_dotenv
+
+import main
+from storage import load_json, open_backend
+
+IDENTIFY_INTERVAL = 5.5  # Seconds between shard logins Discord allows per concurrency bucket
+START_GRACE = 60  # Seconds a worker has to report once its shards have had time to log in
+STOP_TIMEOUT = 60  # Seconds a worker gets to save and exit before it is killed
+RESTART_BACKOFF_MAX = 300  # Longest wait in seconds before restarting a worker that keeps exiting
+STABLE_RUNTIME = 600  # Seconds a worker must run before its restart delay starts over
+
+
+async def fetch_gateway_info(token):
+    """Return the shard count Discord recommends and how many shards can log in at once"""
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(token)
+        shards, _, session_start_limit = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shards, session_start_limit["max_concurrency"]
+
+
+def split_shards(shard_count, workers):
+    """Split the shard IDs into `workers` contiguous ranges of nearly equal size"""
+    size, extra = divmod(shard_count, workers)
+    ranges = []
+    start = 0
+    for worker_id in range(workers):
+        end = start + size + (worker_id < extra)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def prepare_storage():
+    """Apply the journals of earlier runs, failing if XP is still waiting to be migrated.
+
+    Returns False when the bot has to run once on its own first.
+    """
+    backend = open_backend(
+        main.STORAGE_BACKEND, main.XP_DIR, main.STARBOARD_FILE, main.DATABASE_FILE,
+        xp_path=main.XP_FILE, snapshot_format=main.SNAPSHOT_FORMAT
+    )
+    try:
+        # Migrating needs every server's members, which no single worker has
+        if backend.load_legacy_xp() is not None:
+            return False
+        journaled = backend.journaled
+    finally:
+        backend.close()
+    if journaled:
+        main.compact_journals([None] + main.cluster_worker_ids())
+    return True
+
+
+class Worker:
+    """One main.py process and the shards it runs"""
+
+    def __init__(self, worker_id, shard_ids, shard_count, args):
+        self.worker_id = worker_id
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.args = args
+        self.process = None
+        self.started = 0.0
+        self.started_at = 0.0
+        self.next_start = 0.0
+        self.backoff = 1
+        self.restarts = 0
+        self.stop_requested = None
+
+    @property
+    def health_path(self):
+        return os.path.join(main.CLUSTER_DIR, f"worker-{self.worker_id}.json")
+
+    @property
+    def shard_range(self):
+        if len(self.shard_ids) == 1:
+            return str(self.shard_ids[0])
+        return f"{self.shard_ids[0]}-{self.shard_ids[-1]}"
+
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        env = dict(
+            os.environ,
+            KITAN_CLUSTER_ID=str(self.worker_id),
+            KITAN_SHARD_IDS=",".join(str(shard_id) for shard_id in self.shard_ids),
+            KITAN_SHARD_COUNT=str(self.shard_count)
+        )
+        # A session of its own keeps Ctrl+C in the terminal from reaching the
+        # worker directly; the supervisor forwards it once
+        self.process = subprocess.Popen(
+            [sys.executable, main.__file__] + self.args, env=env, start_new_session=True
+        )
+        self.started = time.monotonic()
+        self.started_at = time.time()
+        self.stop_requested = None
+        print(f"Started worker {self.worker_id} (pid {self.process.pid}) with shards {self.shard_range}")
+
+    def stop(self):
+        """Ask the worker to save and exit; check_stop kills it if it takes too long"""
+        if self.running() and self.stop_requested is None:
+            self.process.send_signal(signal.SIGINT)
+            self.stop_requested = time.monotonic()
+
+    def check_stop(self):
+        if self.stop_requested is not None and self.running():
+            if time.monotonic() - self.stop_requested >= STOP_TIMEOUT:
+                print(f"Worker {self.worker_id} did not stop within {STOP_TIMEOUT}s, killing it")
+                self.process.kill()
+
+    def report(self):
+        """Return the worker's last health report since it was started, or None"""
+        report = load_json(self.health_path)
+        if report.get("pid") != self.process.pid or report.get("time", 0) < self.started_at:
+            return None
+        return report
+
+    def stale(self, max_concurrency):
+        """Whether the worker has stopped reporting after having had time to log in"""
+        if self.stop_requested is not None:
+            return False
+        login_time = len(self.shard_ids) * IDENTIFY_INTERVAL / max_concurrency
+        if time.monotonic() - self.started < START_GRACE + login_time:
+            return False
+        report = self.report()
+        return report is None or time.time() - report["time"] > 3 * main.CLUSTER_HEALTH_INTERVAL
+
+    def supervise(self, max_concurrency):
+        """Restart the worker when it has exited or stopped reporting"""
+        if self.process is None:
+            if time.monotonic() >= self.next_start:
+                self.start()
+            return
+
+        code = self.process.poll()
+        if code is None:
+            self.check_stop()
+            if self.stale(max_concurrency):
+                print(f"Worker {self.worker_id} stopped reporting its health, restarting it")
+                self.stop()
+            return
+
+        runtime = time.monotonic() - self.started
+        if runtime >= STABLE_RUNTIME:
+            self.backoff = 1
+        print(f"Worker {self.worker_id} exited with code {code} after {runtime:.0f}s, restarting in {self.backoff}s")
+        self.process = None
+        self.restarts += 1
+        self.next_start = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, RESTART_BACKOFF_MAX)
+
+    def summary(self):
+        if not self.running():
+            return f"worker {self.worker_id}: not running, shards {self.shard_range}, {self.restarts} restart(s)"
+        report = self.report()
+        if report is None:
+            return f"worker {self.worker_id}: starting (pid {self.process.pid}), shards {self.shard_range}"
+
+        shards = report["shards"]
+        latencies = [shard["latency"] for shard in shards.values() if shard["latency"] is not None]
+        down = [shard_id for shard_id, shard in shards.items() if shard["closed"] or shard["latency"] is None]
+        limited = [shard_id for shard_id, shard in shards.items() if shard["rate_limited"]]
+        line = (
+            f"worker {self.worker_id}: pid {self.process.pid}, shards {self.shard_range}, "
+            f"{report['guilds']} servers, {len(shards) - len(down)}/{len(self.shard_ids)} shards up"
+        )
+        if latencies:
+            line += f", latency {sum(latencies) / len(latencies) * 1000:.0f}ms avg {max(latencies) * 1000:.0f}ms max"
+        if down:
+            line += f", down: {', '.join(down)}"
+        if limited:
+            line += f", rate limited: {', '.join(limited)}"
+        if self.restarts:
+            line += f", {self.restarts} restart(s)"
+        return line
+
+
+def run(workers, max_concurrency):
+    stopping = False
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    # Stagger the first starts so each worker's shards log in after the previous ones
+    delay = 0.0
+    for worker in workers:
+        worker.next_start = time.monotonic() + delay
+        delay += len(worker.shard_ids) * IDENTIFY_INTERVAL / max_concurrency
+
+    last_summary = time.monotonic()
+    while not stopping:
+        for worker in workers:
+            worker.supervise(max_concurrency)
+        if time.monotonic() - last_summary >= main.CLUSTER_HEALTH_INTERVAL:
+            last_summary = time.monotonic()
+            for worker in workers:
+                print(worker.summary())
+        time.sleep(1)
+
+    print("Stopping workers")
+    for worker in workers:
+        worker.stop()
+    while any(worker.running() for worker in workers):
+        for worker in workers:
+            worker.check_stop()
+        time.sleep(0.5)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the bot's shards across several worker processes")
+    parser.add_argument("--workers", type=int, default=main.CLUSTER_WORKERS)
+    parser.add_argument("--shards", type=int, default=main.SHARD_COUNT, help="Default: Discord's recommendation")
+    parser.add_argument("--sync-commands", action="store_true", help="Sync slash commands even if unchanged")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if os.name != "posix":
+        sys.exit("Cluster mode needs file locks and signals only available on Linux and macOS")
+    load_dotenv()
+    token = os.getenv("DISCORD_TOKEN")
+    if not token:
+        raise RuntimeError("DISCORD_TOKEN not set in environment or .env file")
+
+    recommended, max_concurrency = asyncio.run(fetch_gateway_info(token))
+    shard_count = args.shards or recommended
+    print(f"Running {shard_count} shard(s) across {min(args.workers, shard_count)} worker(s)")
+
+    # Moves settings from older layouts before workers start merging their changes into the file
+    main.load_config()
+    main.save_config()
+    if not prepare_storage():
+        sys.exit(f"Run main.py on its own once to migrate {main.XP_FILE} before starting a cluster")
+
+    os.makedirs(main.CLUSTER_DIR, exist_ok=True)
+    for name in os.listdir(main.CLUSTER_DIR):
+        if name.startswith("worker-"):
+            os.remove(os.path.join(main.CLUSTER_DIR, name))
+
+    worker_args = ["--sync-commands"] if args.sync_commands else []
+    workers = [
+        Worker(worker_id, shard_ids, shard_count, worker_args)
+        for worker_id, shard_ids in enumerate(split_shards(shard_count, min(args.workers, shard_count)))
+    ]
+    run(workers, max_concurrency)
@@ -0,0 +1,70 @@
+import copy
+from bisect import bisect_right
+
+
+class GuildConfig:
+    """The settings of one server, with what the hot paths look up precomputed.
+
+    `starboard`, `level_roles` (level: role ID), `role_names` (role ID:
+    name), `ignored_channels` (a list of channel IDs) and `level_up` are the
+    settings as bot_config.json stores them. `rebuild` must be called after
+    changing them; it refreshes `ignored` (a frozenset of the ignored
+    channels), `role_tiers` (level roles sorted by level), `tier_levels`
+    and `level_role_ids`, so messages and level-ups never sort or scan
+    anything.
+    """
+
+    def __init__(self, starboard, level_roles, role_names, ignored_channels, level_up):
+        self.starboard = starboard
+        self.level_roles = level_roles
+        self.role_names = role_names
+        self.ignored_channels = ignored_channels
+        self.level_up = level_up
+        self.rebuild()
+
+    def rebuild(self):
+        self.ignored = frozenset(self.ignored_channels)
+        self.role_tiers = sorted(self.level_roles.items())
+        self.tier_levels = [level for level, _ in self.role_tiers]
+        self.level_role_ids = frozenset(self.level_roles.values())
+
+    def role_for_level(self, level):
+        """Return the ID of the level role for `level`, or None below the first one"""
+        index = bisect_right(self.tier_levels, level) - 1
+        return self.role_tiers[index][1] if index >= 0 else None
+
+    def copy(self):
+        return GuildConfig(
+            copy.deepcopy(self.starboard),
+            dict(self.level_roles),
+            dict(self.role_names),
+            list(self.ignored_channels),
+            dict(self.level_up)
+        )
+
+    @classmethod
+    def from_json(cls, data, defaults):
+        """Build a config from its bot_config.json form, taking missing settings from `defaults`"""
+        config = defaults.copy()
+        if "starboard" in data:
+            config.starboard = {**config.starboard, **data["starboard"]}
+            config.starboard["channel_id"] = int(config.starboard["channel_id"])
+        if "level_roles" in data:
+            config.level_roles = {int(k): int(v) for k, v in data["level_roles"].items()}
+        if "role_names" in data:
+            config.role_names = {int(k): v for k, v in data["role_names"].items()}
+        if "ignored_channels" in data:
+            config.ignored_channels = [int(channel_id) for channel_id in data["ignored_channels"]]
+        if "level_up" in data:
+            config.level_up = {"enabled": data["level_up"]["enabled"], "channel_id": int(data["level_up"]["channel_id"])}
+        config.rebuild()
+        return config
+
+    def to_json(self):
+        return {
+            "starboard": self.starboard,
+            "level_roles": {str(k): str(v) for k, v in self.level_roles.items()},
+            "role_names": {str(k): v for k, v in self.role_names.items()},
+            "ignored_channels": [str(channel_id) for channel_id in self.ignored_channels],
+            "level_up": {"enabled": self.level_up["enabled"], "channel_id": str(self.level_up["channel_id"])}
+        }
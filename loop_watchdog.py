@@ -0,0 +1,231 @@
+import asyncio
+import functools
+import inspect
+import sys
+import threading
+import time
+import traceback
+import types
+
+
+class HandlerCall:
+    """Timing of one running call of a handler registered with LoopWatchdog.handler"""
+    __slots__ = ("name", "busy", "step_start", "longest_step", "stack", "stack_source", "previous")
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0  # Seconds the call's own code ran on the loop, without its awaits
+        self.step_start = None
+        self.longest_step = 0.0
+        self.stack = None
+        self.stack_source = None
+        self.previous = None
+
+
+def coroutine_stack(coro):
+    """Return where a suspended coroutine is waiting, following its chain of awaits"""
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+        if frame is None:
+            break
+        frames.append((frame, frame.f_lineno))
+        coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+    return traceback.StackSummary.extract(frames)
+
+
+class LoopWatchdog:
+    """Measures event loop lag and logs what is blocking the loop.
+
+    A task on the loop wakes up every `interval` seconds and records how
+    late it woke up. A separate thread checks that those wake-ups keep
+    coming; once the loop has been stuck for `threshold` seconds it prints
+    the loop thread's current stack, which shows the code blocking it while
+    it is still blocking, and which handler it is in when the stack passes
+    through one registered with `handler`.
+
+    Handlers are timed by how long their own code keeps the loop busy, not
+    counting the time they spend awaiting. While a handler runs, the thread
+    also samples the loop thread's stack, so a slow handler is reported with
+    the code it was busy in.
+    """
+
+    def __init__(self, interval=0.5, threshold=1.0, slow_handler_threshold=2.0):
+        self.interval = interval
+        self.threshold = threshold
+        self.slow_handler_threshold = slow_handler_threshold
+        self.handler_names = {}  # format: code object: handler name
+        self.running = None  # The innermost HandlerCall running on the loop right now
+        self.loop_thread_id = None
+        self.last_beat = None
+        self.task = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.stalls = 0
+        self.slow_handlers = 0
+
+    def start(self):
+        """Start watching the running loop; does nothing if already started"""
+        if self.task is not None:
+            return
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self.beat())
+        self.thread = threading.Thread(target=self.monitor, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.last_lag = max(0.0, now - expected)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.last_beat = now
+
+    def monitor(self):
+        reported_beat = None
+        while not self.stop_event.wait(self.interval):
+            self.sample_handler()
+            last_beat = self.last_beat
+            blocked = time.monotonic() - last_beat
+            if blocked < self.threshold or last_beat == reported_beat:
+                continue
+            # Report each stall once, with the stack as it is now
+            reported_beat = last_beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.extract_stack(frame)
+            handler = self.find_handler(frame)
+            where = f" in {handler}" if handler else ""
+            print(
+                f"Event loop blocked for {blocked:.1f}s{where}, stack:\n"
+                + "".join(traceback.format_list(stack))
+            )
+
+    def sample_handler(self):
+        """Keep the loop thread's stack for the running handler, from the longest step sampled"""
+        call = self.running
+        if call is None:
+            return
+        step_start = call.step_start
+        if step_start is None:
+            return
+        running_for = time.perf_counter() - step_start
+        if call.stack_source == "sampled" and running_for <= call.longest_step:
+            return
+        frame = sys._current_frames().get(self.loop_thread_id)
+        # The handler may have finished its step in the meantime
+        if frame is None or self.running is not call or call.step_start != step_start:
+            return
+        call.stack = traceback.extract_stack(frame)
+        call.stack_source = "sampled"
+        call.longest_step = running_for
+
+    def find_handler(self, frame):
+        while frame is not None:
+            name = self.handler_names.get(frame.f_code)
+            if name is not None:
+                return name
+            frame = frame.f_back
+        return None
+
+    def enter(self, call):
+        call.previous = self.running
+        self.running = call
+        call.step_start = time.perf_counter()
+
+    def leave(self, call):
+        """End a step of the call and return how long it ran"""
+        elapsed = time.perf_counter() - call.step_start
+        call.step_start = None
+        call.busy += elapsed
+        self.running = call.previous
+        return elapsed
+
+    @types.coroutine
+    def drive(self, call, coro):
+        """Run `coro` like `await coro`, timing each step it runs on the loop"""
+        send, value = coro.send, None
+        while True:
+            self.enter(call)
+            try:
+                yielded = send(value)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                elapsed = self.leave(call)
+            # Without a sample from the monitor thread, report where the
+            # longest step stopped, right after the code that took the time
+            if elapsed > call.longest_step and call.stack_source != "sampled":
+                call.longest_step = elapsed
+                call.stack = coroutine_stack(coro)
+                call.stack_source = "paused"
+            try:
+                value = yield yielded
+                send = coro.send
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as error:
+                send, value = coro.throw, error
+
+    def report(self, call, wall_time):
+        if call.busy < self.slow_handler_threshold:
+            return
+        self.slow_handlers += 1
+        message = f"Slow handler: {call.name} kept the event loop busy for {call.busy:.2f}s"
+        if wall_time - call.busy >= 0.01:
+            message += f" ({wall_time:.2f}s including awaits)"
+        message += {
+            "sampled": ", stack while it ran:\n",
+            "paused": ", stack where its longest step ended:\n",
+            "caller": ", called from:\n"
+        }[call.stack_source]
+        print(message + "".join(traceback.format_list(call.stack)))
+
+    def handler(self, func):
+        """Decorator logging calls of a handler whose code keeps the loop busy too long"""
+        self.handler_names[func.__code__] = func.__name__
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                call = HandlerCall(func.__name__)
+                start = time.perf_counter()
+                try:
+                    return await self.drive(call, func(*args, **kwargs))
+                finally:
+                    self.report(call, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                call = HandlerCall(func.__name__)
+                self.enter(call)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = self.leave(call)
+                    if call.stack_source != "sampled":
+                        # Only the caller is left to show
+                        call.stack = traceback.extract_stack()[:-1]
+                        call.stack_source = "caller"
+                    self.report(call, elapsed)
+        return wrapper
+
+    def stats(self):
+        return {
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+            "stalls": self.stalls,
+            "slow_handlers": self.slow_handlers
+        }
@@ -1,13 +1,27 @@
 import discord
 from discord import app_commands
-from discord.ext import commands
+from discord.ext import commands, tasks
 import json
 import os
 import random
 import asyncio
+import cProfile
+import hashlib
+import io
+import pstats
+import sys
+import time
 import math
+from bisect import bisect_right
+from collections import Counter, OrderedDict
 from math import floor
+from types import SimpleNamespace
 from dotenv import load_dotenv
+import metrics
+from guild_config import GuildConfig
+from loop_watchdog import LoopWatchdog
+from outbound import PRIORITY_LEVEL_UP, PRIORITY_ROLES, PRIORITY_STARBOARD, OutboundScheduler
+from storage import XPStore, file_lock, load_json, open_backend, save_json
 
 # Bot configuration
 XP_MULTIPLIER = 0.5  # XP per character in message
@@ -16,6 +30,49 @@ MAX_XP_PER_MESSAGE = 1000  # Maximum XP per message
 XP_COOLDOWN = 3     # Cooldown in seconds between XP awards
 BOT_COLOR = 0xfb02bd  # Embed color (hex color code)
 MAX_LEVEL = 100     # Max level cap
+XP_FLUSH_INTERVAL = 30   # Seconds between writes of changed XP data to disk
+XP_FLUSH_THRESHOLD = 100  # Write early once this many users have unsaved XP
+STORAGE_BACKEND = "json"  # Where XP and starboard data is kept: "json" or "sqlite"
+SNAPSHOT_FORMAT = "json"  # Format of the per-server XP files of the JSON backend: "json" or "binary"
+XP_GUILD_IDLE_TIMEOUT = 600  # Seconds before an inactive guild's XP data is unloaded from memory
+LEADERBOARD_PAGE_SIZE = 10  # Users per leaderboard page
+LEADERBOARD_MAX_PAGES = 25  # Number of leaderboard pages that can be browsed
+LEADERBOARD_CACHE_TTL = 30  # Seconds a leaderboard snapshot is reused before it is refreshed
+XP_QUEUE_SIZE = 10000  # Messages waiting for XP before new ones are dropped
+XP_BATCH_SIZE = 500  # Most queued messages applied in one batch
+XP_BATCH_DELAY = 0.5  # Seconds to wait for more messages before applying a small batch
+STARBOARD_TRACKED_MESSAGES = 5000  # Messages whose star counts are kept in memory
+STARBOARD_EDIT_DEBOUNCE = 5  # Seconds to collect new stars before editing a starboard post
+STARBOARD_MESSAGE_CACHE_SIZE = 100  # Starboard posts kept in memory for editing without refetching
+ROLE_RESYNC_CONCURRENCY = 4  # Members /resync_roles works on at the same time
+ROLE_RESYNC_RATE = 5  # Average Discord requests per second made by /resync_roles
+ROLE_RESYNC_SAVE_INTERVAL = 10  # Seconds between saves of /resync_roles progress
+OUTBOUND_CONCURRENCY = 4  # Requests the bot makes on its own that can run at the same time
+OUTBOUND_BUCKET_CONCURRENCY = 1  # Of those, requests to the same channel or server at the same time
+OUTBOUND_QUEUE_SIZE = 1000  # Requests waiting to be made before low priority ones are dropped
+LEVEL_UP_MAX_DELAY = 60  # Seconds a level-up announcement can wait to be sent before it is dropped
+LEVEL_UP_BUFFER_WINDOW = 5  # Seconds to collect level-ups in a channel before announcing them together
+LEVEL_UP_MAX_LISTED = 10  # Members listed in one level-up announcement before the rest are counted
+METRICS_ENABLED = False  # Serve handler, command, storage and Discord request timings for Prometheus
+METRICS_HOST = "127.0.0.1"  # Address the metrics endpoint listens on
+METRICS_PORT = 9108  # Port of the metrics endpoint, served at /metrics
+LOOP_LAG_CHECK_INTERVAL = 0.5  # Seconds between event loop lag checks
+LOOP_LAG_THRESHOLD = 1  # Seconds the event loop can be blocked before what is blocking it is logged
+SLOW_HANDLER_THRESHOLD = 2  # Seconds an event handler can keep the loop busy (not counting awaits) before it is logged as slow
+PROFILE_MAX_SECONDS = 300  # Longest profile /profile can take
+GATEWAY_RECORD_FILE = None  # JSONL file to record gateway events to for tools/replay.py, or None to not record
+CONFIG_RELOAD_INTERVAL = 5  # Seconds between checks of bot_config.json for changes made while the bot runs
+FORCE_COMMAND_SYNC = False  # Sync slash commands on start even if they have not changed (or run with --sync-commands)
+AUTO_SHARD = False  # Run as an AutoShardedBot in this process; cluster.py runs the shards across several instead
+SHARD_COUNT = None  # Shards for AUTO_SHARD and cluster.py, or None to use the number Discord recommends
+CLUSTER_WORKERS = 2  # Worker processes cluster.py splits the shards across
+CLUSTER_HEALTH_INTERVAL = 15  # Seconds between the shard health reports cluster workers write for cluster.py
+LOW_MEMORY_MEMBERS = False  # Keep no member list per server and fetch the few members needed instead
+MEMBER_CACHE_SIZE = 1000  # Fetched members kept in memory for role updates
+MEMBER_CACHE_TTL = 300  # Seconds a fetched member is reused before it is fetched again
+
+# Settings of servers that have not configured their own, overridden by the
+# top level of bot_config.json. Commands change the server they are used in.
 
 # Level roles configuration - format: level: role_id
 LEVEL_ROLES = {}
@@ -31,6 +88,13 @@ STARBOARD = {
     "threshold": 3  # Number of reactions needed to appear on starboard
 }
 
+# Level-up announcements - format: {"enabled", "channel_id"}
+# A channel_id of 0 announces in the channel the member was talking in
+LEVEL_UP = {
+    "enabled": True,
+    "channel_id": 0
+}
+
 # Channels to ignore for XP gain - list of channel IDs
 IGNORED_CHANNELS = [
     0
@@ -41,74 +105,227 @@ intents.message_content = True
 intents.members = True
 intents.reactions = True
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+if METRICS_ENABLED:
+    metrics.enable()
+
+# Set by cluster.py in the environment of the worker processes it starts
+cluster_id = int(os.environ["KITAN_CLUSTER_ID"]) if "KITAN_CLUSTER_ID" in os.environ else None
+cluster_shard_ids = [int(shard_id) for shard_id in os.environ.get("KITAN_SHARD_IDS", "").split(",") if shard_id]
 
-XP_FILE = 'user_xp.json'
+bot_options = dict(
+    command_prefix='!',
+    intents=intents,
+    tree_cls=metrics.TimedCommandTree if METRICS_ENABLED else app_commands.CommandTree,
+    # Raw gateway events are only dispatched while recording them
+    enable_debug_events=GATEWAY_RECORD_FILE is not None
+)
+if LOW_MEMORY_MEMBERS:
+    # Members arrive with every message, reaction and command, so only the
+    # bot's own member is cached and servers are not chunked at startup
+    bot_options.update(member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+if cluster_id is not None:
+    bot = commands.AutoShardedBot(
+        shard_ids=cluster_shard_ids, shard_count=int(os.environ["KITAN_SHARD_COUNT"]), **bot_options
+    )
+elif AUTO_SHARD:
+    bot = commands.AutoShardedBot(shard_count=SHARD_COUNT, **bot_options)
+else:
+    bot = commands.Bot(**bot_options)
+metrics.instrument_http(bot.http)
+
+XP_FILE = 'user_xp.json'  # Pre-guild XP data, migrated into XP_DIR on startup
+XP_DIR = 'xp_data'
 STARBOARD_FILE = 'starboard.json'
 CONFIG_FILE = 'bot_config.json'
+DATABASE_FILE = 'kitan.db'
+PROFILE_DIR = 'profiles'
+ROLE_RESYNC_FILE = 'role_resync.json'
+COMMAND_SYNC_FILE = 'command_sync.json'
+CLUSTER_DIR = 'cluster'  # Health reports of cluster workers
 
-def load_xp_data():
-    if os.path.exists(XP_FILE):
-        with open(XP_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+storage_backend = None
+xp_store = None
+metrics_server = None
 
-def save_xp_data(data):
-    with open(XP_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+# Backend methods timed when metrics are enabled
+STORAGE_METRICS = (
+    "load_guild", "save_guild", "append_journal", "rotate_journal", "top", "position",
+    "count_users", "user_ids", "get_starboard", "save_starboard", "save_starboard_many"
+)
 
-def load_starboard_data():
-    if os.path.exists(STARBOARD_FILE):
-        with open(STARBOARD_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+loop_watchdog = LoopWatchdog(
+    interval=LOOP_LAG_CHECK_INTERVAL,
+    threshold=LOOP_LAG_THRESHOLD,
+    slow_handler_threshold=SLOW_HANDLER_THRESHOLD
+)
+profiler_running = False
+
+# Level-up announcements, role changes and starboard posts, in priority order
+outbound = OutboundScheduler(
+    max_concurrency=OUTBOUND_CONCURRENCY,
+    bucket_concurrency=OUTBOUND_BUCKET_CONCURRENCY,
+    max_queued=OUTBOUND_QUEUE_SIZE
+)
 
-def save_starboard_data(data):
-    with open(STARBOARD_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+def cluster_journal_dir(worker_id):
+    """Return where a cluster worker keeps its XP journal, or None for XP_DIR itself"""
+    return None if worker_id is None else os.path.join(XP_DIR, f"cluster-{worker_id}")
 
+def cluster_worker_ids():
+    """Return the IDs of the cluster workers that have kept a journal in XP_DIR"""
+    if not os.path.isdir(XP_DIR):
+        return []
+    return sorted(
+        int(name[len("cluster-"):]) for name in os.listdir(XP_DIR)
+        if name.startswith("cluster-") and name[len("cluster-"):].isdigit()
+    )
+
+def compact_journals(worker_ids):
+    """Apply the XP journals of the given cluster workers (None for XP_DIR's own) to the snapshots.
+
+    Which process owns a server can change between runs, so cluster.py and
+    a bot started on its own apply the journals of every other layout first.
+    """
+    for worker_id in worker_ids:
+        backend = open_backend(
+            STORAGE_BACKEND, XP_DIR, STARBOARD_FILE, DATABASE_FILE,
+            snapshot_format=SNAPSHOT_FORMAT, journal_dir=cluster_journal_dir(worker_id)
+        )
+        store = XPStore(backend, level_for_xp=calculate_level)
+        try:
+            replayed = store.replay_journal()
+            store.flush()
+        finally:
+            backend.close()
+        if replayed:
+            print(f"Recovered {replayed} XP change(s) from the journal in {backend.journal_dir}")
+
+def owns_guild(guild_id):
+    """Whether a server is on one of this process's shards; always true outside cluster mode"""
+    if cluster_id is None:
+        return True
+    return (int(guild_id) >> 22) % bot.shard_count in cluster_shard_ids
+
+def open_storage():
+    """Open the configured storage backend and the XP store on top of it"""
+    global storage_backend, xp_store
+    if cluster_id is None and STORAGE_BACKEND == "json":
+        compact_journals(cluster_worker_ids())
+    storage_backend = open_backend(
+        STORAGE_BACKEND, XP_DIR, STARBOARD_FILE, DATABASE_FILE, xp_path=XP_FILE, snapshot_format=SNAPSHOT_FORMAT,
+        journal_dir=cluster_journal_dir(cluster_id), shared=cluster_id is not None
+    )
+    metrics.instrument_storage(storage_backend, STORAGE_METRICS)
+    xp_store = XPStore(
+        storage_backend,
+        flush_interval=XP_FLUSH_INTERVAL,
+        flush_threshold=XP_FLUSH_THRESHOLD,
+        idle_timeout=XP_GUILD_IDLE_TIMEOUT,
+        level_for_xp=calculate_level
+    )
+    replayed = xp_store.replay_journal()
+    if replayed:
+        print(f"Recovered {replayed} XP change(s) from the journal")
+
+# Settings of each server that has its own - format: guild_id: GuildConfig
+guild_configs = {}
+default_guild_config = GuildConfig(STARBOARD, LEVEL_ROLES, ROLE_NAMES, IGNORED_CHANNELS, LEVEL_UP)
+# Modification time and size of CONFIG_FILE when it was last loaded or saved
+config_file_stamp = None
+# Servers whose settings were changed since they were last saved
+edited_guild_configs = set()
+
+def get_guild_config(guild_id):
+    """Return the settings of a server, or the defaults for servers without their own and DMs"""
+    return guild_configs.get(guild_id, default_guild_config)
+
+def edit_guild_config(guild_id):
+    """Return the settings of a server for a command to change, giving it its own first if needed.
+
+    Call `rebuild` on the result and save_config after changing it.
+    """
+    config = guild_configs.get(guild_id)
+    if config is None:
+        config = guild_configs[guild_id] = default_guild_config.copy()
+    edited_guild_configs.add(guild_id)
+    return config
+
+def get_config_file_stamp():
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+@metrics.timed(metrics.storage_seconds, "load_config")
 def load_config():
-    global STARBOARD, LEVEL_ROLES, ROLE_NAMES, IGNORED_CHANNELS
-    if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r') as f:
-            config = json.load(f)
-            
-            if "starboard" in config:
-                STARBOARD = config["starboard"]
-            
-            if "level_roles" in config:
-                LEVEL_ROLES = {int(k): int(v) for k, v in config["level_roles"].items()}
-            
-            if "role_names" in config:
-                ROLE_NAMES = {int(k): v for k, v in config["role_names"].items()}
-            
-            if "ignored_channels" in config:
-                IGNORED_CHANNELS = [int(channel_id) for channel_id in config["ignored_channels"]]
-                
-            return config
+    """Load the settings of every server from CONFIG_FILE, creating it on the first start"""
+    global guild_configs, default_guild_config, config_file_stamp
+    base = GuildConfig(STARBOARD, LEVEL_ROLES, ROLE_NAMES, IGNORED_CHANNELS, LEVEL_UP)
+    if not os.path.exists(CONFIG_FILE):
+        default_guild_config = base
+        guild_configs = {}
+        save_config()
+        return
+    
+    stamp = get_config_file_stamp()
+    with open(CONFIG_FILE, 'r') as f:
+        config = json.load(f)
     
-    config = {
-        "starboard": STARBOARD,
-        "level_roles": {str(k): str(v) for k, v in LEVEL_ROLES.items()},
-        "role_names": {str(k): v for k, v in ROLE_NAMES.items()},
-        "ignored_channels": [str(channel_id) for channel_id in IGNORED_CHANNELS]
+    defaults = GuildConfig.from_json(config, base)
+    configs = {
+        int(guild_id): GuildConfig.from_json(data, defaults)
+        for guild_id, data in config.get("guilds", {}).items()
     }
     
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
-        
-    return config
+    default_guild_config = defaults
+    guild_configs = configs
+    config_file_stamp = stamp
 
+@metrics.timed(metrics.storage_seconds, "save_config")
 def save_config():
-    config = {
-        "starboard": STARBOARD,
-        "level_roles": {str(k): str(v) for k, v in LEVEL_ROLES.items()},
-        "role_names": {str(k): v for k, v in ROLE_NAMES.items()},
-        "ignored_channels": [str(channel_id) for channel_id in IGNORED_CHANNELS]
-    }
+    """Write the settings to CONFIG_FILE.
+
+    Cluster workers share the file, so a worker rereads it under a lock,
+    replaces only the servers it changed and loads the result, which also
+    picks up the other workers' changes.
+    """
+    global config_file_stamp
+    if cluster_id is not None and os.path.exists(CONFIG_FILE):
+        with file_lock(CONFIG_FILE):
+            config = load_json(CONFIG_FILE)
+            guilds = config.setdefault("guilds", {})
+            for guild_id in edited_guild_configs:
+                guilds[str(guild_id)] = guild_configs[guild_id].to_json()
+            save_json(CONFIG_FILE, config)
+            edited_guild_configs.clear()
+            load_config()
+        return
     
-    with open(CONFIG_FILE, 'w') as f:
-        json.dump(config, f, indent=4)
+    config = default_guild_config.to_json()
+    config["guilds"] = {str(guild_id): guild_config.to_json() for guild_id, guild_config in guild_configs.items()}
+    save_json(CONFIG_FILE, config)
+    edited_guild_configs.clear()
+    # Our own writes are not changes to reload
+    config_file_stamp = get_config_file_stamp()
+
+@tasks.loop(seconds=CONFIG_RELOAD_INTERVAL)
+async def config_reload_loop():
+    """Reload CONFIG_FILE when it was changed by something other than the bot"""
+    global config_file_stamp
+    stamp = get_config_file_stamp()
+    if stamp is None or stamp == config_file_stamp:
+        return
+    try:
+        load_config()
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        # Keep the current settings, and only complain again once the file changes
+        config_file_stamp = stamp
+        print(f"Failed to reload {CONFIG_FILE}, keeping the current settings: {e}")
+        return
+    # Tracked star counts may be for a previous starboard emoji
+    starred_messages.clear()
+    print(f"Reloaded {CONFIG_FILE}")
 
 def advanced_xp_for_level(level):
     """Calculate XP needed for a specific level using Disgaea-style formula"""
@@ -117,25 +334,39 @@ def advanced_xp_for_level(level):
     # Formula: XP = 0.04 * level^3 + 0.8 * level^2 + 2 * level
     return 11 * (50 + 0.04 * (level - 1)**3 + 0.8 * (level - 1)**2 + 2 * (level - 1) + 0.5)
 
+_level_table = None
+
+def level_thresholds():
+    """Return the XP needed for every level from 0 to MAX_LEVEL + 1, indexed by level.
+
+    The table is built once from advanced_xp_for_level and rebuilt whenever
+    MAX_LEVEL or the formula function is changed.
+    """
+    global _level_table
+    if _level_table is None or _level_table[0] != MAX_LEVEL or _level_table[1] is not advanced_xp_for_level:
+        thresholds = [advanced_xp_for_level(level) for level in range(MAX_LEVEL + 2)]
+        _level_table = (MAX_LEVEL, advanced_xp_for_level, thresholds)
+    return _level_table[2]
+
+def xp_for_level(level):
+    """XP needed for a level, read from the threshold table when possible"""
+    thresholds = level_thresholds()
+    if 0 <= level < len(thresholds):
+        return thresholds[level]
+    return advanced_xp_for_level(level)
+
 def calculate_level(xp):
     """Calculate level based on total XP using advanced progression"""
     if xp <= 0:
         return 1
     
-    low, high = 1, MAX_LEVEL
-    while low <= high:
-        mid = (low + high) // 2
-        if advanced_xp_for_level(mid) <= xp < advanced_xp_for_level(mid + 1):
-            return mid
-        elif advanced_xp_for_level(mid) > xp:
-            high = mid - 1
-        else:
-            low = mid + 1
-    
-    return min(low, MAX_LEVEL)
+    # Highest level in 1..MAX_LEVEL whose threshold has been reached
+    return bisect_right(level_thresholds(), xp, 1, MAX_LEVEL + 1) - 1
 
 def calculate_message_xp(message):
-    length = len(message.content)
+    return calculate_length_xp(len(message.content))
+
+def calculate_length_xp(length):
     xp = int(length * XP_MULTIPLIER)
     xp = max(MIN_XP_PER_MESSAGE, min(xp, MAX_XP_PER_MESSAGE))
     xp += random.randint(0, 3)
@@ -144,162 +375,846 @@ def calculate_message_xp(message):
 def is_admin(interaction: discord.Interaction):
     return interaction.user.guild_permissions.administrator
 
-user_cooldowns = {}
+class CooldownTracker:
+    """Per-guild XP cooldowns that expire on their own.
 
-@bot.event
-async def on_ready():
-    print(f'{bot.user.name} has connected to Discord!')
-    print(f'Bot is active in {len(bot.guilds)} guilds.')
+    Award times are kept in two generations that rotate every `cooldown`
+    seconds, so an entry is dropped at most two cooldowns after it was set
+    and memory only holds users who talked recently. Checks are two dict
+    lookups.
+    """
+    
+    def __init__(self, cooldown):
+        self.cooldown = cooldown
+        self.current = {}
+        self.previous = {}
+        self.rotate_at = 0
+        self.rotations = 0
+        self.peak_entries = 0
+    
+    def _rotate(self, now):
+        if now >= self.rotate_at + self.cooldown:
+            # Nothing in either generation can still be cooling down
+            self.previous = {}
+        else:
+            self.previous = self.current
+        self.current = {}
+        self.rotate_at = now + self.cooldown
+        self.rotations += 1
+    
+    def try_acquire(self, guild_id, user_id, now):
+        """Start a cooldown for a user and return True, or return False if one is running"""
+        if self.cooldown <= 0:
+            return True
+        if now >= self.rotate_at:
+            self._rotate(now)
+        
+        key = (guild_id, user_id)
+        last = self.current.get(key)
+        if last is None:
+            last = self.previous.get(key)
+        if last is not None and now - last < self.cooldown:
+            return False
+        
+        self.current[key] = now
+        entries = len(self.current) + len(self.previous)
+        if entries > self.peak_entries:
+            self.peak_entries = entries
+        return True
+    
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+    
+    def stats(self):
+        return {
+            "entries": len(self),
+            "peak_entries": self.peak_entries,
+            "rotations": self.rotations,
+            "bytes": sys.getsizeof(self.current) + sys.getsizeof(self.previous)
+        }
+
+user_cooldowns = CooldownTracker(XP_COOLDOWN)
+
+# Messages waiting for XP - items are (guild, member, channel, length, timestamp)
+xp_queue = asyncio.Queue(maxsize=XP_QUEUE_SIZE)
+xp_queue_stats = {
+    "enqueued": 0,
+    "dropped": 0,
+    "batches": 0,
+    "last_batch_size": 0,
+    "last_drain_latency": 0.0,
+    "max_drain_latency": 0.0
+}
+
+@tasks.loop(seconds=1)
+async def xp_flush_loop():
+    global last_starboard_flush
+    if xp_store.needs_flush():
+        try:
+            await xp_store.flush_async()
+        except Exception as e:
+            print(f"Failed to save XP data: {e}")
+    xp_store.evict_idle()
     
-    load_config()
+    if unsaved_starboard_entries and time.monotonic() - last_starboard_flush >= XP_FLUSH_INTERVAL:
+        entries = dict(unsaved_starboard_entries)
+        unsaved_starboard_entries.clear()
+        last_starboard_flush = time.monotonic()
+        try:
+            await asyncio.to_thread(storage_backend.save_starboard_many, entries)
+        except Exception as e:
+            # Keep the entries for the next flush unless they were updated meanwhile
+            for message_id, entry in entries.items():
+                unsaved_starboard_entries.setdefault(message_id, entry)
+            print(f"Failed to save starboard data: {e}")
+
+def command_tree_hash():
+    """Return a hash of the slash commands as they are sent to Discord"""
+    # Command.to_dict only takes the tree since discord.py 2.4
+    if discord.version_info >= (2, 4):
+        commands = [command.to_dict(bot.tree) for command in bot.tree.get_commands()]
+    else:
+        commands = [command.to_dict() for command in bot.tree.get_commands()]
+    commands.sort(key=lambda command: (command["type"], command["name"]))
+    return hashlib.sha256(json.dumps(commands, sort_keys=True).encode()).hexdigest()
+
+async def sync_commands():
+    """Sync the slash commands unless they are unchanged since the last sync"""
+    command_hash = command_tree_hash()
+    last_sync = load_json(COMMAND_SYNC_FILE)
+    if (
+        not FORCE_COMMAND_SYNC
+        and last_sync.get("hash") == command_hash
+        and last_sync.get("application_id") == str(bot.application_id)
+    ):
+        print("Slash commands unchanged since the last sync")
+        return
     
-    # Sync slash commands
     try:
         synced = await bot.tree.sync()
         print(f"Synced {len(synced)} command(s)")
     except Exception as e:
         print(f"Failed to sync commands: {e}")
+        return
+    save_json(COMMAND_SYNC_FILE, {"application_id": str(bot.application_id), "hash": command_hash})
+
+async def fetch_all_members(guild):
+    """Return a stand-in for `guild` whose get_member finds all its members, without caching them"""
+    members = {member.id: member for member in await guild.chunk(cache=False)}
+    return SimpleNamespace(id=guild.id, get_member=members.get)
+
+# Set once on_ready has done the work that is only needed after the first connection
+started = False
 
 @bot.event
+@metrics.handler
+@loop_watchdog.handler
+async def on_ready():
+    """Finish starting up; on_ready also fires after reconnects, which only log"""
+    global metrics_server, started
+    if started:
+        print(f'{bot.user.name} has reconnected to Discord')
+        return
+    started = True
+    print(f'{bot.user.name} has connected to Discord!')
+    print(f'Bot is active in {len(bot.guilds)} guilds.')
+    
+    guilds = bot.guilds
+    if LOW_MEMORY_MEMBERS and storage_backend.load_legacy_xp() is not None:
+        # Migrating needs to know every server's members, once
+        guilds = [await fetch_all_members(guild) for guild in bot.guilds]
+    migrated = xp_store.migrate_legacy(guilds)
+    if migrated is not None:
+        print(f"Migrated {migrated} XP entries from {XP_FILE} into per-guild data")
+    
+    loop_watchdog.start()
+    
+    if not xp_flush_loop.is_running():
+        xp_flush_loop.start()
+    
+    if not xp_ingest_loop.is_running():
+        xp_ingest_loop.start()
+    
+    if not config_reload_loop.is_running():
+        config_reload_loop.start()
+    
+    resume_role_resyncs()
+    
+    if cluster_id is not None and not cluster_health_loop.is_running():
+        os.makedirs(CLUSTER_DIR, exist_ok=True)
+        cluster_health_loop.start()
+    
+    if METRICS_ENABLED and metrics_server is None:
+        # Each cluster worker serves its own metrics on the next port
+        port = METRICS_PORT + (cluster_id or 0)
+        try:
+            metrics_server = await metrics.start_server(METRICS_HOST, port)
+            print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+        except OSError as e:
+            print(f"Failed to start metrics server: {e}")
+    
+    # Commands are global, so one cluster worker syncs them for all
+    if not cluster_id:
+        await sync_commands()
+
+@bot.event
+async def on_shard_ready(shard_id):
+    print(f"Shard {shard_id} is ready")
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    print(f"Shard {shard_id} disconnected from Discord")
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    print(f"Shard {shard_id} resumed its session")
+
+def shard_health():
+    """Return the latency, state and server count of each shard this process runs"""
+    guild_counts = Counter(guild.shard_id for guild in bot.guilds)
+    health = {}
+    for shard_id, shard in sorted(getattr(bot, "shards", {}).items()):
+        latency = shard.latency
+        health[shard_id] = {
+            "latency": latency if math.isfinite(latency) else None,
+            "closed": shard.is_closed(),
+            "rate_limited": shard.is_ws_ratelimited(),
+            "guilds": guild_counts[shard_id]
+        }
+    return health
+
+@tasks.loop(seconds=CLUSTER_HEALTH_INTERVAL)
+async def cluster_health_loop():
+    """Report this worker's shards to cluster.py, which restarts workers that stop reporting"""
+    report = {
+        "pid": os.getpid(),
+        "time": time.time(),
+        "guilds": len(bot.guilds),
+        "shards": {str(shard_id): health for shard_id, health in shard_health().items()}
+    }
+    path = os.path.join(CLUSTER_DIR, f"worker-{cluster_id}.json")
+    try:
+        await asyncio.to_thread(save_json, path, report)
+    except OSError as e:
+        print(f"Failed to write cluster health report: {e}")
+
+# Gateway events tools/replay.py can replay
+RECORDED_GATEWAY_EVENTS = {
+    "READY", "GUILD_CREATE", "MESSAGE_CREATE", "MESSAGE_REACTION_ADD", "MESSAGE_REACTION_REMOVE",
+    "MESSAGE_REACTION_REMOVE_ALL", "MESSAGE_REACTION_REMOVE_EMOJI", "INTERACTION_CREATE"
+}
+gateway_record = None
+
+@bot.event
+async def on_socket_raw_receive(msg):
+    """Append replayable gateway events to GATEWAY_RECORD_FILE"""
+    global gateway_record
+    event = json.loads(msg)
+    if event.get("op") != 0 or event.get("t") not in RECORDED_GATEWAY_EVENTS:
+        return
+    
+    if gateway_record is None:
+        gateway_record = open(GATEWAY_RECORD_FILE, 'a')
+    gateway_record.write(json.dumps({"ts": time.time(), "t": event["t"], "d": event["d"]}) + "\n")
+    gateway_record.flush()
+
+@bot.event
+@metrics.handler
+@loop_watchdog.handler
 async def on_message(message):
     if message.author.bot:
         return
     await bot.process_commands(message)
-    if message.channel.id not in IGNORED_CHANNELS:
-        await process_xp(message)
+    if message.channel.id not in get_guild_config(message.guild and message.guild.id).ignored:
+        process_xp(message)
+    
+@metrics.handler
+@loop_watchdog.handler
+def process_xp(message):
+    """Queue a message for XP unless the author is on cooldown"""
+    if message.guild is None:
+        return
     
-async def process_xp(message):
+    guild_id = str(message.guild.id)
     user_id = str(message.author.id)
     current_time = asyncio.get_event_loop().time()
     
-    if user_id in user_cooldowns and current_time - user_cooldowns[user_id] < XP_COOLDOWN:
+    if not user_cooldowns.try_acquire(guild_id, user_id, current_time):
         return
     
-    user_cooldowns[user_id] = current_time
-    xp_data = load_xp_data()
-    
-    if user_id not in xp_data:
-        xp_data[user_id] = {
-            "xp": 0,
-            "level": 1,
-            "username": message.author.name
-        }
-    
-    xp_gained = calculate_message_xp(message)
-    xp_data[user_id]["xp"] += xp_gained
-    xp_data[user_id]["username"] = message.author.name
-    
-    current_level = xp_data[user_id]["level"]
-    new_level = calculate_level(xp_data[user_id]["xp"])
-    
-    if new_level > current_level:
-        xp_data[user_id]["level"] = new_level
-        save_xp_data(xp_data)
+    try:
+        xp_queue.put_nowait((message.guild, message.author, message.channel, len(message.content), current_time))
+        xp_queue_stats["enqueued"] += 1
+    except asyncio.QueueFull:
+        # Shed load instead of stalling the gateway; the author can earn XP again after the cooldown
+        xp_queue_stats["dropped"] += 1
+        if xp_queue_stats["dropped"] % 1000 == 1:
+            print(f"XP queue is full, {xp_queue_stats['dropped']} message(s) dropped so far")
+
+@metrics.handler
+@loop_watchdog.handler
+def apply_xp_batch(batch):
+    """Apply XP for a batch of queued messages and return the resulting level-ups.
+
+    Messages from the same member are combined into one XP change. Level-ups
+    are returned as (guild, member, channel, new_level) tuples, announced in
+    the channel of the member's last message.
+    """
+    combined = {}
+    for guild, member, channel, length, timestamp in batch:
+        key = (guild.id, member.id)
+        entry = combined.get(key)
+        if entry is None:
+            combined[key] = [guild, member, channel, calculate_length_xp(length)]
+        else:
+            entry[1] = member
+            entry[2] = channel
+            entry[3] += calculate_length_xp(length)
+    
+    level_ups = []
+    for guild, member, channel, xp_gained in combined.values():
+        guild_id = str(guild.id)
+        user_id = str(member.id)
+        user_data, old_level = xp_store.add_xp(guild_id, user_id, member.name, xp_gained)
         
+        if user_data["level"] > old_level:
+            level_ups.append((guild, member, channel, user_data["level"]))
+    
+    return level_ups
+
+# Level-ups waiting to be announced - format: channel_id: {member_id: (member, level)}
+pending_level_ups = {}
+level_up_tasks = set()
+
+def announce_level_up(guild, member, channel, new_level):
+    """Queue the level-up message and role change for a member.
+
+    Announcements go to the server's level-up channel if it has one, and are
+    collected for LEVEL_UP_BUFFER_WINDOW seconds so everyone who levels up
+    in a channel meanwhile is announced in a single message.
+    """
+    settings = get_guild_config(guild.id).level_up
+    if settings["channel_id"]:
+        channel = guild.get_channel(settings["channel_id"]) or channel
+    
+    if settings["enabled"]:
+        pending = pending_level_ups.get(channel.id)
+        if pending is None:
+            pending = pending_level_ups[channel.id] = {}
+            task = asyncio.create_task(send_level_ups_after_window(channel))
+            level_up_tasks.add(task)
+            task.add_done_callback(level_up_tasks.discard)
+        pending[member.id] = (member, new_level)
+    
+    # Only the latest level matters if the member levels up again before this runs
+    outbound.submit(
+        PRIORITY_ROLES, ("guild", guild.id),
+        lambda: update_level_roles(guild, member, new_level),
+        key=("roles", guild.id, member.id)
+    )
+
+async def send_level_ups_after_window(channel):
+    await asyncio.sleep(LEVEL_UP_BUFFER_WINDOW)
+    embed = build_level_up_embed(list(pending_level_ups.pop(channel.id).values()))
+    outbound.submit(
+        PRIORITY_LEVEL_UP, ("channel", channel.id),
+        lambda: channel.send(embed=embed),
+        max_age=LEVEL_UP_MAX_DELAY
+    )
+
+def build_level_up_embed(level_ups):
+    """Build one announcement for a list of (member, level) pairs"""
+    if len(level_ups) == 1:
+        member, level = level_ups[0]
         embed = discord.Embed(
             title="Level Up!",
-            description=f"{message.author.mention} has reached level {new_level}!",
+            description=f"{member.mention} has reached level {level}!",
             color=BOT_COLOR
         )
-        embed.set_thumbnail(url=message.author.display_avatar.url)
-        await message.channel.send(embed=embed)
-        
-        await update_level_roles(message.guild, message.author, new_level)
-    else:
-        save_xp_data(xp_data)
+        embed.set_thumbnail(url=member.display_avatar.url)
+        return embed
+    
+    lines = [f"{member.mention} has reached level {level}!" for member, level in level_ups[:LEVEL_UP_MAX_LISTED]]
+    if len(level_ups) > LEVEL_UP_MAX_LISTED:
+        lines.append(f"...and {len(level_ups) - LEVEL_UP_MAX_LISTED} more!")
+    return discord.Embed(
+        title="Level Up!",
+        description="\n".join(lines),
+        color=BOT_COLOR
+    )
+
+def take_xp_batch(limit):
+    batch = []
+    while len(batch) < limit and not xp_queue.empty():
+        batch.append(xp_queue.get_nowait())
+    return batch
+
+@tasks.loop(seconds=0)
+async def xp_ingest_loop():
+    first = await xp_queue.get()
+    if xp_queue.qsize() < XP_BATCH_SIZE - 1:
+        await asyncio.sleep(XP_BATCH_DELAY)
+    batch = [first] + take_xp_batch(XP_BATCH_SIZE - 1)
+    
+    now = asyncio.get_event_loop().time()
+    latency = now - min(item[4] for item in batch)
+    xp_queue_stats["batches"] += 1
+    xp_queue_stats["last_batch_size"] = len(batch)
+    xp_queue_stats["last_drain_latency"] = latency
+    xp_queue_stats["max_drain_latency"] = max(xp_queue_stats["max_drain_latency"], latency)
+    
+    try:
+        level_ups = apply_xp_batch(batch)
+    except Exception as e:
+        print(f"Failed to apply XP for {len(batch)} message(s): {e}")
+        return
+    
+    for guild, member, channel, new_level in level_ups:
+        try:
+            announce_level_up(guild, member, channel, new_level)
+        except Exception as e:
+            print(f"Failed to announce level up for {member.name}: {e}")
 
 async def update_level_roles(guild, member, new_level):
-    """Update member's roles based on their level"""
+    """Update member's roles based on their level.
+
+    The member keeps only the level role for the highest level they have
+    reached, or none below the first level role; nothing is sent when their
+    roles are already right. Members in the member cache are edited in a
+    single request; members fetched earlier (low-memory mode) may have
+    stale roles, so only their level roles are added and removed.
+    Returns True when the roles were changed.
+    """
     if not guild or not member:
-        return
+        return False
+    
+    config = get_guild_config(guild.id)
+    role_id = config.role_for_level(new_level)
+    if role_id is not None:
+        role = guild.get_role(role_id)
+        
+        if not role:
+            print(f"Error: Role with ID {role_id} not found")
+            return False
+    else:
+        role = None
     
-    sorted_levels = sorted(LEVEL_ROLES.keys())
+    # The member may have waited behind other requests; the cache has
+    # their roles as they are now, so the edit keeps roles given since
+    cached_member = guild.get_member(member.id)
+    if cached_member is not None:
+        member = cached_member
     
-    highest_role_level = None
-    for level in sorted_levels:
-        if new_level >= level:
-            highest_role_level = level
+    # The first role of a member is always @everyone, which cannot be assigned
+    current_roles = member.roles[1:]
+    level_role_ids = config.level_role_ids
+    new_roles = [r for r in current_roles if r.id not in level_role_ids or r.id == role_id]
+    if role and role not in new_roles:
+        new_roles.append(role)
+    
+    if len(new_roles) == len(current_roles) and (role is None or role in current_roles):
+        return False
+    
+    try:
+        if cached_member is not None:
+            await member.edit(roles=new_roles)
         else:
-            break
+            removed_roles = [r for r in current_roles if r not in new_roles]
+            if removed_roles:
+                await member.remove_roles(*removed_roles)
+            if role and role not in current_roles:
+                await member.add_roles(role)
+            # Its roles are out of date now
+            fetched_members.pop((guild.id, member.id), None)
+        if role:
+            print(f"Set level role {role.name} for {member.name}")
+        else:
+            print(f"Removed level roles from {member.name}")
+    except Exception as e:
+        print(f"Failed to update level roles for {member.name}: {e}")
+        return False
+    return True
+
+# Members fetched from Discord, least recently used first - format: (guild_id, user_id): (member, fetched_at)
+fetched_members = OrderedDict()
+
+def cache_fetched_member(member):
+    key = (member.guild.id, member.id)
+    fetched_members[key] = (member, time.monotonic())
+    fetched_members.move_to_end(key)
+    if len(fetched_members) > MEMBER_CACHE_SIZE:
+        fetched_members.popitem(last=False)
+
+async def get_or_fetch_member(guild, user_id):
+    """Return a member of a server, or None if they left, and whether Discord was asked.
+
+    Members are looked up in the member cache, then among the members
+    fetched in the last MEMBER_CACHE_TTL seconds, before being fetched.
+    """
+    member = guild.get_member(user_id)
+    if member is not None:
+        return member, False
+    
+    key = (guild.id, user_id)
+    cached = fetched_members.get(key)
+    if cached is not None and time.monotonic() - cached[1] < MEMBER_CACHE_TTL:
+        fetched_members.move_to_end(key)
+        return cached[0], False
     
-    if highest_role_level is None:
+    try:
+        member = await guild.fetch_member(user_id)
+    except discord.NotFound:
+        fetched_members.pop(key, None)
+        return None, True
+    cache_fetched_member(member)
+    return member, True
+
+# Running level role resyncs - format: guild_id: {"task", "state"}
+role_resync_jobs = {}
+
+def save_role_resync_state():
+    """Persist the progress of running resyncs so they resume after a restart"""
+    states = {guild_id: job["state"] for guild_id, job in role_resync_jobs.items()}
+    if cluster_id is None:
+        save_json(ROLE_RESYNC_FILE, states)
         return
+    # Keep the resyncs of servers on other workers' shards
+    with file_lock(ROLE_RESYNC_FILE):
+        for guild_id, state in load_json(ROLE_RESYNC_FILE).items():
+            if not owns_guild(guild_id):
+                states[guild_id] = state
+        save_json(ROLE_RESYNC_FILE, states)
+
+async def resync_member_roles(guild, user_id):
+    """Reconcile one member's level roles with their stored level.
+
+    Returns (requests made, whether their roles were changed).
+    """
+    entry = xp_store.get(str(guild.id), user_id)
+    if entry is None:
+        return 0, False
+    
+    member, fetched = await get_or_fetch_member(guild, int(user_id))
+    requests = int(fetched)
+    if member is None:
+        return requests, False
+    
+    changed = bool(await outbound.submit(
+        PRIORITY_ROLES, ("guild", guild.id),
+        lambda: update_level_roles(guild, member, entry["level"]),
+        key=("roles", guild.id, member.id)
+    ))
+    return requests + changed, changed
+
+async def run_role_resync(guild, state):
+    """Walk every user with XP in a guild, in user ID order, fixing their level roles.
+
+    Members are handled ROLE_RESYNC_CONCURRENCY at a time and the job sleeps
+    after each group so it makes at most ROLE_RESYNC_RATE requests per second
+    on average, leaving room for everything else the bot sends. discord.py
+    still waits out any rate limit Discord reports. `state["cursor"]` is the
+    last user ID done and is saved every ROLE_RESYNC_SAVE_INTERVAL seconds,
+    so a restarted job picks up from there.
+    """
+    guild_id = str(guild.id)
+    user_ids = await xp_store.user_ids(guild_id)
+    start = bisect_right(user_ids, state["cursor"]) if state["cursor"] else 0
+    state["total"] = state["processed"] + len(user_ids) - start
+    state["run_started"] = time.time()
+    state["run_processed"] = 0
+    last_save = time.monotonic()
     
-    role_id = LEVEL_ROLES[highest_role_level]
-    role = guild.get_role(role_id)
-    
-    if not role:
-        print(f"Error: Role with ID {role_id} not found")
+    try:
+        for i in range(start, len(user_ids), ROLE_RESYNC_CONCURRENCY):
+            chunk = user_ids[i:i + ROLE_RESYNC_CONCURRENCY]
+            results = await asyncio.gather(
+                *(resync_member_roles(guild, user_id) for user_id in chunk),
+                return_exceptions=True
+            )
+            
+            requests = 0
+            for result in results:
+                if isinstance(result, Exception):
+                    print(f"Role resync failed for a member of {guild.name}: {result}")
+                    state["failed"] += 1
+                    continue
+                requests += result[0]
+                state["updated"] += result[1]
+            
+            state["processed"] += len(chunk)
+            state["run_processed"] += len(chunk)
+            state["cursor"] = chunk[-1]
+            
+            if time.monotonic() - last_save >= ROLE_RESYNC_SAVE_INTERVAL:
+                save_role_resync_state()
+                last_save = time.monotonic()
+            
+            if requests:
+                await asyncio.sleep(requests / ROLE_RESYNC_RATE)
+    except Exception as e:
+        print(f"Role resync for {guild.name} stopped after {state['processed']} members: {e}")
+        del role_resync_jobs[guild_id]
+        save_role_resync_state()
         return
     
-    for level in LEVEL_ROLES:
-        if level != highest_role_level:
-            other_role_id = LEVEL_ROLES[level]
-            other_role = guild.get_role(other_role_id)
-            if other_role and other_role in member.roles:
-                try:
-                    await member.remove_roles(other_role)
-                except Exception as e:
-                    print(f"Failed to remove role {other_role.name}: {e}")
+    del role_resync_jobs[guild_id]
+    save_role_resync_state()
+    print(f"Role resync for {guild.name} finished: {state['processed']} checked, {state['updated']} updated")
     
-    if role not in member.roles:
+    channel = guild.get_channel(state["channel_id"])
+    if channel:
+        embed = discord.Embed(
+            title="Level Role Resync Finished",
+            description=(
+                f"Checked {state['processed']} members, updated {state['updated']}"
+                + (f", {state['failed']} failed" if state["failed"] else "")
+                + "."
+            ),
+            color=BOT_COLOR
+        )
         try:
-            await member.add_roles(role)
-            print(f"Added role {role.name} to {member.name}")
+            await channel.send(embed=embed)
         except Exception as e:
-            print(f"Failed to add role {role.name}: {e}")
+            print(f"Failed to report role resync in {guild.name}: {e}")
+
+def start_role_resync(guild, state):
+    """Run a resync for `guild` in the background, continuing from `state`"""
+    role_resync_jobs[str(guild.id)] = {
+        "task": asyncio.create_task(run_role_resync(guild, state)),
+        "state": state
+    }
+    save_role_resync_state()
+
+def resume_role_resyncs():
+    """Restart the resyncs that were running when the bot last stopped"""
+    for guild_id, state in load_json(ROLE_RESYNC_FILE).items():
+        guild = bot.get_guild(int(guild_id))
+        if guild is None or guild_id in role_resync_jobs:
+            continue
+        print(f"Resuming level role resync for {guild.name} after {state['processed']} members")
+        start_role_resync(guild, state)
+
+# Star counts of recently starred messages, least recently starred first -
+# format: message_id: {"count", "author_bot", "starboard"}
+starred_messages = OrderedDict()
+
+async def load_starboard_entry(message_id):
+    """Return a message's starboard entry, or None; storage is read in a thread"""
+    entry = unsaved_starboard_entries.get(message_id)
+    if entry is None:
+        entry = await asyncio.to_thread(storage_backend.get_starboard, message_id)
+    return entry
+
+async def track_starred_message(message):
+    """Start counting stars for a message, seeded from its current reactions"""
+    star_count = 0
+    emoji = get_guild_config(message.guild and message.guild.id).starboard["emoji"]
+    for reaction in message.reactions:
+        if str(reaction.emoji) == emoji:
+            star_count = reaction.count
+            break
+    
+    starboard_entry = await load_starboard_entry(str(message.id))
+    tracked = starred_messages.get(message.id)
+    if tracked is not None:
+        # Another reaction started tracking it while storage was read
+        tracked["count"] = max(tracked["count"], star_count)
+        if tracked["starboard"] is None:
+            tracked["starboard"] = starboard_entry
+        return tracked
+    
+    tracked = {
+        "count": star_count,
+        "author_bot": message.author.bot,
+        "starboard": starboard_entry
+    }
+    starred_messages[message.id] = tracked
+    if len(starred_messages) > STARBOARD_TRACKED_MESSAGES:
+        starred_messages.popitem(last=False)
+    return tracked
 
 @bot.event
+@metrics.handler
+@loop_watchdog.handler
 async def on_raw_reaction_add(payload):
     """Handle starboard reactions"""
-    if not STARBOARD["enabled"]:
+    if payload.guild_id is None:
         return
-    member = await bot.get_guild(payload.guild_id).fetch_member(payload.user_id)
-    if member.bot:
+    starboard = get_guild_config(payload.guild_id).starboard
+    if not starboard["enabled"] or str(payload.emoji) != starboard["emoji"]:
         return
-    if str(payload.emoji) != STARBOARD["emoji"]:
+    
+    message = None
+    tracked = starred_messages.get(payload.message_id)
+    if tracked is None:
+        channel = bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        message = await channel.fetch_message(payload.message_id)
+        tracked = await track_starred_message(message)
+    else:
+        tracked["count"] += 1
+        starred_messages.move_to_end(payload.message_id)
+    
+    if payload.member is not None and payload.member.bot:
         return
-    channel = bot.get_channel(payload.channel_id)
-    message = await channel.fetch_message(payload.message_id)
-    if message.author.bot:
+    if tracked["author_bot"] or tracked["count"] < starboard["threshold"]:
         return
-    star_count = 0
-    for reaction in message.reactions:
-        if str(reaction.emoji) == STARBOARD["emoji"]:
-            star_count = reaction.count
-            break
-    if star_count >= STARBOARD["threshold"]:
-        await add_to_starboard(message, star_count)
+    if payload.message_id in starboard_posts_in_flight:
+        # The post being sent is updated with this star once it is there
+        return
+    
+    if tracked["starboard"] is not None:
+        await update_starboard(payload.guild_id, str(payload.message_id), tracked["starboard"], tracked["count"])
+        return
+    
+    if message is None:
+        channel = bot.get_channel(payload.channel_id)
+        if channel is None:
+            return
+        message = await channel.fetch_message(payload.message_id)
+    star_count = tracked["count"]
+    starboard_entry = await submit_starboard_post(message, star_count)
+    if starboard_entry is None:
+        return
+    tracked["starboard"] = starboard_entry
+    if tracked["count"] != star_count:
+        await update_starboard(payload.guild_id, str(payload.message_id), starboard_entry, tracked["count"])
+
+@bot.event
+@metrics.handler
+@loop_watchdog.handler
+async def on_raw_reaction_remove(payload):
+    tracked = starred_messages.get(payload.message_id)
+    if tracked is not None and str(payload.emoji) == get_guild_config(payload.guild_id).starboard["emoji"]:
+        tracked["count"] = max(0, tracked["count"] - 1)
+
+@bot.event
+@metrics.handler
+@loop_watchdog.handler
+async def on_raw_reaction_clear(payload):
+    starred_messages.pop(payload.message_id, None)
+
+@bot.event
+@metrics.handler
+@loop_watchdog.handler
+async def on_raw_reaction_clear_emoji(payload):
+    if str(payload.emoji) == get_guild_config(payload.guild_id).starboard["emoji"]:
+        starred_messages.pop(payload.message_id, None)
 
 async def add_to_starboard(message, star_count):
-    """Add a message to the starboard"""
-    starboard_data = load_starboard_data()
-    
+    """Add a message to the starboard, or update its star count if it is already there"""
     message_id = str(message.id)
-    if message_id in starboard_data:
-        starboard_msg_id = starboard_data[message_id]["starboard_msg_id"]
-        starboard_channel = bot.get_channel(STARBOARD["channel_id"])
-        if not starboard_channel:
-            return
-        
-        try:
-            starboard_msg = await starboard_channel.fetch_message(int(starboard_msg_id))
-            
-            embed = starboard_msg.embeds[0]
-            embed.set_footer(text=f"{STARBOARD['emoji']} {star_count}")
-            
-            await starboard_msg.edit(embed=embed)
-            starboard_data[message_id]["stars"] = star_count
-            save_starboard_data(starboard_data)
-        except Exception as e:
-            print(f"Error updating starboard message: {e}")
-        
+    starboard_entry = await load_starboard_entry(message_id)
+    if starboard_entry is not None:
+        await update_starboard(message.guild.id, message_id, starboard_entry, star_count)
+    else:
+        await submit_starboard_post(message, star_count)
+
+# Messages whose starboard post is queued or being sent
+starboard_posts_in_flight = set()
+
+async def submit_starboard_post(message, star_count):
+    """Queue a message's starboard post and return its entry, or None if it failed or is already on its way.
+
+    The outbound merge key only catches posts still waiting in the queue,
+    so messages are also remembered until their post has been sent.
+    """
+    if message.id in starboard_posts_in_flight:
+        return None
+    starboard_posts_in_flight.add(message.id)
+    try:
+        return await outbound.submit(
+            PRIORITY_STARBOARD, ("channel", get_guild_config(message.guild.id).starboard["channel_id"]),
+            lambda: post_to_starboard(message, star_count),
+            key=("starboard post", message.id)
+        )
+    finally:
+        starboard_posts_in_flight.discard(message.id)
+
+# Latest star counts waiting for a debounced starboard edit - format: message_id: star_count
+pending_starboard_edits = {}
+starboard_edit_tasks = set()
+
+# Starboard entries with star counts not saved yet - format: message_id: entry
+unsaved_starboard_entries = {}
+last_starboard_flush = 0
+
+# Recently fetched or edited starboard posts - format: starboard message id: discord.Message
+starboard_message_cache = OrderedDict()
+
+def cache_starboard_message(starboard_msg):
+    starboard_message_cache[starboard_msg.id] = starboard_msg
+    starboard_message_cache.move_to_end(starboard_msg.id)
+    if len(starboard_message_cache) > STARBOARD_MESSAGE_CACHE_SIZE:
+        starboard_message_cache.popitem(last=False)
+
+async def get_starboard_message(starboard_channel, starboard_msg_id):
+    starboard_msg = starboard_message_cache.get(starboard_msg_id)
+    if starboard_msg is None:
+        starboard_msg = await starboard_channel.fetch_message(starboard_msg_id)
+        cache_starboard_message(starboard_msg)
+    return starboard_msg
+
+async def update_starboard(guild_id, message_id, starboard_entry, star_count):
+    """Update the star count shown on a message's starboard post.
+
+    Updates are collected for STARBOARD_EDIT_DEBOUNCE seconds and only the
+    latest count is edited in, so a burst of stars costs a single edit.
+    """
+    already_pending = message_id in pending_starboard_edits
+    pending_starboard_edits[message_id] = star_count
+    if already_pending:
         return
     
-    starboard_channel = bot.get_channel(STARBOARD["channel_id"])
+    task = asyncio.create_task(edit_starboard_after_debounce(guild_id, message_id, starboard_entry))
+    starboard_edit_tasks.add(task)
+    task.add_done_callback(starboard_edit_tasks.discard)
+
+async def edit_starboard_after_debounce(guild_id, message_id, starboard_entry):
+    await asyncio.sleep(STARBOARD_EDIT_DEBOUNCE)
+    # Stars that arrive while the edit waits in the outbound queue are still picked up
+    edited = await outbound.submit(
+        PRIORITY_STARBOARD, ("channel", get_guild_config(guild_id).starboard["channel_id"]),
+        lambda: edit_starboard(guild_id, message_id, starboard_entry)
+    )
+    if edited is None:
+        # Dropped by the outbound queue, so the next star schedules a new edit
+        pending_starboard_edits.pop(message_id, None)
+
+async def edit_starboard(guild_id, message_id, starboard_entry):
+    """Edit the latest pending star count into a starboard post; returns True once it is taken"""
+    star_count = pending_starboard_edits.pop(message_id)
+    if star_count == starboard_entry["stars"]:
+        return True
+    
+    starboard = get_guild_config(guild_id).starboard
+    starboard_channel = bot.get_channel(starboard["channel_id"])
     if not starboard_channel:
-        print(f"Starboard channel with ID {STARBOARD['channel_id']} not found")
-        return
+        return True
+    
+    starboard_msg_id = int(starboard_entry["starboard_msg_id"])
+    try:
+        starboard_msg = await get_starboard_message(starboard_channel, starboard_msg_id)
+        
+        embed = starboard_msg.embeds[0]
+        embed.set_footer(text=f"{starboard['emoji']} {star_count}")
+        
+        cache_starboard_message(await starboard_msg.edit(embed=embed))
+        starboard_entry["stars"] = star_count
+        unsaved_starboard_entries[message_id] = starboard_entry
+    except Exception as e:
+        starboard_message_cache.pop(starboard_msg_id, None)
+        print(f"Error updating starboard message: {e}")
+    return True
+
+async def post_to_starboard(message, star_count):
+    """Post a message to the starboard and return its starboard entry, or None on failure"""
+    starboard = get_guild_config(message.guild.id).starboard
+    starboard_channel = bot.get_channel(starboard["channel_id"])
+    if not starboard_channel:
+        print(f"Starboard channel with ID {starboard['channel_id']} not found")
+        return None
     
     embed = discord.Embed(
         description=message.content,
@@ -308,7 +1223,7 @@ async def add_to_starboard(message, star_count):
     )
     
     embed.set_author(name=message.author.display_name, icon_url=message.author.display_avatar.url)
-    embed.set_footer(text=f"{STARBOARD['emoji']} {star_count}")
+    embed.set_footer(text=f"{starboard['emoji']} {star_count}")
     embed.add_field(name="Source", value=f"[Jump to message]({message.jump_url})")
     
     if message.attachments and message.attachments[0].url.lower().endswith(('png', 'jpeg', 'jpg', 'gif', 'webp')):
@@ -316,26 +1231,31 @@ async def add_to_starboard(message, star_count):
     
     try:
         starboard_msg = await starboard_channel.send(embed=embed)
-        starboard_data[message_id] = {
+        cache_starboard_message(starboard_msg)
+        starboard_entry = {
             "starboard_msg_id": str(starboard_msg.id),
             "stars": star_count,
             "author": str(message.author.id),
             "channel": str(message.channel.id)
         }
-        save_starboard_data(starboard_data)
+        await asyncio.to_thread(storage_backend.save_starboard, str(message.id), starboard_entry)
+        return starboard_entry
     except Exception as e:
         print(f"Error adding message to starboard: {e}")
+        return None
 
 @bot.tree.command(name="rank", description="Check your or another user's XP and rank")
 @app_commands.describe(member="The member whose rank you want to check")
+@app_commands.guild_only()
 async def rank(interaction: discord.Interaction, member: discord.Member = None):
     if member is None:
         member = interaction.user
     
-    xp_data = load_xp_data()
+    guild_id = str(interaction.guild.id)
     user_id = str(member.id)
+    user_data = xp_store.get(guild_id, user_id)
     
-    if user_id not in xp_data:
+    if user_data is None:
         embed = discord.Embed(
             description=f"{member.display_name} hasn't earned any XP yet!",
             color=BOT_COLOR
@@ -343,10 +1263,12 @@ async def rank(interaction: discord.Interaction, member: discord.Member = None):
         await interaction.response.send_message(embed=embed)
         return
     
-    user_xp = xp_data[user_id]["xp"]
-    user_level = xp_data[user_id]["level"]
-    next_level_xp = advanced_xp_for_level(user_level + 1)
-    current_level_xp = advanced_xp_for_level(user_level)
+    user_xp = user_data["xp"]
+    user_level = user_data["level"]
+    position = await xp_store.position(guild_id, user_id)
+    total_users = await xp_store.count(guild_id)
+    next_level_xp = xp_for_level(user_level + 1)
+    current_level_xp = xp_for_level(user_level)
     
     if user_level >= MAX_LEVEL:
         progress_percent = 1
@@ -366,6 +1288,7 @@ async def rank(interaction: discord.Interaction, member: discord.Member = None):
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.add_field(name="Level", value=str(user_level), inline=True)
     embed.add_field(name="Total XP", value=str(user_xp), inline=True)
+    embed.add_field(name="Rank", value=f"#{position:,} of {total_users:,}", inline=True)
     
     if user_level < MAX_LEVEL:
         embed.add_field(name="Next Level", value=f"{floor(user_xp)}/{floor(next_level_xp)}", inline=True)
@@ -376,32 +1299,37 @@ async def rank(interaction: discord.Interaction, member: discord.Member = None):
     
     await interaction.response.send_message(embed=embed)
 
-@bot.tree.command(name="leaderboard", description="Show the XP leaderboard")
-@app_commands.describe(limit="Number of users to show (default: 10)")
-async def leaderboard(interaction: discord.Interaction, limit: int = 10):
-    xp_data = load_xp_data()
-    
-    if not xp_data:
-        embed = discord.Embed(
-            description="No users have earned XP yet!",
-            color=BOT_COLOR
-        )
-        await interaction.response.send_message(embed=embed)
-        return
-    
-    sorted_users = sorted(xp_data.items(), key=lambda x: x[1]["xp"], reverse=True)
-    
-    embed = discord.Embed(
-        title="📊 XP Leaderboard",
-        color=BOT_COLOR
-    )
-    
-    leaderboard_text = ""
-    for index, (user_id, data) in enumerate(sorted_users[:limit], 1):
-        username = data["username"]
-        level = data["level"]
-        xp = data["xp"]
-        
+# Short-lived leaderboard snapshots - format: guild_id: {"expires", "users", "pages"}
+leaderboard_cache = {}
+
+async def get_leaderboard_snapshot(guild_id):
+    """Return the cached ranking snapshot of a guild, refreshing it once it has expired"""
+    now = time.monotonic()
+    snapshot = leaderboard_cache.get(guild_id)
+    if snapshot is not None and now < snapshot["expires"]:
+        return snapshot
+    
+    for cached_guild_id in [key for key, value in leaderboard_cache.items() if now >= value["expires"]]:
+        del leaderboard_cache[cached_guild_id]
+    
+    top_users = await xp_store.top(guild_id, LEADERBOARD_PAGE_SIZE * LEADERBOARD_MAX_PAGES)
+    snapshot = {
+        "expires": now + LEADERBOARD_CACHE_TTL,
+        "users": [(data["username"], data["level"], data["xp"]) for _, data in top_users],
+        "pages": {}
+    }
+    leaderboard_cache[guild_id] = snapshot
+    return snapshot
+
+def render_leaderboard_page(snapshot, page):
+    """Render one page of a leaderboard snapshot, reusing earlier renders"""
+    text = snapshot["pages"].get(page)
+    if text is not None:
+        return text
+    
+    start = (page - 1) * LEADERBOARD_PAGE_SIZE
+    lines = []
+    for index, (username, level, xp) in enumerate(snapshot["users"][start:start + LEADERBOARD_PAGE_SIZE], start + 1):
         # Add emoji based on rank
         if index == 1:
             rank_emoji = "🥇"  # Gold medal for 1st place
@@ -412,14 +1340,100 @@ async def leaderboard(interaction: discord.Interaction, limit: int = 10):
         else:
             rank_emoji = "⭐"  # General medal for others
             
-        leaderboard_text += f"{rank_emoji} **{index}.** **{username}** - Level {level} ({xp} XP)\n"
+        lines.append(f"{rank_emoji} **{index}.** **{username}** - Level {level} ({xp} XP)")
     
-    embed.description = leaderboard_text
+    text = "\n".join(lines)
+    snapshot["pages"][page] = text
+    return text
+
+async def build_leaderboard_embed(guild_id, page):
+    """Return the leaderboard embed for a page (clamped to the available pages) and the page count"""
+    snapshot = await get_leaderboard_snapshot(guild_id)
+    page_count = max(1, math.ceil(len(snapshot["users"]) / LEADERBOARD_PAGE_SIZE))
+    page = max(1, min(page, page_count))
     
-    await interaction.response.send_message(embed=embed)
+    embed = discord.Embed(
+        title="📊 XP Leaderboard",
+        description=render_leaderboard_page(snapshot, page),
+        color=BOT_COLOR
+    )
+    embed.set_footer(text=f"Page {page}/{page_count}")
+    return embed, page, page_count
+
+class LeaderboardView(discord.ui.View):
+    """Previous/next buttons for browsing the leaderboard"""
+    
+    def __init__(self, owner_id, guild_id, page, page_count):
+        super().__init__(timeout=120)
+        self.owner_id = owner_id
+        self.guild_id = guild_id
+        self.page = page
+        # The /leaderboard interaction, whose response the buttons are on
+        self.interaction = None
+        self.update_buttons(page_count)
+    
+    def update_buttons(self, page_count):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= page_count
+    
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.owner_id:
+            embed = discord.Embed(
+                description="❌ Use `/leaderboard` to browse the leaderboard yourself!",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return False
+        return True
+    
+    async def show_page(self, interaction, page):
+        embed, self.page, page_count = await build_leaderboard_embed(self.guild_id, page)
+        self.update_buttons(page_count)
+        await interaction.response.edit_message(embed=embed, view=self)
+    
+    async def on_timeout(self):
+        # Grey the buttons out instead of leaving ones that fail when clicked
+        for item in self.children:
+            item.disabled = True
+        if self.interaction is None:
+            return
+        try:
+            await self.interaction.edit_original_response(view=self)
+        except discord.HTTPException:
+            # The message was deleted or can no longer be edited
+            pass
+    
+    @discord.ui.button(label="Previous", emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+    
+    @discord.ui.button(label="Next", emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+@bot.tree.command(name="leaderboard", description="Show the XP leaderboard")
+@app_commands.describe(page="Page of the leaderboard to show (default: 1)")
+@app_commands.guild_only()
+async def leaderboard(interaction: discord.Interaction, page: int = 1):
+    guild_id = str(interaction.guild.id)
+    snapshot = await get_leaderboard_snapshot(guild_id)
+    
+    if not snapshot["users"]:
+        embed = discord.Embed(
+            description="No users have earned XP yet!",
+            color=BOT_COLOR
+        )
+        await interaction.response.send_message(embed=embed)
+        return
+    
+    embed, page, page_count = await build_leaderboard_embed(guild_id, page)
+    view = LeaderboardView(interaction.user.id, guild_id, page, page_count)
+    await interaction.response.send_message(embed=embed, view=view)
+    view.interaction = interaction
 
 @bot.tree.command(name="help_xp", description="Show help for XP system")
 async def help_xp(interaction: discord.Interaction):
+    config = get_guild_config(interaction.guild_id)
     embed = discord.Embed(
         title="XP System Help",
         color=BOT_COLOR
@@ -429,11 +1443,15 @@ async def help_xp(interaction: discord.Interaction):
         name="Commands",
         value=(
             "`/rank [user]` - Check your or another user's rank\n"
-            "`/leaderboard [limit]` - Show the XP leaderboard\n"
+            "`/leaderboard [page]` - Show the XP leaderboard\n"
             "`/help_xp` - Show this help message\n"
             "`/givexp` - (Admin only) Give XP to a user\n"
             "`/starboard_config` - (Admin only) Configure the starboard\n"
-            "`/ignored_channels` - (Admin only) View/edit ignored channels"
+            "`/levelup_config` - (Admin only) Configure level-up announcements\n"
+            "`/ignored_channels` - (Admin only) View/edit ignored channels\n"
+            "`/bot_stats` - (Admin only) Show XP processing statistics\n"
+            "`/resync_roles` - (Admin only) Fix level roles of every member\n"
+            "`/profile` - (Admin only) Profile the bot for a number of seconds"
         ),
         inline=False
     )
@@ -450,32 +1468,33 @@ async def help_xp(interaction: discord.Interaction):
         inline=False
     )
     
-    if LEVEL_ROLES:
+    if config.role_tiers:
         roles_text = ""
-        for level, role_id in LEVEL_ROLES.items():
-            role_name = ROLE_NAMES.get(role_id, f"Role ID: {role_id}")
+        for level, role_id in config.role_tiers:
+            role_name = config.role_names.get(role_id, f"Role ID: {role_id}")
             roles_text += f"• Level {level}: {role_name}\n"
         
         embed.add_field(name="Level Roles", value=roles_text, inline=False)
     
-    if STARBOARD["enabled"]:
+    starboard = config.starboard
+    if starboard["enabled"]:
         embed.add_field(
             name="Starboard",
             value=(
-                f"• React with {STARBOARD['emoji']} to add messages to the starboard\n"
-                f"• Threshold: {STARBOARD['threshold']} {STARBOARD['emoji']} reactions\n"
-                f"• Channel ID: {STARBOARD['channel_id']}"
+                f"• React with {starboard['emoji']} to add messages to the starboard\n"
+                f"• Threshold: {starboard['threshold']} {starboard['emoji']} reactions\n"
+                f"• Channel ID: {starboard['channel_id']}"
             ),
             inline=False
         )
 
-    if IGNORED_CHANNELS:
+    if config.ignored_channels:
         ignored_text = "Channels where XP is not earned:\n"
-        for i, channel_id in enumerate(IGNORED_CHANNELS[:5], 1):
+        for i, channel_id in enumerate(config.ignored_channels[:5], 1):
             ignored_text += f"• Channel ID: {channel_id}\n"
         
-        if len(IGNORED_CHANNELS) > 5:
-            ignored_text += f"And {len(IGNORED_CHANNELS) - 5} more..."
+        if len(config.ignored_channels) > 5:
+            ignored_text += f"And {len(config.ignored_channels) - 5} more..."
             
         embed.add_field(name="Ignored Channels", value=ignored_text, inline=False)
     
@@ -486,6 +1505,7 @@ async def help_xp(interaction: discord.Interaction):
     member="The member to give XP to",
     amount="Amount of XP to give"
 )
+@app_commands.guild_only()
 async def givexp(interaction: discord.Interaction, member: discord.Member, amount: int):
     if not is_admin(interaction):
         embed = discord.Embed(
@@ -503,27 +1523,13 @@ async def givexp(interaction: discord.Interaction, member: discord.Member, amoun
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    xp_data = load_xp_data()
+    guild_id = str(interaction.guild.id)
     user_id = str(member.id)
-
-    if user_id not in xp_data:
-        xp_data[user_id] = {
-            "xp": 0,
-            "level": 1,
-            "username": member.name
-        }
-    
-    old_xp = xp_data[user_id]["xp"]
-    old_level = xp_data[user_id]["level"]
+    old_xp = xp_store.ensure(guild_id, user_id, member.name)["xp"]
+    user_data, old_level = xp_store.add_xp(guild_id, user_id, member.name, amount, reason="givexp")
     
-    xp_data[user_id]["xp"] += amount
-    xp_data[user_id]["username"] = member.name
-    
-    new_level = calculate_level(xp_data[user_id]["xp"])
+    new_level = user_data["level"]
     level_change = new_level - old_level
-    xp_data[user_id]["level"] = new_level
-    
-    save_xp_data(xp_data)
     
     embed = discord.Embed(
         title="XP Added",
@@ -531,7 +1537,7 @@ async def givexp(interaction: discord.Interaction, member: discord.Member, amoun
         color=BOT_COLOR
     )
     embed.add_field(name="Previous XP", value=str(old_xp), inline=True)
-    embed.add_field(name="New XP", value=str(xp_data[user_id]["xp"]), inline=True)
+    embed.add_field(name="New XP", value=str(user_data["xp"]), inline=True)
     
     if level_change > 0:
         if level_change == 1:
@@ -547,7 +1553,13 @@ async def givexp(interaction: discord.Interaction, member: discord.Member, amoun
                 inline=False
             )
             
-        await update_level_roles(interaction.guild, member, new_level)
+        # Queued like level ups from messages, so the reply does not wait on it
+        guild = interaction.guild
+        outbound.submit(
+            PRIORITY_ROLES, ("guild", guild.id),
+            lambda: update_level_roles(guild, member, new_level),
+            key=("roles", guild.id, member.id)
+        )
     
     await interaction.response.send_message(embed=embed)
 
@@ -558,6 +1570,7 @@ async def givexp(interaction: discord.Interaction, member: discord.Member, amoun
     threshold="Number of reactions needed to appear on starboard",
     channel_id="ID of the starboard channel"
 )
+@app_commands.guild_only()
 async def starboard_config(
     interaction: discord.Interaction,
     enabled: bool = None,
@@ -573,11 +1586,15 @@ async def starboard_config(
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
+    config = edit_guild_config(interaction.guild.id)
+    starboard = config.starboard
     if enabled is not None:
-        STARBOARD["enabled"] = enabled
+        starboard["enabled"] = enabled
     
     if emoji is not None:
-        STARBOARD["emoji"] = emoji
+        starboard["emoji"] = emoji
+        # Tracked star counts were for the previous emoji
+        starred_messages.clear()
     
     if threshold is not None:
         if threshold < 1:
@@ -587,12 +1604,12 @@ async def starboard_config(
             )
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
-        STARBOARD["threshold"] = threshold
+        starboard["threshold"] = threshold
     
     if channel_id is not None:
         try:
             channel_id_int = int(channel_id)
-            STARBOARD["channel_id"] = channel_id_int
+            starboard["channel_id"] = channel_id_int
         except ValueError:
             embed = discord.Embed(
                 description="❌ Invalid channel ID! Must be a number.",
@@ -601,6 +1618,7 @@ async def starboard_config(
             await interaction.response.send_message(embed=embed, ephemeral=True)
             return
     
+    config.rebuild()
     save_config()
     
     embed = discord.Embed(
@@ -609,12 +1627,12 @@ async def starboard_config(
         color=BOT_COLOR
     )
     
-    embed.add_field(name="Enabled", value=str(STARBOARD["enabled"]), inline=True)
-    embed.add_field(name="Emoji", value=STARBOARD["emoji"], inline=True)
-    embed.add_field(name="Threshold", value=str(STARBOARD["threshold"]), inline=True)
-    embed.add_field(name="Channel ID", value=str(STARBOARD["channel_id"]), inline=True)
+    embed.add_field(name="Enabled", value=str(starboard["enabled"]), inline=True)
+    embed.add_field(name="Emoji", value=starboard["emoji"], inline=True)
+    embed.add_field(name="Threshold", value=str(starboard["threshold"]), inline=True)
+    embed.add_field(name="Channel ID", value=str(starboard["channel_id"]), inline=True)
     
-    channel = interaction.guild.get_channel(STARBOARD["channel_id"])
+    channel = interaction.guild.get_channel(starboard["channel_id"])
     if channel:
         embed.add_field(name="Channel Name", value=f"#{channel.name}", inline=True)
     else:
@@ -622,11 +1640,71 @@ async def starboard_config(
     
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="levelup_config", description="Configure level-up announcements (Admin only)")
+@app_commands.describe(
+    enabled="Enable or disable level-up announcements",
+    channel_id="ID of the channel to announce level-ups in, or 0 for the channel the member is talking in"
+)
+@app_commands.guild_only()
+async def levelup_config(
+    interaction: discord.Interaction,
+    enabled: bool = None,
+    channel_id: str = None
+):
+    if not is_admin(interaction):
+        embed = discord.Embed(
+            description="❌ You don't have permission to use this command!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    settings = dict(get_guild_config(interaction.guild.id).level_up)
+    
+    if channel_id is not None:
+        try:
+            channel_id_int = int(channel_id)
+        except ValueError:
+            embed = discord.Embed(
+                description="❌ Invalid channel ID! Must be a number.",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        settings["channel_id"] = channel_id_int
+    
+    if enabled is not None:
+        settings["enabled"] = enabled
+    
+    if enabled is not None or channel_id is not None:
+        config = edit_guild_config(interaction.guild.id)
+        config.level_up = settings
+        config.rebuild()
+        save_config()
+    
+    embed = discord.Embed(
+        title="Level-up Announcements",
+        color=BOT_COLOR
+    )
+    
+    embed.add_field(name="Enabled", value=str(settings["enabled"]), inline=True)
+    if not settings["channel_id"]:
+        embed.add_field(name="Channel", value="Where the member is talking", inline=True)
+    else:
+        channel = interaction.guild.get_channel(settings["channel_id"])
+        if channel:
+            embed.add_field(name="Channel", value=channel.mention, inline=True)
+        else:
+            embed.add_field(name="Warning", value="Channel with this ID not found in server", inline=False)
+    
+    await interaction.response.send_message(embed=embed)
+
 @bot.tree.command(name="ignored_channels", description="View or edit channels ignored for XP (Admin only)")
 @app_commands.describe(
     action="Action to perform (view, add, remove)",
     channel_id="Channel ID to add or remove"
 )
+@app_commands.guild_only()
 async def ignored_channels(
     interaction: discord.Interaction,
     action: str,
@@ -640,7 +1718,10 @@ async def ignored_channels(
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    global IGNORED_CHANNELS
+    if action.lower() in ("add", "remove"):
+        config = edit_guild_config(interaction.guild.id)
+    else:
+        config = get_guild_config(interaction.guild.id)
     
     if action.lower() == "view":
         embed = discord.Embed(
@@ -649,11 +1730,11 @@ async def ignored_channels(
             color=BOT_COLOR
         )
         
-        if not IGNORED_CHANNELS:
+        if not config.ignored_channels:
             embed.description = "No channels are being ignored."
         else:
             channels_text = ""
-            for i, channel_id in enumerate(IGNORED_CHANNELS, 1):
+            for i, channel_id in enumerate(config.ignored_channels, 1):
                 channel = interaction.guild.get_channel(channel_id)
                 if channel:
                     channels_text += f"{i}. {channel.mention} (ID: {channel_id})\n"
@@ -681,7 +1762,7 @@ async def ignored_channels(
                     color=discord.Color.gold()
                 )
             else:
-                if channel_id_int in IGNORED_CHANNELS:
+                if channel_id_int in config.ignored_channels:
                     embed = discord.Embed(
                         description=f"❌ Channel {channel.mention} is already in the ignored list.",
                         color=discord.Color.red()
@@ -694,7 +1775,8 @@ async def ignored_channels(
                     color=BOT_COLOR
                 )
             
-            IGNORED_CHANNELS.append(channel_id_int)
+            config.ignored_channels.append(channel_id_int)
+            config.rebuild()
             save_config()
             
         except ValueError:
@@ -715,13 +1797,14 @@ async def ignored_channels(
         try:
             channel_id_int = int(channel_id)
             
-            if channel_id_int not in IGNORED_CHANNELS:
+            if channel_id_int not in config.ignored_channels:
                 embed = discord.Embed(
                     description=f"❌ Channel ID {channel_id_int} is not in the ignored list.",
                     color=discord.Color.red()
                 )
             else:
-                IGNORED_CHANNELS.remove(channel_id_int)
+                config.ignored_channels.remove(channel_id_int)
+                config.rebuild()
                 save_config()
                 channel = interaction.guild.get_channel(channel_id_int)
                 if channel:
@@ -755,6 +1838,7 @@ async def ignored_channels(
     role_id="ID of the role",
     role_name="Display name for the role"
 )
+@app_commands.guild_only()
 async def role_config(
     interaction: discord.Interaction,
     action: str,
@@ -770,7 +1854,10 @@ async def role_config(
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
     
-    global LEVEL_ROLES, ROLE_NAMES
+    if action.lower() in ("add", "remove", "update"):
+        config = edit_guild_config(interaction.guild.id)
+    else:
+        config = get_guild_config(interaction.guild.id)
 
     if action.lower() == "view":
         embed = discord.Embed(
@@ -779,15 +1866,15 @@ async def role_config(
             color=BOT_COLOR
         )
         
-        if not LEVEL_ROLES:
+        if not config.level_roles:
             embed.description = "No level roles configured."
         else:
-            sorted_levels = sorted(LEVEL_ROLES.keys())
+            sorted_levels = sorted(config.level_roles.keys())
             roles_text = ""
             
             for level in sorted_levels:
-                role_id = LEVEL_ROLES[level]
-                role_name = ROLE_NAMES.get(role_id, "Unknown")
+                role_id = config.level_roles[level]
+                role_name = config.role_names.get(role_id, "Unknown")
                 role = interaction.guild.get_role(role_id)
                 if role:
                     roles_text += f"Level {level}: {role.mention} (ID: {role_id}, Name: {role_name})\n"
@@ -808,7 +1895,7 @@ async def role_config(
         try:
             level_int = int(level)
             role_id_int = int(role_id)
-            if level_int in LEVEL_ROLES:
+            if level_int in config.level_roles:
                 embed = discord.Embed(
                     description=f"❌ Level {level_int} already has a role assigned. Use 'update' to change it.",
                     color=discord.Color.red()
@@ -828,15 +1915,16 @@ async def role_config(
                     color=BOT_COLOR
                 )
             
-            LEVEL_ROLES[level_int] = role_id_int
+            config.level_roles[level_int] = role_id_int
             
             if role_name:
-                ROLE_NAMES[role_id_int] = role_name
+                config.role_names[role_id_int] = role_name
             elif role:
-                ROLE_NAMES[role_id_int] = role.name
+                config.role_names[role_id_int] = role.name
             else:
-                ROLE_NAMES[role_id_int] = f"Level {level_int} Role"
+                config.role_names[role_id_int] = f"Level {level_int} Role"
             
+            config.rebuild()
             save_config()
             
         except ValueError:
@@ -859,7 +1947,7 @@ async def role_config(
         try:
             level_int = int(level)
             
-            if level_int not in LEVEL_ROLES:
+            if level_int not in config.level_roles:
                 embed = discord.Embed(
                     description=f"❌ No role found for level {level_int}.",
                     color=discord.Color.red()
@@ -867,20 +1955,21 @@ async def role_config(
                 await interaction.response.send_message(embed=embed, ephemeral=True)
                 return
             
-            role_id = LEVEL_ROLES[level_int]
+            role_id = config.level_roles[level_int]
             role = interaction.guild.get_role(role_id)
             
-            del LEVEL_ROLES[level_int]
+            del config.level_roles[level_int]
             
             role_still_used = False
-            for _, other_role_id in LEVEL_ROLES.items():
+            for _, other_role_id in config.level_roles.items():
                 if other_role_id == role_id:
                     role_still_used = True
                     break
 
-            if not role_still_used and role_id in ROLE_NAMES:
-                del ROLE_NAMES[role_id]
+            if not role_still_used and role_id in config.role_names:
+                del config.role_names[role_id]
             
+            config.rebuild()
             save_config()
             
             if role:
@@ -914,7 +2003,7 @@ async def role_config(
         try:
             level_int = int(level)
             
-            if level_int not in LEVEL_ROLES:
+            if level_int not in config.level_roles:
                 embed = discord.Embed(
                     description=f"❌ No role found for level {level_int}. Use 'add' to create it.",
                     color=discord.Color.red()
@@ -922,22 +2011,23 @@ async def role_config(
                 await interaction.response.send_message(embed=embed, ephemeral=True)
                 return
             
-            old_role_id = LEVEL_ROLES[level_int]
+            old_role_id = config.level_roles[level_int]
             
             if role_id:
                 role_id_int = int(role_id)
-                LEVEL_ROLES[level_int] = role_id_int
+                config.level_roles[level_int] = role_id_int
                 
                 role = interaction.guild.get_role(role_id_int)
                 
                 if role and not role_name:
-                    ROLE_NAMES[role_id_int] = role.name
+                    config.role_names[role_id_int] = role.name
             else:
                 role_id_int = old_role_id
             
             if role_name:
-                ROLE_NAMES[role_id_int] = role_name
+                config.role_names[role_id_int] = role_name
             
+            config.rebuild()
             save_config()
             
             embed = discord.Embed(
@@ -959,6 +2049,9 @@ async def role_config(
             color=discord.Color.red()
         )
     
+    if action.lower() in ("add", "remove", "update"):
+        embed.set_footer(text="Existing members get the new roles as they level up, or run /resync_roles start")
+    
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="setup_wizard", description="Run setup wizard to configure the bot (Admin only)")
@@ -1002,12 +2095,273 @@ async def setup_wizard(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="bot_stats", description="Show XP processing statistics (Admin only)")
+async def bot_stats(interaction: discord.Interaction):
+    if not is_admin(interaction):
+        embed = discord.Embed(
+            description="❌ You don't have permission to use this command!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    embed = discord.Embed(
+        title="Bot Statistics",
+        color=BOT_COLOR
+    )
+    
+    embed.add_field(
+        name="XP Queue",
+        value=(
+            f"• Depth: {xp_queue.qsize()}/{XP_QUEUE_SIZE}\n"
+            f"• Queued: {xp_queue_stats['enqueued']}, dropped: {xp_queue_stats['dropped']}\n"
+            f"• Batches: {xp_queue_stats['batches']}, last size: {xp_queue_stats['last_batch_size']}\n"
+            f"• Drain latency: {xp_queue_stats['last_drain_latency']:.2f}s (max {xp_queue_stats['max_drain_latency']:.2f}s)"
+        ),
+        inline=False
+    )
+    
+    cooldown_stats = user_cooldowns.stats()
+    embed.add_field(
+        name="Cooldowns",
+        value=(
+            f"• Tracked users: {cooldown_stats['entries']} (peak {cooldown_stats['peak_entries']})\n"
+            f"• Memory: {cooldown_stats['bytes'] / 1024:.1f} KiB"
+        ),
+        inline=False
+    )
+    
+    embed.add_field(
+        name="Members",
+        value=(
+            f"• Member cache: {'only members in use (low-memory mode)' if LOW_MEMORY_MEMBERS else 'every member'}\n"
+            f"• Recently fetched: {len(fetched_members)}/{MEMBER_CACHE_SIZE}"
+        ),
+        inline=False
+    )
+    
+    embed.add_field(
+        name="XP Store",
+        value=(
+            f"• Servers loaded: {len(xp_store.guilds)}\n"
+            f"• Unsaved users: {xp_store.dirty_count}"
+        ),
+        inline=False
+    )
+    
+    watchdog_stats = loop_watchdog.stats()
+    embed.add_field(
+        name="Event Loop",
+        value=(
+            f"• Lag: {watchdog_stats['last_lag'] * 1000:.0f}ms (max {watchdog_stats['max_lag'] * 1000:.0f}ms)\n"
+            f"• Blocked over {LOOP_LAG_THRESHOLD}s: {watchdog_stats['stalls']} time(s)\n"
+            f"• Handlers busy over {SLOW_HANDLER_THRESHOLD}s: {watchdog_stats['slow_handlers']}"
+        ),
+        inline=False
+    )
+    
+    health = shard_health()
+    if health:
+        lines = [
+            f"• Shard {shard_id}: "
+            + ("disconnected" if shard["closed"] or shard["latency"] is None else f"{shard['latency'] * 1000:.0f}ms")
+            + (", rate limited" if shard["rate_limited"] else "")
+            + f", {shard['guilds']} servers"
+            for shard_id, shard in health.items()
+        ]
+        if len(lines) > 20:
+            lines[20:] = [f"• ...and {len(lines) - 20} more"]
+        title = "Shards" if cluster_id is None else f"Shards (cluster worker {cluster_id}, {bot.shard_count} in all)"
+        embed.add_field(name=title, value="\n".join(lines), inline=False)
+    
+    outbound_stats = outbound.stats()
+    queued = outbound_stats["queued"]
+    embed.add_field(
+        name="Outbound Requests",
+        value=(
+            f"• Queued: {queued['roles']} roles, {queued['starboard']} starboard, {queued['level-ups']} level-ups\n"
+            f"• Running: {outbound_stats['in_flight']}/{OUTBOUND_CONCURRENCY}\n"
+            f"• Done: {outbound_stats['completed']}, failed: {outbound_stats['failed']}, merged: {outbound_stats['merged']}\n"
+            f"• Dropped: {outbound_stats['dropped_stale']} stale, {outbound_stats['dropped_full']} over queue size\n"
+            f"• Wait: {outbound_stats['last_wait']:.2f}s (max {outbound_stats['max_wait']:.2f}s)"
+        ),
+        inline=False
+    )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="resync_roles", description="Fix the level roles of every member (Admin only)")
+@app_commands.describe(action="Action to perform (start, status, cancel)")
+@app_commands.guild_only()
+async def resync_roles(interaction: discord.Interaction, action: str = "status"):
+    if not is_admin(interaction):
+        embed = discord.Embed(
+            description="❌ You don't have permission to use this command!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    guild_id = str(interaction.guild.id)
+    job = role_resync_jobs.get(guild_id)
+    
+    if action.lower() == "start":
+        if job:
+            embed = discord.Embed(
+                description="❌ A role resync is already running. Use 'status' to follow it.",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        
+        state = {
+            "channel_id": interaction.channel_id,
+            "cursor": None,
+            "processed": 0,
+            "updated": 0,
+            "failed": 0,
+            "total": await xp_store.count(guild_id)
+        }
+        start_role_resync(interaction.guild, state)
+        embed = discord.Embed(
+            description=(
+                f"✅ Started resyncing level roles for {state['total']} members. "
+                f"A summary will be posted here when it finishes."
+            ),
+            color=BOT_COLOR
+        )
+    
+    elif action.lower() == "status":
+        if not job:
+            embed = discord.Embed(
+                description="No role resync is running.",
+                color=BOT_COLOR
+            )
+        else:
+            state = job["state"]
+            embed = discord.Embed(
+                title="Level Role Resync",
+                description=(
+                    f"• Checked: {state['processed']}/{state['total']}\n"
+                    f"• Updated: {state['updated']}, failed: {state['failed']}"
+                ),
+                color=BOT_COLOR
+            )
+            run_processed = state.get("run_processed", 0)
+            if run_processed:
+                elapsed = time.time() - state["run_started"]
+                remaining = max(state["total"] - state["processed"], 0)
+                embed.description += (
+                    f"\n• Speed: {run_processed / elapsed:.1f} members/s, "
+                    f"about {math.ceil(remaining * elapsed / run_processed / 60)} min left"
+                )
+    
+    elif action.lower() == "cancel":
+        if not job:
+            embed = discord.Embed(
+                description="❌ No role resync is running.",
+                color=discord.Color.red()
+            )
+            await interaction.response.send_message(embed=embed, ephemeral=True)
+            return
+        
+        job["task"].cancel()
+        del role_resync_jobs[guild_id]
+        save_role_resync_state()
+        embed = discord.Embed(
+            description=f"✅ Cancelled the role resync after {job['state']['processed']} members.",
+            color=BOT_COLOR
+        )
+    
+    else:
+        embed = discord.Embed(
+            description="❌ Invalid action! Use 'start', 'status', or 'cancel'.",
+            color=discord.Color.red()
+        )
+    
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+@bot.tree.command(name="profile", description="Profile the bot for a number of seconds (Admin only)")
+@app_commands.describe(seconds="How many seconds to profile for")
+async def profile(interaction: discord.Interaction, seconds: int = 30):
+    if not is_admin(interaction):
+        embed = discord.Embed(
+            description="❌ You don't have permission to use this command!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    global profiler_running
+    
+    if not 1 <= seconds <= PROFILE_MAX_SECONDS:
+        embed = discord.Embed(
+            description=f"❌ Seconds must be between 1 and {PROFILE_MAX_SECONDS}!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    if profiler_running:
+        embed = discord.Embed(
+            description="❌ A profile is already being taken!",
+            color=discord.Color.red()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
+    
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    
+    # Everything the bot does runs on the event loop thread, so profiling it
+    # from here covers every handler, command and task
+    profiler_running = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        profiler_running = False
+    
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, time.strftime("profile-%Y%m%d-%H%M%S.prof"))
+    profiler.dump_stats(path)
+    print(f"Saved a {seconds}s profile to {path}")
+    
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(15)
+    report = output.getvalue()
+    report = report[report.find("ncalls"):] if "ncalls" in report else report
+    
+    embed = discord.Embed(
+        title=f"Profile ({seconds}s)",
+        description=f"```\n{report[:3900]}\n```",
+        color=BOT_COLOR
+    )
+    embed.set_footer(text=f"Saved to {path}; open it with pstats or snakeviz")
+    await interaction.followup.send(embed=embed, file=discord.File(path), ephemeral=True)
+
 if __name__ == "__main__":
+    if "--sync-commands" in sys.argv[1:]:
+        FORCE_COMMAND_SYNC = True
     load_config()
+    open_storage()
     load_dotenv()
 
     token = os.getenv("DISCORD_TOKEN")
     if not token:
         raise RuntimeError("DISCORD_TOKEN not set in environment or .env file")
 
-    bot.run(token)
+    try:
+        bot.run(token)
+    finally:
+        loop_watchdog.stop()
+        # Keep XP from messages still waiting in the queue, without announcing level-ups
+        while not xp_queue.empty():
+            apply_xp_batch(take_xp_batch(XP_BATCH_SIZE))
+        xp_store.flush()
+        if unsaved_starboard_entries:
+            storage_backend.save_starboard_many(unsaved_starboard_entries)
+        storage_backend.close()
+        if gateway_record is not None:
+            gateway_record.close()
@@ -0,0 +1,234 @@
+import asyncio
+import functools
+import inspect
+import time
+
+import discord
+from discord import app_commands
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Set by enable(); instrumentation decorators applied while this is False
+# return the function unchanged, so a disabled exporter costs nothing
+enabled = False
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # format: labels: [count per bucket..., count above the last bucket, sum]
+        self.values = {}
+
+    def observe(self, labels, seconds):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        index = 0
+        for bound in self.buckets:
+            if seconds <= bound:
+                break
+            index += 1
+        counts[index] += 1
+        counts[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, counts in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = format_labels(self.label_names + ("le",), labels + (str(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {counts[-1]}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+handler_seconds = Histogram("kitan_handler_seconds", "Time spent in event handlers", ("handler",))
+handler_errors = Counter("kitan_handler_errors_total", "Event handlers that raised", ("handler",))
+command_seconds = Histogram("kitan_command_seconds", "Time spent running slash commands", ("command", "status"))
+storage_seconds = Histogram("kitan_storage_seconds", "Time spent loading and saving data", ("operation",))
+rest_seconds = Histogram("kitan_rest_seconds", "Time spent on Discord REST requests", ("method", "route", "status"))
+
+METRICS = (handler_seconds, handler_errors, command_seconds, storage_seconds, rest_seconds)
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+def timed(histogram, name, errors=None):
+    """Decorator recording how long each call of a function takes under label `name`"""
+    def decorate(func):
+        if not enabled:
+            return func
+
+        labels = (name,)
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(labels)
+                    raise
+                finally:
+                    histogram.observe(labels, time.perf_counter() - start)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                except Exception:
+                    if errors is not None:
+                        errors.inc(labels)
+                    raise
+                finally:
+                    histogram.observe(labels, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def handler(func):
+    """Decorator timing an event handler, labelled with its function name"""
+    return timed(handler_seconds, func.__name__, errors=handler_errors)(func)
+
+
+def instrument_storage(backend, names):
+    """Time the given methods of a storage backend, labelled by method name; missing ones are skipped"""
+    if not enabled:
+        return
+    for name in names:
+        method = getattr(backend, name, None)
+        if method is not None:
+            setattr(backend, name, timed(storage_seconds, name)(method))
+
+
+def instrument_http(http):
+    """Time every REST request made through a discord.py HTTP client"""
+    if not enabled:
+        return
+    request = http.request
+
+    @functools.wraps(request)
+    async def timed_request(route, **kwargs):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        except Exception:
+            status = "error"
+            raise
+        finally:
+            rest_seconds.observe((route.method, route.path, status), time.perf_counter() - start)
+
+    http.request = timed_request
+
+
+class TimedCommandTree(app_commands.CommandTree):
+    """Command tree that records how long every slash command takes.
+
+    Only the tree's public hooks are used: interaction_check notes when a
+    command starts, and the client's app_command_completion event or the
+    tree's on_error records it as ok or error. The client must be a
+    commands.Bot, for its add_listener.
+    """
+
+    def __init__(self, client, *args, **kwargs):
+        super().__init__(client, *args, **kwargs)
+        client.add_listener(self.on_app_command_completion, "on_app_command_completion")
+
+    async def interaction_check(self, interaction):
+        interaction.extras["metrics_started"] = time.perf_counter()
+        return True
+
+    async def on_app_command_completion(self, interaction, command):
+        observe_command(interaction, "ok")
+
+    async def on_error(self, interaction, error):
+        observe_command(interaction, "error")
+        await super().on_error(interaction, error)
+
+
+def observe_command(interaction, status):
+    started = interaction.extras.pop("metrics_started", None)
+    if started is None:
+        return
+    command = interaction.command
+    name = command.qualified_name if command is not None else "unknown"
+    command_seconds.observe((name, status), time.perf_counter() - started)
+
+
+async def handle_request(reader, writer):
+    try:
+        request_line = await reader.readline()
+        # Skip the rest of the request headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        parts = request_line.split()
+        if len(parts) >= 2 and parts[0] == b"GET" and parts[1] == b"/metrics":
+            body = render().encode()
+            status = b"200 OK"
+            content_type = b"text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = b"Not found\n"
+            status = b"404 Not Found"
+            content_type = b"text/plain; charset=utf-8"
+        writer.write(
+            b"HTTP/1.0 " + status + b"\r\nContent-Type: " + content_type
+            + b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_server(host, port):
+    """Serve the metrics at http://host:port/metrics"""
+    return await asyncio.start_server(handle_request, host, port)
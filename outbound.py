@@ -0,0 +1,191 @@
+import asyncio
+import heapq
+import time
+
+# Lower numbers go first
+PRIORITY_ROLES = 0
+PRIORITY_STARBOARD = 1
+PRIORITY_LEVEL_UP = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_ROLES: "roles",
+    PRIORITY_STARBOARD: "starboard",
+    PRIORITY_LEVEL_UP: "level-ups"
+}
+
+
+class Action:
+    __slots__ = ("priority", "bucket", "factory", "key", "deadline", "submitted", "future")
+
+    def __init__(self, priority, bucket, factory, key, deadline, submitted, future):
+        self.priority = priority
+        self.bucket = bucket
+        self.factory = factory
+        self.key = key
+        self.deadline = deadline
+        self.submitted = submitted
+        self.future = future
+
+
+class OutboundScheduler:
+    """Runs the requests the bot makes on its own in priority order.
+
+    Actions are coroutine factories submitted with a priority and a bucket,
+    a key naming the Discord rate limit they count against (for example
+    ("channel", id) for messages sent to a channel). At most
+    `max_concurrency` actions run at once and at most `bucket_concurrency`
+    per bucket, so a burst queues up here instead of turning into 429s.
+
+    An action submitted with the `key` of one still queued replaces it, so
+    only the latest version runs. An action that waited longer than its
+    `max_age` is dropped, and when `max_queued` actions are waiting the
+    lowest priority one makes room. Dropped actions resolve to None.
+
+    Interaction responses never go through the scheduler: they have to be
+    sent within three seconds and have their own rate limit, so they always
+    go first.
+    """
+
+    def __init__(self, max_concurrency=4, bucket_concurrency=1, max_queued=1000):
+        self.max_concurrency = max_concurrency
+        self.bucket_concurrency = bucket_concurrency
+        self.max_queued = max_queued
+        self.queue = []  # heap of (priority, seq, action)
+        self.queued_keys = {}
+        self.in_flight = 0
+        self.bucket_in_flight = {}
+        self.seq = 0
+        self.wakeup = None
+        self.task = None
+        self.running = set()
+        self.counters = {
+            "submitted": 0,
+            "merged": 0,
+            "dropped_stale": 0,
+            "dropped_full": 0,
+            "completed": 0,
+            "failed": 0
+        }
+        self.last_wait = 0.0
+        self.max_wait = 0.0
+
+    def submit(self, priority, bucket, factory, key=None, max_age=None):
+        """Queue `factory()` to be awaited and return a future for its result"""
+        loop = asyncio.get_running_loop()
+        self.counters["submitted"] += 1
+
+        queued = self.queued_keys.get(key) if key is not None else None
+        if queued is not None:
+            queued.factory = factory
+            self.counters["merged"] += 1
+            return queued.future
+
+        if len(self.queue) >= self.max_queued:
+            worst = max(self.queue)
+            if worst[0] <= priority:
+                self.counters["dropped_full"] += 1
+                future = loop.create_future()
+                future.set_result(None)
+                return future
+            self.queue.remove(worst)
+            heapq.heapify(self.queue)
+            self.drop(worst[2], "dropped_full")
+
+        now = time.monotonic()
+        action = Action(
+            priority, bucket, factory, key,
+            now + max_age if max_age is not None else None,
+            now, loop.create_future()
+        )
+        self.seq += 1
+        heapq.heappush(self.queue, (priority, self.seq, action))
+        if key is not None:
+            self.queued_keys[key] = action
+
+        if self.task is None:
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.create_task(self.run())
+        self.wakeup.set()
+        return action.future
+
+    def drop(self, action, reason):
+        if action.key is not None:
+            self.queued_keys.pop(action.key, None)
+        self.counters[reason] += 1
+        if not action.future.done():
+            action.future.set_result(None)
+
+    def next_action(self):
+        """Take the most urgent action whose bucket has room, or None"""
+        if self.in_flight >= self.max_concurrency:
+            return None
+
+        now = time.monotonic()
+        skipped = []
+        found = None
+        while self.queue:
+            item = heapq.heappop(self.queue)
+            action = item[2]
+            if action.deadline is not None and action.deadline < now:
+                self.drop(action, "dropped_stale")
+                continue
+            if self.bucket_in_flight.get(action.bucket, 0) >= self.bucket_concurrency:
+                skipped.append(item)
+                continue
+            found = action
+            break
+
+        for item in skipped:
+            heapq.heappush(self.queue, item)
+        if found is not None and found.key is not None:
+            del self.queued_keys[found.key]
+        return found
+
+    async def run(self):
+        while True:
+            action = self.next_action()
+            if action is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            self.in_flight += 1
+            self.bucket_in_flight[action.bucket] = self.bucket_in_flight.get(action.bucket, 0) + 1
+            task = asyncio.create_task(self.execute(action))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def execute(self, action):
+        wait = time.monotonic() - action.submitted
+        self.last_wait = wait
+        self.max_wait = max(self.max_wait, wait)
+        try:
+            result = await action.factory()
+            self.counters["completed"] += 1
+        except Exception as e:
+            print(f"Outbound {PRIORITY_NAMES.get(action.priority, action.priority)} request failed: {e}")
+            self.counters["failed"] += 1
+            result = None
+        finally:
+            self.in_flight -= 1
+            remaining = self.bucket_in_flight[action.bucket] - 1
+            if remaining:
+                self.bucket_in_flight[action.bucket] = remaining
+            else:
+                del self.bucket_in_flight[action.bucket]
+            self.wakeup.set()
+
+        if not action.future.done():
+            action.future.set_result(result)
+
+    def stats(self):
+        queued = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, _ in self.queue:
+            queued[PRIORITY_NAMES[priority]] += 1
+        return {
+            "queued": queued,
+            "in_flight": self.in_flight,
+            "last_wait": self.last_wait,
+            "max_wait": self.max_wait,
+            **self.counters
+        }
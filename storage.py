@@ -0,0 +1,1005 @@
+import asyncio
+from array import array
+from contextlib import contextmanager, nullcontext
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+
+from sortedcontainers import SortedList
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where cluster mode is not supported
+    fcntl = None
+
+
+def load_json(path):
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def save_json(path, data):
+    """Write JSON through a temporary file so a crash never leaves a half-written file"""
+    temp_path = path + ".tmp"
+    with open(temp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+@contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on `path` against other processes while it is read and rewritten.
+
+    The lock is taken on a `.lock` file next to it, since save_json replaces
+    the file itself. Without fcntl this does nothing.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def load_json_snapshot(path):
+    """Return the users and journal sequence number of a JSON guild snapshot"""
+    data = load_json(path)
+    if "users" in data and "seq" in data:
+        return data["users"], data["seq"]
+    # Guild files written before the journal hold the users directly
+    return data, 0
+
+
+SNAPSHOT_MAGIC = b"KXP1"
+# Magic, journal sequence number, user count and size of the username bytes
+SNAPSHOT_HEADER = struct.Struct("<4s4xQQQ")
+SNAPSHOT_ID = struct.Struct("<Q")
+SNAPSHOT_NAME_RANGE = struct.Struct("<QQ")
+
+
+def _little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values
+
+
+def save_snapshot(path, entries, seq=0):
+    """Write {user_id: entry} or GuildColumns as a binary XP snapshot, through a temporary file like save_json"""
+    columns = entries if isinstance(entries, GuildColumns) else GuildColumns.from_entries(entries)
+    order = sorted(range(len(columns)), key=columns.ids.__getitem__)
+    user_ids = array('Q', [columns.ids[row] for row in order])
+    xp = array('q', [columns.xp[row] for row in order])
+    levels = array('i', [columns.levels[row] for row in order])
+    offsets = array('Q', [0])
+    names = bytearray()
+    for row in order:
+        names += columns.username(row).encode()
+        offsets.append(len(names))
+    if len(levels) % 2:
+        # Keep the columns after the levels 8-byte aligned
+        levels.append(0)
+
+    temp_path = path + ".tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq, len(user_ids), len(names)))
+        for column in (user_ids, xp, levels, offsets):
+            f.write(_little_endian(column).tobytes())
+        f.write(names)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+class XPSnapshot:
+    """A binary XP snapshot of one guild, memory-mapped and read in place.
+
+    After a 32 byte header come fixed-width little-endian columns sorted by
+    user ID: user IDs (u64), XP (i64), levels (i32, padded to a multiple of
+    8 bytes), username offsets (u64, one more than there are users), and the
+    UTF-8 usernames back to back. Single users are found by binary search
+    over the ID column, and whole columns load with one copy each, so
+    nothing is parsed per user until it is asked for.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.seq, self.count, names_size = SNAPSHOT_HEADER.unpack_from(self.map)
+        if magic != SNAPSHOT_MAGIC:
+            self.map.close()
+            raise ValueError(f"{path} is not an XP snapshot")
+
+        self.ids_start = SNAPSHOT_HEADER.size
+        self.xp_start = self.ids_start + 8 * self.count
+        self.levels_start = self.xp_start + 8 * self.count
+        self.offsets_start = self.levels_start + 8 * ((self.count + 1) // 2)
+        self.names_start = self.offsets_start + 8 * (self.count + 1)
+        if len(self.map) != self.names_start + names_size:
+            self.map.close()
+            raise ValueError(f"{path} is truncated")
+
+    def __len__(self):
+        return self.count
+
+    def _column(self, typecode, start):
+        values = array(typecode)
+        values.frombytes(self.map[start:start + values.itemsize * self.count])
+        return _little_endian(values)
+
+    def ids(self):
+        return self._column('Q', self.ids_start)
+
+    def xp(self):
+        return self._column('q', self.xp_start)
+
+    def levels(self):
+        return self._column('i', self.levels_start)
+
+    def username(self, index):
+        start, end = SNAPSHOT_NAME_RANGE.unpack_from(self.map, self.offsets_start + 8 * index)
+        return self.map[self.names_start + start:self.names_start + end].decode()
+
+    def index(self, user_id):
+        """Return the position of a user in the columns, or None"""
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if SNAPSHOT_ID.unpack_from(self.map, self.ids_start + 8 * middle)[0] < user_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and SNAPSHOT_ID.unpack_from(self.map, self.ids_start + 8 * low)[0] == user_id:
+            return low
+        return None
+
+    def get(self, user_id):
+        index = self.index(int(user_id))
+        if index is None:
+            return None
+        return {
+            "xp": struct.unpack_from("<q", self.map, self.xp_start + 8 * index)[0],
+            "level": struct.unpack_from("<i", self.map, self.levels_start + 4 * index)[0],
+            "username": self.username(index)
+        }
+
+    def items(self):
+        """Yield every (user_id, entry) pair in user ID order"""
+        for index, (user_id, xp, level) in enumerate(zip(self.ids(), self.xp(), self.levels())):
+            yield str(user_id), {"xp": xp, "level": level, "username": self.username(index)}
+
+    def close(self):
+        self.map.close()
+
+
+class JSONBackend:
+    """JSON storage with one XP file per guild and a shared starboard file.
+
+    Guild files are snapshots; every XP change in between is appended to a
+    journal of small JSON lines in `xp_dir`, split into segments named after
+    their first sequence number. Each snapshot records the sequence number
+    it includes, so replaying the journal on startup only applies newer
+    changes, and segments are deleted once every guild they touch has been
+    snapshotted again.
+
+    `xp_path` is the old global `user_xp.json`, only read to migrate it into
+    the per-guild files in `xp_dir`.
+
+    Cluster workers each own a set of guilds, so they share `xp_dir` but keep
+    their journals in their own `journal_dir`. With `shared` the starboard
+    file is locked against the other processes while it is rewritten.
+
+    With `snapshot_format` "binary" the guild snapshots are XPSnapshot files
+    instead of JSON. Either format is read when the other is missing, and
+    saving a guild removes its snapshot in the other format.
+    """
+
+    partial_writes = False
+    journaled = True
+
+    def __init__(self, xp_dir, starboard_path, xp_path=None, snapshot_format="json", journal_dir=None, shared=False):
+        if snapshot_format not in ("json", "binary"):
+            raise ValueError(f"Unknown snapshot format: {snapshot_format}")
+        self.xp_dir = xp_dir
+        self.journal_dir = journal_dir or xp_dir
+        self.shared = shared
+        self.snapshot_format = snapshot_format
+        self.starboard_path = starboard_path
+        self.xp_path = xp_path
+        # Starboard saves rewrite the whole file, from the event loop and the flush thread
+        self.starboard_lock = threading.Lock()
+        self.journal = None
+        os.makedirs(xp_dir, exist_ok=True)
+        os.makedirs(self.journal_dir, exist_ok=True)
+
+    def guild_path(self, guild_id, snapshot_format=None):
+        extension = "xps" if (snapshot_format or self.snapshot_format) == "binary" else "json"
+        return os.path.join(self.xp_dir, f"{guild_id}.{extension}")
+
+    def load_guild(self, guild_id):
+        other_format = "json" if self.snapshot_format == "binary" else "binary"
+        for snapshot_format in (self.snapshot_format, other_format):
+            path = self.guild_path(guild_id, snapshot_format)
+            if not os.path.exists(path):
+                continue
+            if snapshot_format == "binary":
+                snapshot = XPSnapshot(path)
+                return snapshot, snapshot.seq
+            return load_json_snapshot(path)
+        return {}, 0
+
+    def get_user(self, guild_id, user_id):
+        return None
+
+    def save_guild(self, guild_id, entries, seq=0):
+        """Write a guild's snapshot from {user_id: entry} dicts or GuildColumns"""
+        if self.snapshot_format == "binary":
+            save_snapshot(self.guild_path(guild_id), entries, seq)
+            other_path = self.guild_path(guild_id, "json")
+        else:
+            if isinstance(entries, GuildColumns):
+                entries = entries.entries()
+            save_json(self.guild_path(guild_id), {"seq": seq, "users": entries})
+            other_path = self.guild_path(guild_id, "binary")
+        if os.path.exists(other_path):
+            os.remove(other_path)
+
+    def journal_segments(self):
+        """Return the paths of the journal segments in the order they were written"""
+        names = [
+            name for name in os.listdir(self.journal_dir) if name.startswith("journal-") and name.endswith(".jsonl")
+        ]
+        names.sort(key=self._segment_start)
+        return [os.path.join(self.journal_dir, name) for name in names]
+
+    @staticmethod
+    def _segment_start(name):
+        return int(os.path.basename(name)[len("journal-"):-len(".jsonl")])
+
+    def journal_start(self):
+        """Return the first sequence number of the newest segment, or 1 without a journal"""
+        segments = self.journal_segments()
+        return self._segment_start(segments[-1]) if segments else 1
+
+    def read_journal(self):
+        for path in self.journal_segments():
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        # A write torn by a crash can only be the segment's last line
+                        break
+
+    def append_journal(self, record):
+        if self.journal is None:
+            self.rotate_journal(record["s"])
+        self.journal.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self.journal.flush()
+
+    def rotate_journal(self, next_seq):
+        """Start a new journal segment and return the paths of the earlier ones"""
+        if self.journal is not None:
+            self.journal.close()
+        path = os.path.join(self.journal_dir, f"journal-{next_seq}.jsonl")
+        self.journal = open(path, 'a')
+        return [segment for segment in self.journal_segments() if segment != path]
+
+    def remove_journal_segments(self, paths):
+        for path in paths:
+            os.remove(path)
+
+    def load_legacy_xp(self):
+        if self.xp_path and os.path.exists(self.xp_path):
+            return load_json(self.xp_path)
+        return None
+
+    def finish_legacy_migration(self):
+        os.replace(self.xp_path, self.xp_path + ".migrated")
+
+    def get_starboard(self, message_id):
+        with self.starboard_lock:
+            return load_json(self.starboard_path).get(message_id)
+
+    def save_starboard(self, message_id, entry):
+        self.save_starboard_many({message_id: entry})
+
+    def save_starboard_many(self, entries):
+        with self.starboard_lock, file_lock(self.starboard_path) if self.shared else nullcontext():
+            starboard_data = load_json(self.starboard_path)
+            starboard_data.update(entries)
+            save_json(self.starboard_path, starboard_data)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+
+class SQLiteBackend:
+    """SQLite storage with one row per guild member and an XP index for ranking.
+
+    Rows are only read when needed, so load_guild returns None and the store
+    fetches users lazily. The database runs in WAL mode so the flush thread
+    and lookups from the event loop do not block each other for long.
+
+    SQLite has no ranked index, so count_users and position count the rows
+    of the guild (above the user's XP) with the (guild_id, xp) index, which
+    is O(n) in the guild's size rather than O(log n) like the in-memory
+    ranking of the JSON backend. XPStore runs them in a thread.
+
+    With `shared` several processes write the database, so writers wait
+    longer for each other's transactions before giving up.
+    """
+
+    partial_writes = True
+    journaled = False
+
+    def __init__(self, path, xp_path=None, starboard_path=None, shared=False):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30 if shared else 5, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+
+        # Databases created before XP was split by guild keep their rows as
+        # legacy data until they are migrated into each guild
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(xp)")]
+        if columns and "guild_id" not in columns:
+            self.conn.execute("DROP INDEX IF EXISTS idx_xp_xp")
+            self.conn.execute("ALTER TABLE xp RENAME TO legacy_xp")
+
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS xp (
+                guild_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                xp INTEGER NOT NULL,
+                level INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                PRIMARY KEY (guild_id, user_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_xp_guild_xp ON xp (guild_id, xp DESC);
+            CREATE TABLE IF NOT EXISTS starboard (
+                message_id TEXT PRIMARY KEY,
+                starboard_msg_id TEXT NOT NULL,
+                stars INTEGER NOT NULL,
+                author TEXT NOT NULL,
+                channel TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self.migrate_json(xp_path, starboard_path)
+
+    def migrate_json(self, xp_path, starboard_path):
+        """Import the JSON data files once, the first time the database is opened"""
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = 'migrated_json'").fetchone()
+            if row is not None:
+                return
+
+            xp_data = load_json(xp_path) if xp_path else {}
+            starboard_data = load_json(starboard_path) if starboard_path else {}
+
+            with self.conn:
+                if xp_data:
+                    self.conn.execute(
+                        "CREATE TABLE IF NOT EXISTS legacy_xp ("
+                        "user_id TEXT PRIMARY KEY, xp INTEGER NOT NULL, level INTEGER NOT NULL, username TEXT NOT NULL)"
+                    )
+                    self.conn.executemany(
+                        "INSERT OR IGNORE INTO legacy_xp (user_id, xp, level, username) VALUES (?, ?, ?, ?)",
+                        [(user_id, entry["xp"], entry["level"], entry["username"]) for user_id, entry in xp_data.items()]
+                    )
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO starboard (message_id, starboard_msg_id, stars, author, channel) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (message_id, entry["starboard_msg_id"], entry["stars"], entry["author"], entry["channel"])
+                        for message_id, entry in starboard_data.items()
+                    ]
+                )
+                self.conn.execute("INSERT INTO meta (key, value) VALUES ('migrated_json', ?)", (str(int(time.time())),))
+
+            if xp_data or starboard_data:
+                print(f"Imported {len(xp_data)} user(s) and {len(starboard_data)} starboard message(s) into {self.path}")
+
+    def load_guild(self, guild_id):
+        return None, 0
+
+    def get_user(self, guild_id, user_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT xp, level, username FROM xp WHERE guild_id = ? AND user_id = ?", (guild_id, user_id)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"xp": row[0], "level": row[1], "username": row[2]}
+
+    def count_users(self, guild_id):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM xp WHERE guild_id = ?", (guild_id,)).fetchone()[0]
+
+    def save_guild(self, guild_id, entries, seq=0):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO xp (guild_id, user_id, xp, level, username) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (guild_id, user_id) DO UPDATE SET xp = excluded.xp, level = excluded.level, "
+                "username = excluded.username",
+                [
+                    (guild_id, user_id, entry["xp"], entry["level"], entry["username"])
+                    for user_id, entry in entries.items()
+                ]
+            )
+
+    def top(self, guild_id, limit):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id, xp, level, username FROM xp WHERE guild_id = ? ORDER BY xp DESC, user_id LIMIT ?",
+                (guild_id, limit)
+            ).fetchall()
+        return [(row[0], {"xp": row[1], "level": row[2], "username": row[3]}) for row in rows]
+
+    def position(self, guild_id, user_id, xp):
+        with self.lock:
+            return self.conn.execute(
+                "SELECT COUNT(*) FROM xp WHERE guild_id = ? AND (xp > ? OR (xp = ? AND user_id < ?))",
+                (guild_id, xp, xp, user_id)
+            ).fetchone()[0] + 1
+
+    def user_ids(self, guild_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM xp WHERE guild_id = ? ORDER BY user_id", (guild_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def load_legacy_xp(self):
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'legacy_xp'").fetchone() is None:
+                return None
+            rows = self.conn.execute("SELECT user_id, xp, level, username FROM legacy_xp").fetchall()
+        return {row[0]: {"xp": row[1], "level": row[2], "username": row[3]} for row in rows}
+
+    def finish_legacy_migration(self):
+        with self.lock, self.conn:
+            self.conn.execute("DROP TABLE IF EXISTS legacy_xp")
+
+    def get_starboard(self, message_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT starboard_msg_id, stars, author, channel FROM starboard WHERE message_id = ?",
+                (message_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return {"starboard_msg_id": row[0], "stars": row[1], "author": row[2], "channel": row[3]}
+
+    def save_starboard(self, message_id, entry):
+        self.save_starboard_many({message_id: entry})
+
+    def save_starboard_many(self, entries):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO starboard (message_id, starboard_msg_id, stars, author, channel) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (message_id) DO UPDATE SET starboard_msg_id = excluded.starboard_msg_id, "
+                "stars = excluded.stars, author = excluded.author, channel = excluded.channel",
+                [
+                    (message_id, entry["starboard_msg_id"], entry["stars"], entry["author"], entry["channel"])
+                    for message_id, entry in entries.items()
+                ]
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def rank_key(xp, user_id):
+    """Pack a user's leaderboard position into one int: more XP first, then lower user ID"""
+    return (-xp << 64) | user_id
+
+
+class XPEntry:
+    """One user's row in a GuildXP, read and written like an {"xp", "level", "username"} dict"""
+
+    __slots__ = ("guild", "row")
+
+    FIELDS = ("xp", "level", "username")
+
+    def __init__(self, guild, row):
+        self.guild = guild
+        self.row = row
+
+    def __getitem__(self, key):
+        if key == "xp":
+            return self.guild.xp[self.row]
+        if key == "level":
+            return self.guild.levels[self.row]
+        if key == "username":
+            return self.guild.username(self.row)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key == "xp":
+            self.guild.set_xp(self.row, value)
+        elif key == "level":
+            self.guild.levels[self.row] = value
+        elif key == "username":
+            self.guild.set_username(self.row, value)
+        else:
+            raise KeyError(key)
+
+    def keys(self):
+        return self.FIELDS
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class GuildXP:
+    """The XP data of a single guild, as held in memory by XPStore.
+
+    Users are stored column-wise so that millions of them stay small: `ids`,
+    `xp` and `levels` are parallel arrays indexed by row, `usernames` is a
+    list of interned strings (shared by a user's rows in every guild), and
+    `rows` maps integer user IDs back to rows. Partitions loaded from an
+    XPSnapshot copy its columns in one go and leave usernames in the mapped
+    file (None in `usernames`) until they change. Rows are only ever appended.
+    `get` returns an XPEntry view of a row, which reads and writes like the
+    {"xp", "level", "username"} dicts the backends load and save.
+
+    Fully loaded partitions also keep `ranking`, a sorted index of
+    rank_key ints in leaderboard order, updated on every XP change so top-N
+    reads and rank positions never sort the whole guild. Lazy partitions
+    leave ranking to the backend. `seq` is the last journal sequence number
+    included in the data loaded from the backend, which `data` holds and is
+    emptied into the columns.
+    """
+
+    def __init__(self, guild_id, data, lazy, seq=0):
+        self.guild_id = guild_id
+        self.lazy = lazy
+        self.seq = seq
+        self.dirty = set()
+        self.last_access = time.monotonic()
+        self.rows = {}
+        self.ids = array('Q')
+        self.xp = array('q')
+        self.levels = array('i')
+        self.usernames = []
+        self.names = None
+        if isinstance(data, XPSnapshot):
+            self._load_snapshot(data)
+        else:
+            # Empty the loaded dict as it is copied so its entries are freed along the way
+            while data:
+                user_id, entry = data.popitem()
+                self._append(int(user_id), entry)
+        if lazy:
+            self.ranking = None
+        else:
+            self.ranking = SortedList(map(rank_key, self.xp, self.ids))
+
+    def _load_snapshot(self, snapshot):
+        self.ids = snapshot.ids()
+        self.xp = snapshot.xp()
+        self.levels = snapshot.levels()
+        self.rows = dict(zip(self.ids, range(len(self.ids))))
+        self.usernames = [None] * len(self.ids)
+        self.names = snapshot
+
+    def _append(self, user_id, entry):
+        row = self.rows[user_id] = len(self.ids)
+        self.ids.append(user_id)
+        self.xp.append(entry["xp"])
+        self.levels.append(entry["level"])
+        self.usernames.append(sys.intern(entry["username"]))
+        return row
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, user_id):
+        return int(user_id) in self.rows
+
+    def get(self, user_id):
+        row = self.rows.get(int(user_id))
+        return None if row is None else XPEntry(self, row)
+
+    def user_ids(self):
+        return [str(user_id) for user_id in self.rows]
+
+    def insert(self, user_id, entry):
+        user_id = int(user_id)
+        row = self.rows.get(user_id)
+        if row is None:
+            row = self._append(user_id, entry)
+            if self.ranking is not None:
+                self.ranking.add(rank_key(entry["xp"], user_id))
+        else:
+            self.set_xp(row, entry["xp"])
+            self.levels[row] = entry["level"]
+            self.set_username(row, entry["username"])
+        return XPEntry(self, row)
+
+    def set_xp(self, row, xp):
+        if self.ranking is not None:
+            user_id = self.ids[row]
+            self.ranking.remove(rank_key(self.xp[row], user_id))
+            self.ranking.add(rank_key(xp, user_id))
+        self.xp[row] = xp
+
+    def username(self, row):
+        username = self.usernames[row]
+        if username is None:
+            return self.names.username(row)
+        return username
+
+    def set_username(self, row, username):
+        if self.username(row) != username:
+            self.usernames[row] = sys.intern(username)
+
+    def add_xp(self, user_id, amount):
+        user_id = int(user_id)
+        row = self.rows[user_id]
+        xp = self.xp[row]
+        if self.ranking is not None:
+            self.ranking.remove(rank_key(xp, user_id))
+            self.ranking.add(rank_key(xp + amount, user_id))
+        self.xp[row] = xp + amount
+        return XPEntry(self, row)
+
+    def top(self, limit):
+        """Return up to `limit` (user_id, entry dict) pairs in leaderboard order"""
+        mask = (1 << 64) - 1
+        user_ids = [key & mask for key in self.ranking.islice(0, max(limit, 0))]
+        return list(self.snapshot(user_ids).items())
+
+    def position(self, user_id):
+        user_id = int(user_id)
+        return self.ranking.index(rank_key(self.xp[self.rows[user_id]], user_id)) + 1
+
+    def snapshot(self, user_ids):
+        """Return plain entry dicts of `user_ids`, as the backends save them"""
+        rows, xp, levels, username = self.rows, self.xp, self.levels, self.username
+        snapshot = {}
+        for user_id in user_ids:
+            row = rows[int(user_id)]
+            snapshot[str(user_id)] = {"xp": xp[row], "level": levels[row], "username": username(row)}
+        return snapshot
+
+
+class GuildColumns:
+    """A copy of a guild's columns, for writing a full snapshot off the event loop.
+
+    Taking one from a GuildXP only copies its arrays and username list, so
+    it is cheap even for millions of users; building the dicts or binary
+    columns a backend saves is left to the thread that writes them.
+    """
+
+    def __init__(self, ids, xp, levels, usernames, names=None):
+        self.ids = ids
+        self.xp = xp
+        self.levels = levels
+        self.usernames = usernames
+        self.names = names
+
+    @classmethod
+    def copy(cls, guild):
+        return cls(guild.ids[:], guild.xp[:], guild.levels[:], guild.usernames[:], guild.names)
+
+    @classmethod
+    def from_entries(cls, entries):
+        columns = cls(array('Q'), array('q'), array('i'), [])
+        for user_id, entry in entries.items():
+            columns.ids.append(int(user_id))
+            columns.xp.append(entry["xp"])
+            columns.levels.append(entry["level"])
+            columns.usernames.append(entry["username"])
+        return columns
+
+    def __len__(self):
+        return len(self.ids)
+
+    def username(self, row):
+        username = self.usernames[row]
+        if username is None:
+            return self.names.username(row)
+        return username
+
+    def entries(self):
+        """Return the users as {user_id: entry} dicts, as JSON snapshots store them"""
+        return {
+            str(user_id): {"xp": xp, "level": level, "username": self.username(row)}
+            for row, (user_id, xp, level) in enumerate(zip(self.ids, self.xp, self.levels))
+        }
+
+
+class XPStore:
+    """XP data partitioned by guild, kept in memory with write-behind flushing.
+
+    A guild's partition is loaded on its first activity and evicted again
+    once it has been idle for `idle_timeout` seconds and has nothing left to
+    write, so memory follows the active guilds. Users whose XP changed are
+    tracked as dirty and written out together when the flush interval
+    elapses, when too many users are waiting to be saved, or on shutdown.
+    Backends that can read single rows (SQLite) fill a partition lazily
+    and answer top, count_users, position and user_ids queries themselves;
+    the JSON backend loads a guild's whole file and has none of those.
+
+    With a journaled backend every XP change is also appended to the
+    journal as it happens, flushes become snapshot compactions, and the
+    dirty-user threshold is not needed to bound data loss. Backends that
+    rewrite whole guilds get a GuildColumns copy, so the event loop only
+    copies arrays and the saved form is built in the flush thread.
+
+    `level_for_xp` maps total XP to a level; add_xp uses it to raise levels.
+    """
+
+    def __init__(self, backend, flush_interval=30, flush_threshold=100, idle_timeout=600, level_for_xp=None):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.idle_timeout = idle_timeout
+        self.level_for_xp = level_for_xp
+        self.guilds = {}
+        self.dirty_count = 0
+        self.last_flush = time.monotonic()
+        self.seq = 0
+
+    def partition(self, guild_id):
+        """Return the in-memory partition of a guild, loading it if needed"""
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            data, seq = self.backend.load_guild(guild_id)
+            guild = GuildXP(guild_id, {} if data is None else data, lazy=data is None, seq=seq)
+            self.guilds[guild_id] = guild
+            # New journal records for this guild must sort after its snapshot
+            self.seq = max(self.seq, seq)
+        guild.last_access = time.monotonic()
+        return guild
+
+    async def count(self, guild_id):
+        """Return the number of users with XP in a guild"""
+        guild = self.partition(guild_id)
+        if guild.lazy:
+            await self.flush_guild_async(guild)
+            return await asyncio.to_thread(self.backend.count_users, guild_id)
+        return len(guild)
+
+    def get(self, guild_id, user_id):
+        guild = self.partition(guild_id)
+        entry = guild.get(user_id)
+        if entry is None and guild.lazy:
+            entry = self.backend.get_user(guild_id, user_id)
+            if entry is not None:
+                entry = guild.insert(user_id, entry)
+        return entry
+
+    def ensure(self, guild_id, user_id, username):
+        """Return the entry for a user, creating it if needed"""
+        entry = self.get(guild_id, user_id)
+        if entry is None:
+            entry = self.guilds[guild_id].insert(user_id, {
+                "xp": 0,
+                "level": 1,
+                "username": username
+            })
+        return entry
+
+    def add_xp(self, guild_id, user_id, username, amount, reason="message"):
+        """Add XP to a user, creating them if needed.
+
+        The user's level is raised to match their new XP. Returns the entry
+        and the level the user had before.
+        """
+        old_level = self.ensure(guild_id, user_id, username)["level"]
+        entry = self.guilds[guild_id].add_xp(user_id, amount)
+        entry["username"] = username
+        if self.level_for_xp is not None:
+            entry["level"] = max(old_level, self.level_for_xp(entry["xp"]))
+        self.mark_dirty(guild_id, user_id)
+
+        if self.backend.journaled:
+            self.seq += 1
+            self.backend.append_journal({
+                "s": self.seq,
+                "g": guild_id,
+                "u": user_id,
+                "d": amount,
+                "r": reason,
+                "t": round(time.time(), 3),
+                "n": username,
+                "l": entry["level"]
+            })
+        return entry, old_level
+
+    def replay_journal(self):
+        """Apply journal records newer than each guild's snapshot and start a new segment.
+
+        Returns the number of records applied.
+        """
+        if not self.backend.journaled:
+            return 0
+
+        # The newest segment may be empty after a compaction, but its name
+        # still tells where the sequence left off
+        self.seq = max(self.seq, self.backend.journal_start() - 1)
+        applied = 0
+        for record in self.backend.read_journal():
+            self.seq = max(self.seq, record["s"])
+            guild = self.partition(record["g"])
+            if record["s"] <= guild.seq:
+                continue
+            user_id = record["u"]
+            if user_id not in guild:
+                guild.insert(user_id, {"xp": 0, "level": 1, "username": record["n"]})
+            entry = guild.add_xp(user_id, record["d"])
+            entry["level"] = record["l"]
+            entry["username"] = record["n"]
+            self.mark_dirty(record["g"], user_id)
+            applied += 1
+
+        self.backend.rotate_journal(self.seq + 1)
+        return applied
+
+    def mark_dirty(self, guild_id, user_id):
+        dirty = self.guilds[guild_id].dirty
+        if user_id not in dirty:
+            dirty.add(user_id)
+            self.dirty_count += 1
+
+    async def top(self, guild_id, limit):
+        """Return up to `limit` (user_id, entry) pairs of a guild ordered by XP"""
+        guild = self.partition(guild_id)
+        if guild.lazy:
+            await self.flush_guild_async(guild)
+            return await asyncio.to_thread(self.backend.top, guild_id, limit)
+        return guild.top(limit)
+
+    async def position(self, guild_id, user_id):
+        """Return a user's 1-based leaderboard position in a guild, or None if they have no XP"""
+        entry = self.get(guild_id, user_id)
+        if entry is None:
+            return None
+        guild = self.guilds[guild_id]
+        if guild.lazy:
+            await self.flush_guild_async(guild)
+            return await asyncio.to_thread(self.backend.position, guild_id, user_id, entry["xp"])
+        return guild.position(user_id)
+
+    async def user_ids(self, guild_id):
+        """Return the IDs of every user with XP in a guild, sorted"""
+        guild = self.partition(guild_id)
+        if guild.lazy:
+            await self.flush_guild_async(guild)
+            return await asyncio.to_thread(self.backend.user_ids, guild_id)
+        return sorted(guild.user_ids())
+
+    def migrate_legacy(self, guilds):
+        """Copy XP from the old global user map into every guild its users belong to.
+
+        `guilds` are discord.Guild-like objects; a legacy user is copied into
+        a guild when `guild.get_member` finds them there. Returns the number
+        of entries copied, or None when there is nothing to migrate.
+        """
+        legacy = self.backend.load_legacy_xp()
+        if legacy is None:
+            return None
+
+        copied = 0
+        for guild in guilds:
+            guild_id = str(guild.id)
+            for user_id, entry in legacy.items():
+                if guild.get_member(int(user_id)) is None or self.get(guild_id, user_id) is not None:
+                    continue
+                self.guilds[guild_id].insert(user_id, dict(entry))
+                self.mark_dirty(guild_id, user_id)
+                copied += 1
+
+        self.flush()
+        self.backend.finish_legacy_migration()
+        return copied
+
+    def needs_flush(self):
+        if not self.dirty_count:
+            return False
+        if self.dirty_count >= self.flush_threshold and not self.backend.journaled:
+            return True
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    def _snapshot(self, guild):
+        """Take what the backend saves of a guild: dicts of its dirty users, or a copy of its columns"""
+        if self.backend.partial_writes:
+            snapshot = guild.snapshot(guild.dirty)
+        else:
+            snapshot = GuildColumns.copy(guild)
+        self.dirty_count -= len(guild.dirty)
+        guild.dirty = set()
+        return snapshot
+
+    def flush_guild(self, guild):
+        if guild.dirty:
+            self.backend.save_guild(guild.guild_id, self._snapshot(guild), self.seq)
+
+    async def flush_guild_async(self, guild):
+        if not guild.dirty:
+            return
+        pending = set(guild.dirty)
+        seq = self.seq
+        snapshot = self._snapshot(guild)
+        try:
+            await asyncio.to_thread(self.backend.save_guild, guild.guild_id, snapshot, seq)
+        except Exception:
+            # Keep the users queued so the next flush retries them
+            for user_id in pending - guild.dirty:
+                guild.dirty.add(user_id)
+                self.dirty_count += 1
+            raise
+
+    def flush(self):
+        """Write pending changes of every guild to the backend, blocking the caller"""
+        closed_segments = self._rotate_journal()
+        for guild in list(self.guilds.values()):
+            self.flush_guild(guild)
+        self.last_flush = time.monotonic()
+        if closed_segments:
+            self.backend.remove_journal_segments(closed_segments)
+
+    async def flush_async(self):
+        """Write pending changes of every guild without blocking the event loop"""
+        self.last_flush = time.monotonic()
+        closed_segments = self._rotate_journal()
+        for guild in list(self.guilds.values()):
+            await self.flush_guild_async(guild)
+        # Only reached when every snapshot was written, so the old segments are covered
+        if closed_segments:
+            self.backend.remove_journal_segments(closed_segments)
+
+    def _rotate_journal(self):
+        if not self.backend.journaled:
+            return []
+        return self.backend.rotate_journal(self.seq + 1)
+
+    def evict_idle(self):
+        """Drop partitions that have been idle with nothing left to write"""
+        cutoff = time.monotonic() - self.idle_timeout
+        for guild_id, guild in list(self.guilds.items()):
+            if not guild.dirty and guild.last_access < cutoff:
+                del self.guilds[guild_id]
+
+
+def open_backend(
+    kind, xp_dir, starboard_path, database_path, xp_path=None, snapshot_format="json", journal_dir=None, shared=False
+):
+    if kind == "sqlite":
+        return SQLiteBackend(database_path, xp_path=xp_path, starboard_path=starboard_path, shared=shared)
+    if kind == "json":
+        return JSONBackend(
+            xp_dir, starboard_path, xp_path=xp_path, snapshot_format=snapshot_format,
+            journal_dir=journal_dir, shared=shared
+        )
+    raise ValueError(f"Unknown storage backend: {kind}")
@@ -0,0 +1,46 @@
+"""calculate_level and xp_for_level against the original level formula search.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+import main
+from bench_levels import reference_calculate_level
+
+
+def boundary_values():
+    """Every level threshold, and values just below and above it"""
+    values = [-10, 0, 1]
+    for level in range(1, main.MAX_LEVEL + 3):
+        threshold = main.advanced_xp_for_level(level)
+        values += [threshold - 1, threshold - 1e-9, threshold, threshold + 1e-9, threshold + 1]
+        values += [int(threshold) - 1, int(threshold), int(threshold) + 1]
+    return values
+
+
+@pytest.mark.parametrize("max_level", [1, 2, 10, main.MAX_LEVEL, 250])
+def test_calculate_level_matches_reference(monkeypatch, max_level):
+    monkeypatch.setattr(main, "MAX_LEVEL", max_level)
+    for xp in boundary_values():
+        assert main.calculate_level(xp) == reference_calculate_level(xp), f"xp={xp}"
+
+
+@pytest.mark.parametrize("max_level", [1, main.MAX_LEVEL, 250])
+def test_xp_for_level_matches_formula(monkeypatch, max_level):
+    monkeypatch.setattr(main, "MAX_LEVEL", max_level)
+    for level in range(-1, max_level + 5):
+        assert main.xp_for_level(level) == main.advanced_xp_for_level(level)
+
+
+def test_table_follows_formula_changes(monkeypatch):
+    monkeypatch.setattr(main, "advanced_xp_for_level", lambda level: 0 if level <= 1 else 100 * (level - 1))
+    assert main.calculate_level(99) == 1
+    assert main.calculate_level(100) == 2
+    assert main.calculate_level(10 ** 9) == main.MAX_LEVEL
@@ -0,0 +1,200 @@
+"""The JSON backend: its XP journal and binary snapshots.
+
+Journal tests cover replay after a crash, compaction and torn writes;
+snapshot tests cover the XPSnapshot format, falling back to JSON snapshots
+and usernames changed on top of a memory-mapped snapshot.
+
+Run from the repository root with `python -m pytest tests`.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JSONBackend, XPSnapshot, XPStore, save_json, save_snapshot
+
+GUILD_ID = "100"
+
+
+def open_store(tmp_path, **options):
+    backend = JSONBackend(str(tmp_path / "xp"), str(tmp_path / "starboard.json"), **options)
+    return XPStore(backend, level_for_xp=lambda xp: 1 + xp // 100)
+
+
+def restart(store, tmp_path, **options):
+    """Drop `store` the way a crash would, without flushing, and open the files again"""
+    store.backend.close()
+    store = open_store(tmp_path, **options)
+    return store, store.replay_journal()
+
+
+def journal_names(store):
+    return [os.path.basename(path) for path in store.backend.journal_segments()]
+
+
+def test_replay_restores_xp_never_snapshotted(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 60)
+    store.add_xp(GUILD_ID, "2", "bob", 30)
+    store.add_xp(GUILD_ID, "1", "alice", 50)
+    assert not os.path.exists(store.backend.guild_path(GUILD_ID))
+
+    store, applied = restart(store, tmp_path)
+    assert applied == 3
+    assert dict(store.get(GUILD_ID, "1")) == {"xp": 110, "level": 2, "username": "alice"}
+    assert dict(store.get(GUILD_ID, "2")) == {"xp": 30, "level": 1, "username": "bob"}
+    # Replayed users are written by the next flush
+    assert store.dirty_count == 2
+    # New records continue the sequence
+    store.add_xp(GUILD_ID, "2", "bob", 1)
+    assert store.seq == 4
+
+
+def test_replay_after_a_flush_only_applies_newer_records(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 60)
+    store.add_xp(GUILD_ID, "2", "bob", 30)
+    store.flush()
+    store.add_xp(GUILD_ID, "1", "alice", 50)
+
+    store, applied = restart(store, tmp_path)
+    assert applied == 1
+    assert store.get(GUILD_ID, "1")["xp"] == 110
+    assert store.get(GUILD_ID, "2")["xp"] == 30
+    assert store.guilds[GUILD_ID].dirty == {"1"}
+
+
+def test_replay_skips_records_already_in_the_snapshot(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 60)
+    # A crash between the snapshot and removing the segments it covers
+    store._rotate_journal()
+    store.flush_guild(store.guilds[GUILD_ID])
+    assert len(journal_names(store)) == 2
+
+    store, applied = restart(store, tmp_path)
+    assert applied == 0
+    assert store.get(GUILD_ID, "1")["xp"] == 60
+
+
+def test_compaction_removes_covered_segments(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 10)
+    store.add_xp("200", "1", "alice", 10)
+    assert journal_names(store) == ["journal-1.jsonl"]
+
+    store.flush()
+    assert journal_names(store) == ["journal-3.jsonl"]
+    assert store.dirty_count == 0
+
+    # An empty newest segment still tells where the sequence left off
+    store, applied = restart(store, tmp_path)
+    assert applied == 0
+    assert store.seq == 2
+    store.add_xp(GUILD_ID, "1", "alice", 10)
+    assert store.seq == 3
+
+
+def test_replay_ignores_a_torn_last_line(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 60)
+    store.add_xp(GUILD_ID, "1", "alice", 50)
+    store.backend.journal.write('{"s":3,"g":"100","u":"1","d":')
+    store.backend.journal.flush()
+
+    store, applied = restart(store, tmp_path)
+    assert applied == 2
+    assert store.get(GUILD_ID, "1")["xp"] == 110
+    assert store.seq == 2
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "guild.xps")
+    entries = {
+        "30": {"xp": 300, "level": 3, "username": "carol"},
+        "10": {"xp": -5, "level": 1, "username": ""},
+        str(2 ** 64 - 1): {"xp": 2 ** 40, "level": 100, "username": "dävid 🦊"}
+    }
+    save_snapshot(path, entries, seq=42)
+
+    snapshot = XPSnapshot(path)
+    try:
+        assert snapshot.seq == 42
+        assert len(snapshot) == 3
+        assert list(snapshot.ids()) == [10, 30, 2 ** 64 - 1]
+        assert dict(snapshot.items()) == entries
+        assert snapshot.get("30") == entries["30"]
+        assert snapshot.get(str(2 ** 64 - 1)) == entries[str(2 ** 64 - 1)]
+        assert snapshot.get("20") is None
+        assert snapshot.get("40") is None
+    finally:
+        snapshot.close()
+
+    save_snapshot(path, {})
+    snapshot = XPSnapshot(path)
+    assert len(snapshot) == 0 and snapshot.get("1") is None
+    snapshot.close()
+
+
+def test_snapshot_rejects_other_files(tmp_path):
+    path = str(tmp_path / "guild.xps")
+    save_snapshot(path, {"1": {"xp": 1, "level": 1, "username": "alice"}})
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:-1])
+    with pytest.raises(ValueError):
+        XPSnapshot(path)
+
+    save_json(path, {"users": {}, "seq": 0})
+    with pytest.raises(ValueError):
+        XPSnapshot(path)
+
+
+def test_binary_backend_falls_back_to_json_snapshot(tmp_path):
+    store = open_store(tmp_path)
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 60)
+    store.flush()
+    store.backend.close()
+
+    store = open_store(tmp_path, snapshot_format="binary")
+    store.replay_journal()
+    assert dict(store.get(GUILD_ID, "1")) == {"xp": 60, "level": 1, "username": "alice"}
+
+    # The next save converts the guild and removes its JSON snapshot
+    store.add_xp(GUILD_ID, "1", "alice", 1)
+    store.flush()
+    assert os.path.exists(store.backend.guild_path(GUILD_ID, "binary"))
+    assert not os.path.exists(store.backend.guild_path(GUILD_ID, "json"))
+    store.backend.close()
+
+
+def test_usernames_change_on_top_of_a_mapped_snapshot(tmp_path):
+    store = open_store(tmp_path, snapshot_format="binary")
+    store.replay_journal()
+    store.add_xp(GUILD_ID, "1", "alice", 10)
+    store.add_xp(GUILD_ID, "2", "bob", 10)
+    store.flush()
+    store, _ = restart(store, tmp_path, snapshot_format="binary")
+
+    guild = store.partition(GUILD_ID)
+    assert isinstance(guild.names, XPSnapshot)
+    # Unchanged usernames stay in the mapped file
+    assert guild.usernames == [None, None]
+    store.add_xp(GUILD_ID, "2", "robert", 10)
+    store.add_xp(GUILD_ID, "3", "carol", 10)
+    assert [store.get(GUILD_ID, user_id)["username"] for user_id in ("1", "2", "3")] == ["alice", "robert", "carol"]
+
+    # Written over the file the partition still maps
+    store.flush()
+    store, _ = restart(store, tmp_path, snapshot_format="binary")
+    assert [store.get(GUILD_ID, user_id)["username"] for user_id in ("1", "2", "3")] == ["alice", "robert", "carol"]
+    store.backend.close()
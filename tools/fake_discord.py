@@ -0,0 +1,263 @@
+"""A local stand-in for the parts of Discord's REST API the bot uses.
+
+Start a FakeDiscord, point discord.py at `base_url` (see `install`), and
+every request the bot makes is answered locally with a plausible payload.
+Requests are counted per route, and each rate limit bucket allows
+`limit` requests per `window` seconds before answering 429, like Discord
+does. `error_rate` additionally answers that share of requests with a 429
+to exercise the retry paths.
+"""
+import datetime
+import itertools
+import json
+import random
+import re
+import time
+from collections import Counter
+
+import discord
+import discord.http
+import discord.webhook.async_
+from aiohttp import web
+
+API_PREFIX = "/api/v10"
+
+_snowflakes = itertools.count(int((time.time() * 1000 - discord.utils.DISCORD_EPOCH)) << 22)
+
+
+def snowflake():
+    return str(next(_snowflakes))
+
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def route_template(method, path):
+    """Turn /channels/123/messages/456 into POST /channels/{id}/messages/{id}"""
+    path = re.sub(r"/interactions/(\d+)/[^/]+", "/interactions/{id}/{token}", path)
+    path = re.sub(r"/webhooks/(\d+)/[^/]+", "/webhooks/{id}/{token}", path)
+    return f"{method} " + re.sub(r"/\d+", "/{id}", path)
+
+
+def bucket_key(method, path):
+    """Discord's rate limits are per route and major parameter (channel, guild or webhook)"""
+    template = route_template(method, path)
+    major = re.match(r"/(channels|guilds|webhooks|interactions)/(\d+)", path)
+    return (template, major.group(2) if major else None)
+
+
+def user_payload(user_id, name=None, bot=False):
+    return {
+        "id": str(user_id),
+        "username": name or f"user{user_id}",
+        "global_name": None,
+        "discriminator": "0",
+        "avatar": None,
+        "bot": bot
+    }
+
+
+def member_payload(user_id, roles=(), name=None):
+    return {
+        "user": user_payload(user_id, name),
+        "roles": [str(role_id) for role_id in roles],
+        "joined_at": now_iso(),
+        "deaf": False,
+        "mute": False,
+        "flags": 0
+    }
+
+
+def message_payload(message_id, channel_id, author, content="", embeds=(), reactions=(), guild_id=None):
+    payload = {
+        "id": str(message_id),
+        "channel_id": str(channel_id),
+        "author": author,
+        "content": content,
+        "timestamp": now_iso(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": list(embeds),
+        "reactions": list(reactions),
+        "pinned": False,
+        "type": 0,
+        "flags": 0
+    }
+    if guild_id is not None:
+        payload["guild_id"] = str(guild_id)
+    return payload
+
+
+def json_response(payload, status, headers):
+    # discord.py only decodes bodies whose content type is exactly application/json
+    return web.Response(
+        body=json.dumps(payload).encode(), status=status,
+        headers={**headers, "Content-Type": "application/json"}
+    )
+
+
+class FakeDiscord:
+    BOT_USER_ID = "100000000000000001"
+
+    def __init__(self, limit=5, window=5.0, error_rate=0.0, seed=0):
+        self.limit = limit
+        self.window = window
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.rate_limited = Counter()
+        self.buckets = {}  # format: bucket key: [window start, requests in window]
+        # Messages the replayed events created, so fetches return them -
+        # format: message_id: {"payload", "stars": {emoji: count}}
+        self.messages = {}
+        self.runner = None
+        self.base_url = None
+
+        self.app = web.Application()
+        self.app.router.add_route("*", API_PREFIX + "/{path:.*}", self.handle)
+
+    async def start(self, host="127.0.0.1", port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://{host}:{port}{API_PREFIX}"
+        return self.base_url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def install(self):
+        """Send discord.py's REST and webhook requests to this server"""
+        discord.http.Route.BASE = self.base_url
+        discord.webhook.async_.Route.BASE = self.base_url
+
+    def remember_message(self, data):
+        self.messages[data["id"]] = {"payload": data, "stars": Counter()}
+
+    def remember_reaction(self, data, delta):
+        message = self.messages.get(data["message_id"])
+        if message is not None:
+            emoji = data["emoji"].get("name")
+            message["stars"][emoji] = max(0, message["stars"][emoji] + delta)
+
+    def check_rate_limit(self, method, path):
+        """Return (allowed, response headers, seconds until the request's bucket resets)"""
+        key = bucket_key(method, path)
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+        if bucket is None or now - bucket[0] >= self.window:
+            bucket = self.buckets[key] = [now, 0]
+        reset_after = self.window - (now - bucket[0])
+        headers = {
+            "X-RateLimit-Limit": str(self.limit),
+            "X-RateLimit-Bucket": f"{key[0]}:{key[1]}",
+            "X-RateLimit-Reset-After": f"{reset_after:.3f}",
+            "X-RateLimit-Reset": f"{time.time() + reset_after:.3f}"
+        }
+        if bucket[1] >= self.limit or self.random.random() < self.error_rate:
+            headers["X-RateLimit-Remaining"] = "0"
+            headers["Retry-After"] = f"{reset_after:.3f}"
+            return False, headers, reset_after
+        bucket[1] += 1
+        headers["X-RateLimit-Remaining"] = str(self.limit - bucket[1])
+        return True, headers, reset_after
+
+    async def handle(self, request):
+        path = "/" + request.match_info["path"]
+        template = route_template(request.method, path)
+        self.calls[template] += 1
+
+        allowed, headers, retry_after = self.check_rate_limit(request.method, path)
+        if not allowed:
+            self.rate_limited[template] += 1
+            body = {"message": "You are being rate limited.", "retry_after": retry_after, "global": False}
+            return json_response(body, 429, headers)
+
+        body = await request.json() if request.can_read_body and request.content_type == "application/json" else {}
+        status, payload = self.respond(request.method, path, body)
+        if payload is None:
+            return web.Response(status=status, headers=headers)
+        return json_response(payload, status, headers)
+
+    def respond(self, method, path, body):
+        parts = path.strip("/").split("/")
+
+        if path == "/users/@me":
+            return 200, user_payload(self.BOT_USER_ID, "Kitan", bot=True)
+
+        if path == "/oauth2/applications/@me":
+            return 200, {
+                "id": self.BOT_USER_ID,
+                "name": "Kitan",
+                "description": "",
+                "icon": None,
+                "bot_public": True,
+                "bot_require_code_grant": False,
+                "owner": user_payload(1, "owner"),
+                "verify_key": "",
+                "flags": 0
+            }
+
+        if parts[0] == "applications" and parts[-1] == "commands":
+            # Echo synced commands back with IDs
+            commands = body if isinstance(body, list) else []
+            return 200, [
+                {**command, "id": snowflake(), "application_id": parts[1], "version": snowflake()}
+                for command in commands
+            ]
+
+        if parts[0] == "channels" and parts[2:3] == ["messages"]:
+            channel_id = parts[1]
+            if method == "POST" and len(parts) == 3:
+                payload = message_payload(
+                    snowflake(), channel_id, user_payload(self.BOT_USER_ID, "Kitan", bot=True),
+                    body.get("content") or "", body.get("embeds") or ()
+                )
+                self.remember_message(payload)
+                return 200, payload
+            if len(parts) == 4:
+                message = self.messages.get(parts[3])
+                if message is None:
+                    payload = message_payload(parts[3], channel_id, user_payload(1))
+                    self.remember_message(payload)
+                    message = self.messages[parts[3]]
+                if method == "PATCH" and "embeds" in body:
+                    message["payload"]["embeds"] = body["embeds"]
+                reactions = [
+                    {"emoji": {"id": None, "name": emoji}, "count": count, "me": False,
+                     "count_details": {"burst": 0, "normal": count}, "burst_colors": [], "me_burst": False}
+                    for emoji, count in message["stars"].items() if count
+                ]
+                return 200, {**message["payload"], "reactions": reactions}
+
+        if parts[0] == "guilds" and parts[2:3] == ["members"] and len(parts) == 4:
+            return 200, member_payload(parts[3], body.get("roles", ()))
+
+        if parts[0] == "interactions" and parts[-1] == "callback":
+            data = body.get("data") or {}
+            response = {"interaction": {"id": parts[1], "type": 2}, "resource": {"type": body.get("type", 4)}}
+            if data:
+                response["resource"]["message"] = message_payload(
+                    snowflake(), "0", user_payload(self.BOT_USER_ID, "Kitan", bot=True),
+                    data.get("content") or "", data.get("embeds") or ()
+                )
+            return 200, response
+
+        if parts[0] == "webhooks":
+            if method == "DELETE":
+                return 204, None
+            return 200, message_payload(
+                snowflake(), "0", user_payload(self.BOT_USER_ID, "Kitan", bot=True),
+                body.get("content") or "", body.get("embeds") or ()
+            )
+
+        # Anything else succeeds with an empty body
+        return 204, None
@@ -0,0 +1,293 @@
+"""Replay recorded gateway events through the bot against a fake Discord.
+
+Record events by setting GATEWAY_RECORD_FILE in main.py, then run from the
+repository root:
+
+    python tools/replay.py replay recording.jsonl [--speed 10] [--config bot_config.json]
+
+Events are fed to discord.py's own gateway parsers, so they reach the real
+on_message, on_raw_reaction_add and slash command handlers. The REST
+requests those make go to tools/fake_discord.py. Events are replayed with
+their original spacing divided by `--speed` (0 replays as fast as
+possible), in a temporary directory so no real data is touched.
+
+Without a recording, a synthetic one can be made with:
+
+    python tools/replay.py generate recording.jsonl [--messages 10000] [--users 500]
+
+The report shows throughput, handler latency per event type (from the
+event being fed in until the handler tasks it started have finished), and
+REST calls per route and per event, including rate limited ones.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_discord import FakeDiscord, member_payload, message_payload, user_payload
+
+SETUP_EVENTS = {"READY", "GUILD_CREATE"}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def load_recording(path):
+    with open(path, "r") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def generate(path, messages, users, reactions, commands, rate, seed):
+    """Write a synthetic recording of one busy server"""
+    rng = random.Random(seed)
+    guild_id, channel_id, app_id = "200000000000000001", "200000000000000002", FakeDiscord.BOT_USER_ID
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    ts = time.time()
+    records = [
+        {"ts": ts, "t": "READY", "d": {
+            "v": 10, "user": user_payload(app_id, "Kitan", bot=True), "session_id": "replay",
+            "resume_gateway_url": "wss://localhost", "guilds": [{"id": guild_id, "unavailable": True}],
+            "application": {"id": app_id, "flags": 0}
+        }},
+        {"ts": ts, "t": "GUILD_CREATE", "d": {
+            "id": guild_id, "name": "Replay", "icon": None, "owner_id": "1", "member_count": users,
+            "large": users > 250, "unavailable": False, "joined_at": now, "features": [], "emojis": [],
+            "stickers": [], "threads": [], "presences": [], "voice_states": [], "stage_instances": [],
+            "guild_scheduled_events": [], "soundboard_sounds": [],
+            "roles": [{"id": guild_id, "name": "@everyone", "permissions": "0", "position": 0, "color": 0,
+                       "hoist": False, "managed": False, "mentionable": False, "flags": 0}],
+            "channels": [{"id": channel_id, "type": 0, "name": "general", "position": 0,
+                          "permission_overwrites": []}],
+            "members": [member_payload(app_id, name="Kitan")]
+        }}
+    ]
+
+    message_ids = []
+    for i in range(messages):
+        ts += rng.expovariate(rate)
+        user_id = str(300000000000000000 + rng.randrange(users))
+        member = member_payload(user_id)
+        del member["user"]
+        message_id = str(400000000000000000 + i)
+        message_ids.append(message_id)
+        data = message_payload(
+            message_id, channel_id, user_payload(user_id), "hello " * rng.randint(1, 40), guild_id=guild_id
+        )
+        data["member"] = member
+        records.append({"ts": ts, "t": "MESSAGE_CREATE", "d": data})
+
+        if rng.random() < reactions:
+            # Stars cluster on a few recent messages
+            target = message_ids[max(0, len(message_ids) - 1 - int(rng.expovariate(0.2)))]
+            records.append({"ts": ts, "t": "MESSAGE_REACTION_ADD", "d": {
+                "user_id": user_id, "channel_id": channel_id, "message_id": target, "guild_id": guild_id,
+                "member": member_payload(user_id), "emoji": {"id": None, "name": "⭐"}, "burst": False, "type": 0
+            }})
+
+        if rng.random() < commands:
+            records.append({"ts": ts, "t": "INTERACTION_CREATE", "d": {
+                "id": str(500000000000000000 + i), "application_id": app_id, "type": 2, "token": "replay",
+                "version": 1, "guild_id": guild_id, "channel_id": channel_id,
+                "channel": {"id": channel_id, "type": 0, "name": "general", "guild_id": guild_id},
+                "member": {**member_payload(user_id), "permissions": "0"}, "locale": "en-US",
+                "guild_locale": "en-US", "app_permissions": "0", "entitlements": [], "attachment_size_limit": 8388608,
+                "authorizing_integration_owners": {"0": guild_id}, "context": 0,
+                "data": rng.choice([
+                    {"id": "1", "name": "rank", "type": 1},
+                    {"id": "2", "name": "leaderboard", "type": 1}
+                ])
+            }})
+
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"Wrote {len(records)} events to {path}")
+
+
+class TaskCollector:
+    """Task factory that remembers the tasks created while an event is being parsed"""
+
+    def __init__(self):
+        self.collecting = None
+
+    def __call__(self, loop, coro, **kwargs):
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        if self.collecting is not None:
+            self.collecting.append(task)
+        return task
+
+
+async def wait_until_idle(main, timeout):
+    """Wait for queued XP, level-ups, starboard edits and outbound requests to finish"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        pending = (
+            main.xp_queue.qsize() + len(main.level_up_tasks) + len(main.starboard_edit_tasks)
+            + len(main.outbound.queue) + main.outbound.in_flight
+        )
+        if not pending:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+async def replay(path, speed, config, limit, window, error_rate, settle):
+    records = load_recording(path)
+    fake = FakeDiscord(limit=limit, window=window, error_rate=error_rate)
+    await fake.start()
+    fake.install()
+
+    original_directory = os.getcwd()
+    directory = tempfile.mkdtemp(prefix="kitan-replay-")
+    if config:
+        shutil.copy(config, os.path.join(directory, "bot_config.json"))
+    os.chdir(directory)
+
+    import main
+    main.load_config()
+    main.open_storage()
+    bot = main.bot
+    # There is no gateway connection to request member chunks over
+    bot._connection._chunk_guilds = False
+
+    collector = TaskCollector()
+    asyncio.get_running_loop().set_task_factory(collector)
+    latencies = defaultdict(list)
+    counts = Counter()
+
+    def track(event_type, started, tasks):
+        remaining = [len(tasks)]
+
+        def done(_):
+            remaining[0] -= 1
+            if not remaining[0]:
+                latencies[event_type].append(time.perf_counter() - started)
+
+        for task in tasks:
+            task.add_done_callback(done)
+        if not tasks:
+            latencies[event_type].append(time.perf_counter() - started)
+
+    try:
+        await bot.login("replay")
+        replay_started = None
+        first_ts = None
+        handler_tasks = []
+
+        for record in records:
+            event_type, data = record["t"], record["d"]
+            if event_type not in SETUP_EVENTS:
+                if replay_started is None:
+                    await asyncio.wait_for(bot.wait_until_ready(), timeout=30)
+                    replay_started = time.perf_counter()
+                    first_ts = record["ts"]
+                    fake.calls.clear()
+                    fake.rate_limited.clear()
+                elif speed:
+                    delay = (record["ts"] - first_ts) / speed - (time.perf_counter() - replay_started)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+            if event_type == "MESSAGE_CREATE":
+                fake.remember_message(data)
+            elif event_type == "MESSAGE_REACTION_ADD":
+                fake.remember_reaction(data, 1)
+            elif event_type == "MESSAGE_REACTION_REMOVE":
+                fake.remember_reaction(data, -1)
+
+            parser = bot._connection.parsers.get(event_type)
+            if parser is None:
+                continue
+            collector.collecting = tasks = []
+            started = time.perf_counter()
+            parser(data)
+            collector.collecting = None
+            if event_type not in SETUP_EVENTS:
+                counts[event_type] += 1
+                handler_tasks += tasks
+                track(event_type, started, tasks)
+            # Let the handlers run between events, as the gateway reader would
+            await asyncio.sleep(0)
+
+        if replay_started is None:
+            print("The recording has no events to replay")
+            return
+
+        await asyncio.gather(*handler_tasks, return_exceptions=True)
+        handled = time.perf_counter() - replay_started
+        idle = await wait_until_idle(main, settle)
+        finished = time.perf_counter() - replay_started
+        report(counts, latencies, fake, handled, finished, idle, speed, records[-1]["ts"] - first_ts)
+    finally:
+        await bot.close()
+        main.xp_store.flush()
+        main.storage_backend.close()
+        await fake.stop()
+        os.chdir(original_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def report(counts, latencies, fake, handled, finished, idle, speed, recorded_span):
+    events = sum(counts.values())
+    print(f"Replayed {events} events recorded over {recorded_span:.1f}s at speed {speed or 'max'}")
+    print(f"  handlers done after {handled:.2f}s ({events / handled:,.0f} events/s)")
+    print(f"  queues drained after {finished:.2f}s" + ("" if idle else " (gave up waiting)"))
+
+    print(f"\n{'event':<28} {'count':>8} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for event_type, values in sorted(latencies.items()):
+        values.sort()
+        print(
+            f"{event_type:<28} {counts[event_type]:>8} {percentile(values, 0.5) * 1000:>10.2f} "
+            f"{percentile(values, 0.99) * 1000:>10.2f} {values[-1] * 1000:>10.2f}"
+        )
+
+    total = sum(fake.calls.values())
+    print(f"\n{'REST route':<60} {'calls':>8} {'429s':>8}")
+    for route, calls in fake.calls.most_common():
+        print(f"{route:<60} {calls:>8} {fake.rate_limited[route]:>8}")
+    print(f"{'total':<60} {total:>8} {sum(fake.rate_limited.values()):>8}")
+    print(f"\n{total / events:.3f} REST calls per event")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Record-and-replay harness for gateway events")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    replay_parser = commands.add_parser("replay", help="Replay a recording")
+    replay_parser.add_argument("recording")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="Speed-up factor, 0 for as fast as possible")
+    replay_parser.add_argument("--config", help="bot_config.json to replay with")
+    replay_parser.add_argument("--limit", type=int, default=5, help="Requests per rate limit bucket and window")
+    replay_parser.add_argument("--window", type=float, default=5.0, help="Rate limit window in seconds")
+    replay_parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with 429")
+    replay_parser.add_argument("--settle", type=float, default=60.0, help="Seconds to wait for queues to drain")
+
+    generate_parser = commands.add_parser("generate", help="Write a synthetic recording")
+    generate_parser.add_argument("recording")
+    generate_parser.add_argument("--messages", type=int, default=10_000)
+    generate_parser.add_argument("--users", type=int, default=500)
+    generate_parser.add_argument("--reactions", type=float, default=0.05, help="Star reactions per message")
+    generate_parser.add_argument("--commands", type=float, default=0.01, help="Slash commands per message")
+    generate_parser.add_argument("--rate", type=float, default=50.0, help="Messages per second")
+    generate_parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "generate":
+        generate(args.recording, args.messages, args.users, args.reactions, args.commands, args.rate, args.seed)
+    else:
+        asyncio.run(replay(
+            args.recording, args.speed, args.config, args.limit, args.window, args.error_rate, args.settle
+        ))
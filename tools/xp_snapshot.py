@@ -0,0 +1,89 @@
+"""Convert per-server XP files between the JSON and binary snapshot formats.
+
+Run from the repository root while the bot is stopped:
+
+    python tools/xp_snapshot.py to-binary [paths...]
+    python tools/xp_snapshot.py to-json [paths...]
+    python tools/xp_snapshot.py show path.xps [user_id]
+
+`paths` are guild files or directories of them (default: XP_DIR). Each file
+is rewritten in the other format next to the original, which is then
+removed, so the bot finds exactly one snapshot per server. The journal
+sequence number is kept, so journal records written after the snapshot are
+still replayed. `show` prints a binary snapshot's header, or one user looked
+up in place.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import XPSnapshot, load_json_snapshot, save_json, save_snapshot
+
+EXTENSIONS = {"binary": ".xps", "json": ".json"}
+
+
+def snapshot_files(paths, extension):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(extension) and not name.startswith("journal-"):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def convert(path, target):
+    base, extension = os.path.splitext(path)
+    if extension == EXTENSIONS[target]:
+        return
+    if target == "binary":
+        entries, seq = load_json_snapshot(path)
+        save_snapshot(base + ".xps", entries, seq)
+    else:
+        snapshot = XPSnapshot(path)
+        try:
+            entries, seq = dict(snapshot.items()), snapshot.seq
+        finally:
+            snapshot.close()
+        save_json(base + ".json", {"seq": seq, "users": entries})
+    os.remove(path)
+    print(f"{path} -> {base + EXTENSIONS[target]} ({len(entries)} users)")
+
+
+def show(path, user_id):
+    snapshot = XPSnapshot(path)
+    try:
+        if user_id is None:
+            print(f"{path}: {len(snapshot)} users, journal sequence {snapshot.seq}")
+        else:
+            print(snapshot.get(user_id) or f"User {user_id} is not in {path}")
+    finally:
+        snapshot.close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert XP snapshots between JSON and binary")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for target in EXTENSIONS:
+        convert_parser = commands.add_parser(f"to-{target}", help=f"Convert snapshots to {target}")
+        convert_parser.add_argument("paths", nargs="*")
+    show_parser = commands.add_parser("show", help="Inspect a binary snapshot")
+    show_parser.add_argument("path")
+    show_parser.add_argument("user_id", nargs="?", type=int)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.command == "show":
+        show(args.path, args.user_id)
+    else:
+        target = args.command[len("to-"):]
+        source_extension = EXTENSIONS["json" if target == "binary" else "binary"]
+        if not args.paths:
+            import main
+            args.paths = [main.XP_DIR]
+        for path in snapshot_files(args.paths, source_extension):
+            convert(path, target)